@@ -0,0 +1,231 @@
+"""Analytics -- vectorized statistics over the columnar trade store.
+
+Functions take the column arrays of a ColumnStore (see ColumnStore.load)
+and return tables: dicts of equally long arrays.  Group-bys sort the rows
+once with np.lexsort and reduce every run of equal keys with
+np.add.reduceat, so no Python code runs per row.
+
+Keys are column names ('species', 'market') or periods of the trade date
+('day', 'month' as YYYYMM, 'year').
+"""
+
+import time
+import warnings
+
+import numpy as np
+
+PERIODS = {'day': 1, 'month': 100, 'year': 10000}
+
+
+def key_array(columns, name):
+    if name in PERIODS:
+        return columns['date'] // PERIODS[name]
+    return columns[name]
+
+
+def packed(keys):
+    """Pack non-negative integer keys into one int64 that sorts like them, or None."""
+    result = np.zeros(len(keys[0]), dtype='i8')
+    span = 1
+    for key in keys:
+        if not len(key):
+            return result
+        low, high = int(key.min()), int(key.max())
+        if low < 0 or key.dtype.kind not in 'iu':
+            return None
+        span *= high + 1
+        if span >= 1 << 62:
+            return None
+        result *= high + 1
+        result += key
+    return result
+
+
+def group_by(keys, then=None):
+    """Sort rows by the `keys` arrays, and within a group by `then`.
+
+    Returns (order, starts, group keys): the sorting permutation, the
+    position where each group starts in sorted order, and each group's keys.
+    Integer keys are packed into one int64 so a single argsort does the work
+    of np.lexsort.
+    """
+    sort_keys = keys + [then] if then is not None else keys
+    key = packed(sort_keys)
+    if key is not None:
+        order = np.argsort(key)
+    else:
+        order = np.lexsort(sort_keys[::-1])
+    sorted_keys = [key[order] for key in keys]
+    change = np.zeros(len(order), dtype=bool)
+    change[:1] = True
+    for key in sorted_keys:
+        change[1:] |= key[1:] != key[:-1]
+    starts = np.flatnonzero(change)
+    return order, starts, [key[starts] for key in sorted_keys]
+
+
+def group_sizes(starts, n):
+    return np.diff(np.append(starts, n))
+
+
+def reduce_sum(values, starts):
+    """Sum of each group of sorted `values`; reduceat needs at least one group."""
+    if not len(starts):
+        return np.zeros(0, dtype=values.dtype)
+    return np.add.reduceat(values, starts)
+
+
+def ratio(numerator, denominator):
+    """numerator / denominator, NaN where the denominator is 0."""
+    return np.divide(numerator, denominator, out=np.full(len(numerator), np.nan), where=denominator != 0)
+
+
+def vwap(columns, by=('species', 'market')):
+    """Volume-weighted average price, total volume and trade count per group."""
+    order, starts, group_keys = group_by([key_array(columns, name) for name in by])
+    volume = columns['trans_amount'][order].astype('f8')
+    value = columns['avg_price'][order] * volume
+    table = dict(zip(by, group_keys))
+    table['volume'] = reduce_sum(volume, starts)
+    table['vwap'] = ratio(reduce_sum(value, starts), table['volume'])
+    table['trades'] = group_sizes(starts, len(order))
+    return table
+
+
+def spread(columns, by=('species', 'market')):
+    """Mean high - low spread per group, absolute and relative to the average price."""
+    order, starts, group_keys = group_by([key_array(columns, name) for name in by])
+    high, low, avg = (columns[name][order].astype('f8') for name in ('high_price', 'low_price', 'avg_price'))
+    counts = group_sizes(starts, len(order))
+    table = dict(zip(by, group_keys))
+    table['spread'] = ratio(reduce_sum(high - low, starts), counts)
+    table['relative_spread'] = ratio(reduce_sum(ratio(high - low, avg), starts), counts)
+    return table
+
+
+def rolling_sums(values, lo, idx):
+    """Sums of values[lo:idx + 1] for every row, from one cumulative sum."""
+    cumulative = np.concatenate(([0.0], np.cumsum(values)))
+    return cumulative[idx + 1] - cumulative[lo]
+
+
+def rolling(columns, window=20, field='avg_price', by=('species', 'market')):
+    """Rolling mean, standard deviation and volatility over each group's last `window` trades.
+
+    Volatility is the standard deviation of daily log returns in the same
+    window.  Returns one entry per trade, sorted by group and date.
+    """
+    keys = [key_array(columns, name) for name in by]
+    order, starts, _ = group_by(keys, then=columns['date'])
+    n = len(order)
+    sizes = group_sizes(starts, n)
+    group_start = np.repeat(starts, sizes)
+    idx = np.arange(n)
+    lo = np.maximum(idx - window + 1, group_start)
+    count = idx - lo + 1
+
+    values = columns[field][order].astype('f8')
+    # Shifting each group by its first value keeps the cumulative sums small.
+    shifted = values - values[group_start] if n else values
+    mean_shift = rolling_sums(shifted, lo, idx) / count
+    variance = rolling_sums(shifted ** 2, lo, idx) / count - mean_shift ** 2
+
+    returns = np.zeros(n)
+    valid = np.zeros(n, dtype=bool)
+    if n:
+        valid[1:] = (group_start[1:] != idx[1:]) & (values[1:] > 0) & (values[:-1] > 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            returns[1:] = np.where(valid[1:], np.log(values[1:] / values[:-1]), 0.0)
+    # A window's first trade has no return inside the window.
+    return_lo = np.minimum(lo + 1, idx)
+    return_count = rolling_sums(valid.astype('f8'), return_lo, idx)
+    return_mean = ratio(rolling_sums(returns, return_lo, idx), return_count)
+    return_variance = ratio(rolling_sums(returns ** 2, return_lo, idx), return_count) - return_mean ** 2
+
+    table = {name: key[order] for name, key in zip(by, keys)}
+    table['date'] = columns['date'][order]
+    table[field] = values
+    table['mean'] = mean_shift + (values[group_start] if n else 0)
+    table['std'] = np.sqrt(np.maximum(variance, 0))
+    table['volatility'] = np.where(return_count > 1, np.sqrt(np.maximum(return_variance, 0)), np.nan)
+    return table
+
+
+def composite(table, by):
+    """One int64 per row, ordered like the rows of a table sorted by `by`."""
+    key = np.zeros(len(table[by[0]]) if by else 0, dtype='i8')
+    for name in by:
+        values = table[name].astype('i8')
+        key = key * (int(values.max()) + 1 if len(values) else 1) + values
+    return key
+
+
+def yoy(columns, by=('species',)):
+    """Monthly VWAP per group and its change from the same month a year earlier."""
+    by = tuple(by)
+    table = vwap(columns, by + ('month',))
+    month = table['month'].astype('i8')
+    key = composite(table, by) * 1000000 + month
+    previous = key - 100
+    position = np.searchsorted(key, previous)
+    found = position < len(key)
+    found[found] = key[position[found]] == previous[found]
+    change = np.full(len(key), np.nan)
+    change[found] = ratio(table['vwap'][found], table['vwap'][position[found]]) - 1
+    table['yoy'] = change
+    return table
+
+
+def seasonality(columns, by=('species',)):
+    """Seasonal index per group and calendar month.
+
+    Each month's VWAP is divided by the mean monthly VWAP of its year; the
+    index is the average of that ratio over the years.
+    """
+    by = tuple(by)
+    monthly = vwap(columns, by + ('month',))
+    group = [monthly[name] for name in by]
+    year = monthly['month'] // 100
+    prices = monthly['vwap']
+    _, starts, _ = group_by(group + [year])  # Already in (group, month) order.
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        counts = group_sizes(starts, len(prices))
+        valid = ~np.isnan(prices)
+        annual = ratio(reduce_sum(np.where(valid, prices, 0), starts), reduce_sum(valid.astype('f8'), starts))
+        relative = prices / np.repeat(annual, counts)
+    calendar = monthly['month'] % 100
+    order, starts, group_keys = group_by(group + [calendar])
+    relative = relative[order]
+    valid = ~np.isnan(relative)
+    table = dict(zip(by + ('month',), group_keys))
+    table['index'] = ratio(reduce_sum(np.where(valid, relative, 0), starts), reduce_sum(valid.astype('f8'), starts))
+    table['years'] = reduce_sum(valid.astype('i8'), starts)
+    return table
+
+
+def naive_vwap(columns, by=('species', 'market')):
+    """vwap() as a plain Python loop over rows, for benchmarks and checks."""
+    totals = {}
+    keys = zip(*[key_array(columns, name).tolist() for name in by])
+    for key, price, volume in zip(keys, columns['avg_price'].tolist(), columns['trans_amount'].tolist()):
+        value_sum, volume_sum = totals.get(key, (0.0, 0.0))
+        totals[key] = value_sum + price * volume, volume_sum + volume
+    return {key: value / volume if volume else float('nan') for key, (value, volume) in totals.items()}
+
+
+def benchmark(columns, by=('species', 'market'), repeat=3):
+    """Time vwap() against naive_vwap(); return rows per second for each."""
+    rows = len(columns['date'])
+    results = {}
+    for name, fn in (('vectorized', vwap), ('naive', naive_vwap)):
+        best = float('inf')
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            fn(columns, by)
+            best = min(best, time.perf_counter() - t0)
+        results[name] = rows / best if best else float('inf')
+    print('vwap over {} rows by {}: vectorized {:.0f} rows/sec, naive loop {:.0f} rows/sec ({:.0f}x)'.format(
+        rows, '/'.join(by), results['vectorized'], results['naive'],
+        results['vectorized'] / results['naive'] if results['naive'] else float('inf')))
+    return results
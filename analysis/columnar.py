@@ -0,0 +1,237 @@
+"""Columnar store -- crawled trades exported to memory-mapped column files.
+
+Every column is a raw little-endian array in a file of its own, described
+by 'meta.json': the dtypes, the row count, the export watermark and the
+species and market dictionaries the integer code columns index into.
+Readers map the files with numpy.memmap, so opening years of trades costs
+a few system calls however many rows there are.
+
+Exports are incremental.  Trades past the watermark are appended in id
+order; trades of dates the ledger shows as fetched again since the last
+export are patched in place, as the storage upserts keep their ids.  The
+row count in meta.json is written last, so readers never see a
+half-appended tail, and the next export cuts such a tail off.  A database
+reset since the last export (a new storage.database_generation) is
+exported again from scratch.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import time
+
+import numpy as np
+
+from crawler.storage import DATABASE_PATH, LEDGER_TABLE, database_generation
+
+LOGGER = logging.getLogger(__name__)
+
+META_FILE = 'meta.json'
+
+# Column name and dtype, in SELECT_SQL order.  'species' and 'market' hold
+# positions in the dictionaries kept in meta.json.
+COLUMNS = (
+    ('id', '<i8'),
+    ('date', '<i4'),
+    ('species', '<i4'),
+    ('market', '<i4'),
+    ('high_price', '<f8'),
+    ('low_price', '<f8'),
+    ('mid_price', '<f8'),
+    ('avg_price', '<f8'),
+    ('trans_amount', '<f8'),
+)
+DTYPES = dict(COLUMNS)
+# Columns an upsert may change for an existing trade.
+VALUE_COLUMNS = ('high_price', 'low_price', 'mid_price', 'avg_price', 'trans_amount')
+
+SELECT_SQL = '''
+SELECT id, date, species_id, market_id, high_price, low_price, mid_price, avg_price, trans_amount
+FROM trades'''
+
+APPEND_SQL = SELECT_SQL + ' WHERE id > ? ORDER BY id'
+
+# Trades already exported whose date was fetched again since the last export.
+# Later trades are appended by id, so an unchanged ledger patches nothing.
+PATCH_SQL = SELECT_SQL + '''
+WHERE id <= ? AND date IN (
+    SELECT CAST(replace(date, '-', '') AS INTEGER) FROM {ledger} WHERE fetched_at > ?)
+ORDER BY id'''
+
+
+def empty_meta():
+    return {
+        'version': 1,
+        'rows': 0,
+        'watermark': 0,
+        'fetched_at': '',
+        'generation': None,
+        'columns': {name: dtype for name, dtype in COLUMNS},
+        'species_codes': [],
+        'species_names': [],
+        'market_names': [],
+    }
+
+
+def dictionary(conn, sql, keys, names=None):
+    """Map database ids to positions in `keys`, appending keys not seen before.
+
+    `sql` selects (id, key) or (id, key, name); names of new keys are
+    appended to `names`.  Returns a lookup array indexed by database id.
+    """
+    index = {key: i for i, key in enumerate(keys)}
+    rows = conn.execute(sql).fetchall()
+    lookup = np.full(max([row[0] for row in rows], default=0) + 1, -1, dtype='<i4')
+    for row in rows:
+        key = row[1]
+        if key not in index:
+            index[key] = len(keys)
+            keys.append(key)
+            if names is not None:
+                names.append(row[2])
+        lookup[row[0]] = index[key]
+    return lookup
+
+
+class ColumnStore:
+    """A directory of column files plus their meta.json."""
+
+    def __init__(self, root):
+        self.root = root
+        self.meta = self.read_meta()
+
+    def read_meta(self):
+        try:
+            with open(os.path.join(self.root, META_FILE), encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return empty_meta()
+
+    def write_meta(self):
+        os.makedirs(self.root, exist_ok=True)
+        path = os.path.join(self.root, META_FILE)
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(self.meta, f, ensure_ascii=False)
+        os.replace(path + '.tmp', path)
+
+    def column_path(self, name):
+        return os.path.join(self.root, name + '.bin')
+
+    @property
+    def rows(self):
+        return self.meta['rows']
+
+    def column(self, name, mode='r'):
+        """Map one column; the array stays valid while the files are not rebuilt."""
+        if not self.rows:
+            return np.zeros(0, dtype=DTYPES[name])
+        return np.memmap(self.column_path(name), dtype=DTYPES[name], mode=mode, shape=(self.rows,))
+
+    def load(self):
+        """Map every column, keyed by name."""
+        return {name: self.column(name) for name, _ in COLUMNS}
+
+    def clear(self):
+        for name, _ in COLUMNS:
+            if os.path.exists(self.column_path(name)):
+                os.remove(self.column_path(name))
+        self.meta = empty_meta()
+
+    def truncate(self):
+        """Cut off rows an interrupted export appended but never recorded."""
+        for name, dtype in COLUMNS:
+            path = self.column_path(name)
+            size = self.rows * np.dtype(dtype).itemsize
+            if os.path.exists(path) and os.path.getsize(path) > size:
+                os.truncate(path, size)
+
+    def encode(self, rows, species, markets):
+        """Turn database rows into one array per column."""
+        arrays = {name: np.array(values, dtype=DTYPES[name]) for (name, _), values in zip(COLUMNS, zip(*rows))}
+        arrays['species'] = species[arrays['species']]
+        arrays['market'] = markets[arrays['market']]
+        return arrays
+
+    def append(self, conn, species, markets, batch_size):
+        self.truncate()
+        cursor = conn.execute(APPEND_SQL, (self.meta['watermark'],))
+        files = {name: open(self.column_path(name), 'ab') for name, _ in COLUMNS}
+        appended = 0
+        try:
+            rows = cursor.fetchmany(batch_size)
+            while rows:
+                for name, values in self.encode(rows, species, markets).items():
+                    values.tofile(files[name])
+                appended += len(rows)
+                self.meta['rows'] += len(rows)
+                self.meta['watermark'] = rows[-1][0]
+                rows = cursor.fetchmany(batch_size)
+        finally:
+            for f in files.values():
+                f.close()
+        return appended
+
+    def patch(self, conn, species, markets):
+        """Rewrite the values of exported trades whose date was fetched again."""
+        rows = conn.execute(PATCH_SQL.format(ledger=LEDGER_TABLE),
+                            (self.meta['watermark'], self.meta['fetched_at'])).fetchall()
+        if not rows:
+            return 0
+        arrays = self.encode(rows, species, markets)
+        ids = self.column('id')
+        positions = np.searchsorted(ids, arrays['id'])
+        found = positions < len(ids)
+        found[found] = ids[positions[found]] == arrays['id'][found]
+        for name in VALUE_COLUMNS:
+            column = self.column(name, mode='r+')
+            column[positions[found]] = arrays[name][found]
+            column.flush()
+        return int(found.sum())
+
+    def export(self, database=DATABASE_PATH, batch_size=100000):
+        """Bring the column files up to date with a crawler database.
+
+        Returns the number of rows appended and patched.
+        """
+        os.makedirs(self.root, exist_ok=True)
+        conn = sqlite3.connect(database)
+        try:
+            # Read before the trades, so days marked during the export are patched next time.
+            sql = 'SELECT MAX(fetched_at) FROM {}'.format(LEDGER_TABLE)
+            fetched_at = conn.execute(sql).fetchone()[0] or ''
+            # Trade ids start over when the database is reset, so the exported
+            # ids only still name the same trades in the same generation.
+            # Trades are never deleted otherwise: fewer of them up to the
+            # watermark than were exported means it was rebuilt some other way.
+            generation = database_generation(conn)
+            sql = 'SELECT COUNT(*) FROM trades WHERE id <= ?'
+            if self.rows and (self.meta.get('generation') != generation or
+                              conn.execute(sql, (self.meta['watermark'],)).fetchone()[0] != self.rows):
+                LOGGER.warning('%r was reset since the last export, rebuilding %r', database, self.root)
+                self.clear()
+            species = dictionary(conn, 'SELECT id, code, name FROM species',
+                                 self.meta['species_codes'], self.meta['species_names'])
+            markets = dictionary(conn, 'SELECT id, name FROM markets', self.meta['market_names'])
+            patched = self.patch(conn, species, markets) if self.rows else 0
+            appended = self.append(conn, species, markets, batch_size)
+            self.meta['fetched_at'] = fetched_at
+            self.meta['generation'] = generation
+            self.write_meta()
+        finally:
+            conn.close()
+        return appended, patched
+
+
+def export(database, root, batch_size=100000):
+    """Export `database` into the column store at `root`, printing a summary."""
+    t0 = time.time()
+    store = ColumnStore(root)
+    appended, patched = store.export(database, batch_size=batch_size)
+    t1 = time.time()
+    columns = ColumnStore(root).load()
+    t2 = time.time()
+    print('exported {} new and {} patched rows in {:.3f} secs; {} rows in {}'.format(
+        appended, patched, t1 - t0, store.rows, root))
+    print('mapped {} columns of {} rows in {:.1f} ms'.format(len(columns), store.rows, (t2 - t1) * 1000))
+    return store
@@ -0,0 +1,290 @@
+"""Price cube -- a dense day x species x market array of daily prices.
+
+The cube is a float32 memory-mapped file of shape (days, species, markets,
+fields), NaN where a species did not trade in a market on a day.  Questions
+such as "every market's average price of one species on one day" or "one
+market's whole board over a year" become array slices instead of table
+scans.
+
+Days are the outermost axis, so new days extend the file in place.  The
+species and market axes have spare capacity; outgrowing it, or a day
+before the first one, rewrites the cube into a new file, and cube.json
+switches to it only once it is complete.  Updates reload every day the
+ledger shows as fetched since the previous update, so revised prices
+replace old ones.
+"""
+
+from datetime import date, timedelta
+import json
+import logging
+import os
+import sqlite3
+import warnings
+
+import numpy as np
+
+from crawler.storage import DATABASE_PATH, LEDGER_TABLE, date_key
+
+LOGGER = logging.getLogger(__name__)
+
+META_FILE = 'cube.json'
+
+FIELDS = ('avg_price', 'high_price', 'low_price', 'mid_price', 'trans_amount')
+
+SELECT_SQL = '''
+SELECT t.date, s.code, m.name, t.avg_price, t.high_price, t.low_price, t.mid_price, t.trans_amount
+FROM trades t JOIN species s ON s.id = t.species_id JOIN markets m ON m.id = t.market_id'''
+
+TOUCHED_SQL = '''
+SELECT DISTINCT CAST(replace(date, '-', '') AS INTEGER) FROM {ledger} WHERE fetched_at > ?'''
+
+REDUCERS = {
+    'mean': np.nanmean,
+    'min': np.nanmin,
+    'max': np.nanmax,
+    'sum': np.nansum,
+}
+AXES = {'day': 0, 'species': 1, 'market': 2}
+
+
+def key_to_date(key):
+    return date(key // 10000, key // 100 % 100, key % 100)
+
+
+def keys_to_datetime64(keys):
+    """Vectorized key_to_date: YYYYMMDD integers to datetime64[D]."""
+    keys = np.asarray(keys, dtype='i8')
+    months = (keys // 10000 - 1970) * 12 + keys // 100 % 100 - 1
+    return months.astype('datetime64[M]').astype('datetime64[D]') + (keys % 100 - 1)
+
+
+def capacity(needed, current):
+    """Room for `needed` entries, growing by powers of two."""
+    if needed <= current:
+        return current
+    return max(8, 1 << (needed - 1).bit_length())
+
+
+def empty_meta():
+    return {
+        'version': 1,
+        'file': None,
+        'generation': 0,
+        'start': None,
+        'days': 0,
+        'species_capacity': 0,
+        'market_capacity': 0,
+        'fields': list(FIELDS),
+        'species_codes': [],
+        'species_names': [],
+        'market_names': [],
+        'fetched_at': '',
+    }
+
+
+class PriceCube:
+    """Daily prices and volumes by (day, species, market), memory-mapped."""
+
+    def __init__(self, root):
+        self.root = root
+        self.meta = self.read_meta()
+        self._data = None
+        self._species = None
+        self._markets = None
+
+    def read_meta(self):
+        try:
+            with open(os.path.join(self.root, META_FILE), encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return empty_meta()
+
+    def write_meta(self):
+        path = os.path.join(self.root, META_FILE)
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(self.meta, f, ensure_ascii=False)
+        os.replace(path + '.tmp', path)
+        self._data = self._species = self._markets = None
+
+    @property
+    def shape(self):
+        meta = self.meta
+        return meta['days'], meta['species_capacity'], meta['market_capacity'], len(FIELDS)
+
+    @property
+    def start(self):
+        return key_to_date(self.meta['start']) if self.meta['start'] else None
+
+    @property
+    def species_codes(self):
+        return self.meta['species_codes']
+
+    @property
+    def market_names(self):
+        return self.meta['market_names']
+
+    def open(self, mode='r'):
+        if not self.meta['file']:
+            return np.full((0, 0, 0, len(FIELDS)), np.nan, dtype='<f4')
+        return np.memmap(os.path.join(self.root, self.meta['file']), dtype='<f4', mode=mode, shape=self.shape)
+
+    @property
+    def data(self):
+        """The cube, trimmed to the species and markets seen so far."""
+        if self._data is None:
+            self._data = self.open()[:, :len(self.species_codes), :len(self.market_names)]
+        return self._data
+
+    # Lookups.
+
+    def day_index(self, day):
+        index = (day - self.start).days if self.start else -1
+        if not 0 <= index < self.meta['days']:
+            raise KeyError(day)
+        return index
+
+    def day_slice(self, start=None, end=None):
+        return slice(self.day_index(start) if start else None, self.day_index(end) + 1 if end else None)
+
+    def species_index(self, code):
+        if self._species is None:
+            self._species = {code: i for i, code in enumerate(self.species_codes)}
+        return self._species[code]
+
+    def market_index(self, name):
+        if self._markets is None:
+            self._markets = {name: i for i, name in enumerate(self.market_names)}
+        return self._markets[name]
+
+    def days(self, start=None, end=None):
+        """The dates along the day axis between `start` and `end`."""
+        days = range(self.meta['days'])[self.day_slice(start, end)]
+        return [self.start + timedelta(days=i) for i in days]
+
+    # Queries.
+
+    def price(self, day, code, market, field='avg_price'):
+        return float(self.data[self.day_index(day), self.species_index(code), self.market_index(market),
+                               FIELDS.index(field)])
+
+    def cross_section(self, day, code, field='avg_price'):
+        """One species on one day, in every market (NaN where it did not trade)."""
+        return self.data[self.day_index(day), self.species_index(code), :, FIELDS.index(field)]
+
+    def board(self, market, start=None, end=None, field='avg_price'):
+        """One market's (day, species) board between `start` and `end`."""
+        return self.data[self.day_slice(start, end), :, self.market_index(market), FIELDS.index(field)]
+
+    def series(self, code, market, start=None, end=None, field='avg_price'):
+        """One species in one market, day by day."""
+        return self.data[self.day_slice(start, end), self.species_index(code), self.market_index(market),
+                         FIELDS.index(field)]
+
+    def aggregate(self, field='avg_price', over='day', how='mean', start=None, end=None):
+        """Reduce the cube over one axis ('day', 'species' or 'market'), ignoring NaN.
+
+        Cells with no data at all stay NaN (0 for 'sum').
+        """
+        values = self.data[self.day_slice(start, end), :, :, FIELDS.index(field)]
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)  # All-NaN slices.
+            return REDUCERS[how](values, axis=AXES[over])
+
+    # Updates.
+
+    def update(self, database=DATABASE_PATH, batch_size=100000):
+        """Load the days fetched since the last update; return how many days were loaded."""
+        os.makedirs(self.root, exist_ok=True)
+        conn = sqlite3.connect(database)
+        try:
+            fetched_at = conn.execute('SELECT MAX(fetched_at) FROM {}'.format(LEDGER_TABLE)).fetchone()[0] or ''
+            if self.meta['file']:
+                days = [row[0] for row in conn.execute(TOUCHED_SQL.format(ledger=LEDGER_TABLE),
+                                                       (self.meta['fetched_at'],))]
+                sql = SELECT_SQL + ' WHERE t.date IN ({})'.format(', '.join(str(int(day)) for day in days))
+            else:
+                days = [row[0] for row in conn.execute('SELECT DISTINCT date FROM trades')]
+                sql = SELECT_SQL
+            if days:
+                self.load(conn, sql, days, batch_size)
+            self.meta['fetched_at'] = fetched_at
+            self.write_meta()
+        finally:
+            conn.close()
+        return len(days)
+
+    def load(self, conn, sql, days, batch_size):
+        self.grow(conn, min(days), max(days))
+        data = self.open('r+')
+        start = np.datetime64(self.start, 'D')
+        data[(keys_to_datetime64(days) - start).astype('i8')] = np.nan
+        species = {code: i for i, code in enumerate(self.species_codes)}
+        markets = {name: i for i, name in enumerate(self.market_names)}
+
+        cursor = conn.execute(sql)
+        rows = cursor.fetchmany(batch_size)
+        while rows:
+            keys, codes, names = zip(*[row[:3] for row in rows])
+            day_index = (keys_to_datetime64(keys) - start).astype('i8')
+            species_index = np.array([species[code] for code in codes])
+            market_index = np.array([markets[name] for name in names])
+            data[day_index, species_index, market_index] = np.array([row[3:] for row in rows], dtype='<f4')
+            rows = cursor.fetchmany(batch_size)
+        data.flush()
+        del data
+
+    def grow(self, conn, first_key, last_key):
+        """Make room for every species and market, and for days up to `last_key`."""
+        meta = self.meta
+        codes = set(meta['species_codes'])
+        for code, name in conn.execute('SELECT code, name FROM species ORDER BY id'):
+            if code not in codes:
+                codes.add(code)
+                meta['species_codes'].append(code)
+                meta['species_names'].append(name)
+        names = set(meta['market_names'])
+        for name, in conn.execute('SELECT name FROM markets ORDER BY id'):
+            if name not in names:
+                names.add(name)
+                meta['market_names'].append(name)
+
+        old_shape, old_start, old_file = self.shape, self.start, meta['file']
+        first, last = key_to_date(first_key), key_to_date(last_key)
+        start = min(first, old_start) if old_start else first
+        end = max(last, old_start + timedelta(days=meta['days'] - 1)) if old_start else last
+        meta['days'] = (end - start).days + 1
+        meta['species_capacity'] = capacity(len(meta['species_codes']), meta['species_capacity'])
+        meta['market_capacity'] = capacity(len(meta['market_names']), meta['market_capacity'])
+
+        if old_file and start == old_start and self.shape[1:] == old_shape[1:]:
+            if meta['days'] > old_shape[0]:
+                self.extend(old_shape[0])
+            return
+
+        # A new layout: copy the old cube into a new file, then switch to it.
+        meta['start'] = date_key(start)
+        meta['generation'] += 1
+        meta['file'] = 'cube-{}.f32'.format(meta['generation'])
+        LOGGER.info('rewriting price cube as %r with shape %r', meta['file'], self.shape)
+        data = np.memmap(os.path.join(self.root, meta['file']), dtype='<f4', mode='w+', shape=self.shape)
+        data[:] = np.nan
+        if old_file:
+            old = np.memmap(os.path.join(self.root, old_file), dtype='<f4', mode='r', shape=old_shape)
+            offset = (old_start - start).days
+            data[offset:offset + old_shape[0], :old_shape[1], :old_shape[2]] = old
+            del old
+        data.flush()
+        del data
+        self.write_meta()
+        if old_file:
+            os.remove(os.path.join(self.root, old_file))
+
+    def extend(self, old_days):
+        """Append NaN days to the cube file in place."""
+        path = os.path.join(self.root, self.meta['file'])
+        with open(path, 'r+b') as f:
+            f.truncate(int(np.prod(self.shape)) * 4)
+        data = self.open('r+')
+        data[old_days:] = np.nan
+        data.flush()
+        del data
@@ -0,0 +1,209 @@
+from datetime import date
+import math
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import analysis.analytics as analytics
+from analysis.columnar import ColumnStore
+from analysis.cube import PriceCube, keys_to_datetime64
+from crawler.storage import LEDGER_DONE, SQLiteStorage
+from crawler.test import make_row
+
+
+class TestColumnStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.database = os.path.join(self.tmp, 'test.sqlite')
+        self.storage = SQLiteStorage(self.database)
+        self.addCleanup(self.storage.close)
+        self.root = os.path.join(self.tmp, 'columns')
+
+    def test_export(self):
+        self.storage.write([make_row(1), make_row(1, '高雄'), make_row(2, code=1012)],
+                           [('2018-01-01', LEDGER_DONE, 2), ('2018-01-02', LEDGER_DONE, 1)])
+        self.assertEqual((3, 0), ColumnStore(self.root).export(self.database))
+
+        store = ColumnStore(self.root)
+        columns = store.load()
+        self.assertEqual(3, store.rows)
+        self.assertEqual([20180101, 20180101, 20180102], columns['date'].tolist())
+        self.assertEqual(['台北', '高雄', '台北'], [store.meta['market_names'][i] for i in columns['market']])
+        self.assertEqual([1011, 1011, 1012], [store.meta['species_codes'][i] for i in columns['species']])
+        self.assertEqual([1200.0] * 3, columns['trans_amount'].tolist())
+
+    def test_incremental(self):
+        self.storage.write([make_row(1), make_row(2)], [('2018-01-01', LEDGER_DONE, 1)])
+        store = ColumnStore(self.root)
+        store.export(self.database)
+        # Day 1 is fetched again with a revised price, day 3 is new.
+        self.storage.conn.execute("UPDATE crawl_ledger SET fetched_at = '2000-01-01 00:00:00'")
+        self.storage.conn.commit()
+        store.meta['fetched_at'] = '2001-01-01 00:00:00'
+        self.storage.write([make_row(1, avg_price=55.0), make_row(3, '高雄')], [('2018-01-01', LEDGER_DONE, 1)])
+        self.assertEqual((1, 1), store.export(self.database))
+
+        columns = ColumnStore(self.root).load()
+        self.assertEqual([55.0, 50.0, 50.0], columns['avg_price'].tolist())
+        self.assertEqual([20180101, 20180102, 20180103], columns['date'].tolist())
+        self.assertEqual((0, 0), store.export(self.database))
+
+    def test_interrupted_append(self):
+        self.storage.write([make_row(1)])
+        store = ColumnStore(self.root)
+        store.export(self.database)
+        with open(store.column_path('date'), 'ab') as f:
+            f.write(b'\0' * 12)
+        self.storage.write([make_row(2)])
+        store.export(self.database)
+        self.assertEqual([20180101, 20180102], ColumnStore(self.root).load()['date'].tolist())
+
+    def test_rebuild_after_reset(self):
+        self.storage.write([make_row(1), make_row(2)])
+        store = ColumnStore(self.root)
+        store.export(self.database)
+        self.storage.reset()
+        self.storage.write([make_row(5)])
+        self.assertEqual((1, 0), store.export(self.database))
+        self.assertEqual([20180105], ColumnStore(self.root).load()['date'].tolist())
+
+    def test_rebuild_after_reset_and_growth(self):
+        self.storage.write([make_row(1), make_row(2)], [('2018-01-01', LEDGER_DONE, 1), ('2018-01-02', LEDGER_DONE, 1)])
+        store = ColumnStore(self.root)
+        store.export(self.database)
+        # The recrawl reuses ids 1 and 2 for other trades and stores one more.
+        self.storage.reset()
+        self.storage.write([make_row(2, avg_price=31.0), make_row(1, avg_price=45.0), make_row(3)],
+                           [('2018-01-0{}'.format(day), LEDGER_DONE, 1) for day in (1, 2, 3)])
+        with self.assertLogs('analysis.columnar', 'WARNING'):
+            self.assertEqual((3, 0), store.export(self.database))
+        columns = ColumnStore(self.root).load()
+        self.assertEqual([20180102, 20180101, 20180103], columns['date'].tolist())
+        self.assertEqual([31.0, 45.0, 50.0], columns['avg_price'].tolist())
+
+
+class TestPriceCube(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.database = os.path.join(self.tmp, 'test.sqlite')
+        self.storage = SQLiteStorage(self.database)
+        self.addCleanup(self.storage.close)
+        self.root = os.path.join(self.tmp, 'cube')
+
+    def test_keys_to_datetime64(self):
+        self.assertEqual(['2018-01-02', '2016-02-29', '2009-12-31'],
+                         [str(day) for day in keys_to_datetime64([20180102, 20160229, 20091231])])
+
+    def test_queries(self):
+        self.storage.write([make_row(1), make_row(1, '高雄', 55.0), make_row(3, code=1012, avg_price=70.0)],
+                           [('2018-01-01', LEDGER_DONE, 2), ('2018-01-03', LEDGER_DONE, 1)])
+        self.assertEqual(2, PriceCube(self.root).update(self.database))
+        self.assertEqual(0, PriceCube(self.root).update(self.database))
+
+        cube = PriceCube(self.root)
+        self.assertEqual((3, 2, 2, 5), cube.data.shape)
+        self.assertEqual(55.0, cube.price(date(2018, 1, 1), 1011, '高雄'))
+        self.assertEqual([50.0, 55.0], cube.cross_section(date(2018, 1, 1), 1011).tolist())
+        board = cube.board('台北', field='trans_amount')
+        self.assertEqual([1200.0, 1200.0], board[[0, 2], [0, 1]].tolist())
+        self.assertTrue(math.isnan(board[1, 0]))
+        self.assertEqual(3, len(cube.series(1012, '台北', date(2018, 1, 1), date(2018, 1, 3))))
+        self.assertEqual([date(2018, 1, 2), date(2018, 1, 3)], cube.days(date(2018, 1, 2)))
+        self.assertEqual(52.5, cube.aggregate(over='market')[0, 0])
+        self.assertEqual([50.0, 70.0], cube.aggregate(over='day')[:, 0].tolist())
+        self.assertRaises(KeyError, cube.price, date(2018, 1, 9), 1011, '台北')
+
+    def test_incremental(self):
+        self.storage.write([make_row(5)], [('2018-01-05', LEDGER_DONE, 1)])
+        cube = PriceCube(self.root)
+        cube.update(self.database)
+        self.storage.conn.execute("UPDATE crawl_ledger SET fetched_at = '2000-01-01 00:00:00'")
+        self.storage.conn.commit()
+        cube.meta['fetched_at'] = '2001-01-01 00:00:00'
+        # Revised price on day 5, an earlier day, a later day and nine more species.
+        rows = [make_row(5, avg_price=60.0), make_row(2), make_row(8)] + [make_row(8, code=2000 + i) for i in range(9)]
+        marks = [('2018-01-0{}'.format(day), LEDGER_DONE, 1) for day in (2, 5, 8)]
+        self.storage.write(rows, marks)
+        self.assertEqual(3, cube.update(self.database))
+
+        cube = PriceCube(self.root)
+        self.assertEqual((7, 10, 1, 5), cube.data.shape)
+        self.assertEqual(16, cube.meta['species_capacity'])
+        self.assertEqual(60.0, cube.price(date(2018, 1, 5), 1011, '台北'))
+        self.assertEqual(50.0, cube.price(date(2018, 1, 8), 2008, '台北'))
+        self.assertEqual(['cube-2.f32', 'cube.json'], sorted(os.listdir(self.root)))
+
+
+def make_columns(*rows):
+    """Columns as ColumnStore.load() returns them, from (date, species, market, avg, high, low, amount)."""
+    names = ('date', 'species', 'market', 'avg_price', 'high_price', 'low_price', 'trans_amount')
+    return {name: np.array(values, dtype='<i4' if i < 3 else '<f8')
+            for i, (name, values) in enumerate(zip(names, zip(*rows)))}
+
+
+class TestAnalytics(unittest.TestCase):
+
+    def test_vwap(self):
+        columns = make_columns((20180101, 1, 0, 50.0, 60.0, 40.0, 100.0), (20180102, 0, 0, 10.0, 12.0, 8.0, 1.0),
+                               (20180102, 1, 0, 80.0, 90.0, 70.0, 300.0), (20180101, 1, 1, 20.0, 20.0, 20.0, 0.0))
+        table = analytics.vwap(columns)
+        self.assertEqual([0, 1, 1], table['species'].tolist())
+        self.assertEqual([0, 0, 1], table['market'].tolist())
+        self.assertEqual([10.0, 72.5], table['vwap'][:2].tolist())
+        self.assertTrue(math.isnan(table['vwap'][2]))
+        self.assertEqual([1, 2, 1], table['trades'].tolist())
+        naive = analytics.naive_vwap(columns)
+        self.assertEqual(72.5, naive[(1, 0)])
+        self.assertEqual([20180101, 20180102], analytics.vwap(columns, ['day'])['day'].tolist())
+
+        spread = analytics.spread(columns, ['species'])
+        self.assertEqual([4.0, 40.0 / 3], spread['spread'].tolist())
+        self.assertAlmostEqual((0.4 + 0.25 + 0.0) / 3, spread['relative_spread'][1])
+        empty = {name: values[:0] for name, values in columns.items()}
+        self.assertEqual(0, len(analytics.vwap(empty)['vwap']))
+        self.assertEqual(0, len(analytics.rolling(empty)['volatility']))
+        self.assertEqual(0, len(analytics.seasonality(empty)['index']))
+
+    def test_rolling(self):
+        prices = [10.0, 11.0, 12.1, 10.0, 5.0]
+        rows = [(20180101 + i, 0, 0, price, price, price, 1.0) for i, price in enumerate(prices)]
+        rows += [(20180101 + i, 1, 0, 100.0, 100.0, 100.0, 1.0) for i in range(2)]
+        table = analytics.rolling(make_columns(*reversed(rows)), window=3)
+        self.assertEqual(prices + [100.0, 100.0], table['avg_price'].tolist())
+        for i in range(len(prices)):
+            window = prices[max(0, i - 2):i + 1]
+            self.assertAlmostEqual(np.mean(window), table['mean'][i])
+            self.assertAlmostEqual(np.std(window), table['std'][i])
+        self.assertTrue(math.isnan(table['volatility'][1]))
+        self.assertAlmostEqual(0.0, table['volatility'][2])
+        self.assertAlmostEqual(np.std(np.log([12.1 / 11.0, 10.0 / 12.1])), table['volatility'][3])
+        self.assertEqual([100.0, 100.0], table['mean'][5:].tolist())
+        self.assertTrue(math.isnan(table['volatility'][6]))
+
+    def test_seasonality(self):
+        rows = [(20170115, 0, 0, 10.0, 0, 0, 1.0), (20170715, 0, 0, 30.0, 0, 0, 1.0),
+                (20180115, 0, 0, 12.0, 0, 0, 1.0), (20180715, 0, 0, 36.0, 0, 0, 1.0),
+                (20180215, 0, 0, 24.0, 0, 0, 1.0), (20180115, 1, 0, 5.0, 0, 0, 1.0)]
+        table = analytics.yoy(make_columns(*rows))
+        self.assertEqual([201701, 201707, 201801, 201802, 201807, 201801], table['month'].tolist())
+        self.assertTrue(np.isnan(table['yoy'][[0, 1, 3, 5]]).all())
+        self.assertAlmostEqual(0.2, table['yoy'][2])
+        self.assertAlmostEqual(0.2, table['yoy'][4])
+
+        table = analytics.seasonality(make_columns(*rows))
+        self.assertEqual([1, 2, 7, 1], table['month'].tolist())
+        self.assertEqual([2, 1, 2, 1], table['years'].tolist())
+        self.assertAlmostEqual((0.5 + 0.5) / 2, table['index'][0])
+        self.assertAlmostEqual(1.0, table['index'][1])
+        self.assertAlmostEqual(1.5, table['index'][2])
+
+
+if __name__ == '__main__':
+    unittest.main()
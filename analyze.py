@@ -0,0 +1,52 @@
+#!/usr/bin/env python3.6
+
+"""Summarize exported trades: VWAP, spread and year-over-year change."""
+
+import argparse
+import logging
+
+import numpy as np
+
+import analysis.analytics as analytics
+from analysis.columnar import ColumnStore
+
+ARGS = argparse.ArgumentParser(description='Summarize a columnar store written by export.py')
+ARGS.add_argument('--by', action='store', nargs='+', choices=('species', 'market') + tuple(analytics.PERIODS),
+                  default=['species', 'market'], help='Group trades by these keys')
+ARGS.add_argument('--top', action='store', type=int, metavar='N', default=20,
+                  help='Show the N groups with the largest volume')
+ARGS.add_argument('--benchmark', action='store_true', dest='benchmark',
+                  default=False, help='Time the vectorized VWAP against a plain Python loop')
+ARGS.add_argument('store', action='store', metavar='DIR',
+                  help='Directory holding the column files')
+ARGS.add_argument('-q', '--quiet', action='store_const', const=logging.ERROR, dest='level', default=logging.INFO,
+                  help='Only log errors')
+
+
+def label(store, name, value):
+    if name == 'species':
+        return '{} {}'.format(store.meta['species_codes'][value], store.meta['species_names'][value])
+    if name == 'market':
+        return store.meta['market_names'][value]
+    return str(value)
+
+
+def main():
+    args = ARGS.parse_args()
+    logging.basicConfig(level=args.level)
+    store = ColumnStore(args.store)
+    columns = store.load()
+    if args.benchmark:
+        analytics.benchmark(columns, tuple(args.by))
+        return
+
+    vwap = analytics.vwap(columns, args.by)
+    spread = analytics.spread(columns, args.by)
+    for i in np.argsort(-vwap['volume'])[:args.top]:
+        print('{}: vwap {:.2f} over {:.0f} in {} trades, spread {:.2f} ({:.1%})'.format(
+            ', '.join(label(store, name, vwap[name][i]) for name in args.by), vwap['vwap'][i],
+            vwap['volume'][i], vwap['trades'][i], spread['spread'][i], spread['relative_spread'][i]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3.6
+
+"""Measure crawler throughput against a local stand-in for the COA API.
+
+A fakeserver.FakeServer runs in this process; every combination of
+--processes, --max_tasks, --batch_size and --storage is crawled --repeat
+times, each run in a fresh process so its peak RSS is its own.  With more
+than one process the run is a sharded crawl (crawl.py --processes), timed
+side by side with the single-process one.  Every run prints one JSON
+object per line: the settings, requests/sec, rows/sec, latency
+percentiles and peak RSS, for comparing commits against each other.
+"""
+
+import argparse
+import asyncio
+from datetime import datetime
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import crawler.crawling as crawling
+import crawler.fakemarket as fakemarket
+import crawler.fakeserver as fakeserver
+import crawler.reporting as reporting
+import crawler.retrying as retrying
+import crawler.storage as storage
+
+ARGS = argparse.ArgumentParser(description='Crawler throughput benchmark against a fake COA API')
+ARGS.add_argument('--processes', action='store', type=int, nargs='+', metavar='N', default=[1],
+                  help='Worker processes to try; more than one crawls date shards in parallel')
+ARGS.add_argument('--max_tasks', action='store', type=int, nargs='+', metavar='N', default=[4, 10, 25],
+                  help='Concurrent connections to try')
+ARGS.add_argument('--batch_size', action='store', type=int, nargs='+', metavar='N', default=[5000],
+                  help='Rows per database transaction to try')
+ARGS.add_argument('--storage', action='store', nargs='+', choices=sorted(storage.STORAGES), default=['sqlite'],
+                  help='Storage backends to try')
+ARGS.add_argument('--repeat', action='store', type=int, metavar='N', default=3,
+                  help='Runs per combination')
+ARGS.add_argument('--stream', action='store_true', default=False,
+                  help='Decode responses while they arrive')
+ARGS.add_argument('--window_days', action='store', type=int, metavar='N', default=7,
+                  help='Initial number of days requested at once')
+ARGS.add_argument('--rows_per_day', action='store', type=int, metavar='N', default=300,
+                  help='Trades the fake API reports per day')
+ARGS.add_argument('--latency', action='store', type=float, metavar='SECS', default=0.05,
+                  help='Median response latency of the fake API')
+ARGS.add_argument('--latency_sigma', action='store', type=float, metavar='SIGMA', default=0.5,
+                  help='Spread of the log-normal latency (0 for a constant latency)')
+ARGS.add_argument('--error_rate', action='store', type=float, metavar='RATIO', default=0.0,
+                  help='Share of requests answered with 503')
+ARGS.add_argument('--compress', action='store_true', default=False,
+                  help='Have the fake API gzip its responses')
+ARGS.add_argument('--retry_base', action='store', type=float, metavar='SECS', default=0.05,
+                  help='Backoff before the first retry')
+ARGS.add_argument('--seed', action='store', type=int, default=0,
+                  help='Seed for the fake trades, latencies and errors')
+ARGS.add_argument('--timeout', action='store', type=float, metavar='SECS', default=600.0,
+                  help='Give up on a run after SECS and record it as an error')
+ARGS.add_argument('--output', action='store', metavar='PATH',
+                  help='Append the results to PATH instead of printing them')
+ARGS.add_argument('start_date', action='store', nargs='?', default='2015-01-01',
+                  help='First day to crawl, YYYY-MM-DD')
+ARGS.add_argument('end_date', action='store', nargs='?', default='2015-12-31',
+                  help='Last day to crawl, YYYY-MM-DD')
+ARGS.add_argument('-q', '--quiet', action='store_const', const=logging.ERROR, dest='level', default=logging.INFO,
+                  help='Only log errors')
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def peak_rss_kb(who):
+    """Peak RSS of this process or its largest child; ru_maxrss is in bytes on macOS, KiB elsewhere."""
+    rss = resource.getrusage(who).ru_maxrss
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+def crawl_single(start, end, store, options):
+    """Crawl in this process, like crawling.crawl_shard does in a worker; return the crawler's stats."""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    crawler = crawling.Crawler(start, end, storage=store, loop=loop, **options)
+    # Keep every latency, so the percentiles cover the whole run.
+    crawler.latencies = reporting.LatencyTracker(size=None)
+    try:
+        loop.run_until_complete(crawler.crawl())
+    finally:
+        crawler.close()
+        loop.close()
+    return crawler.stats()
+
+
+def worst(shards, name):
+    """The largest latency percentile `name` of any shard, or None without samples."""
+    values = [stats['latency'][name] for stats in shards if stats['latency'][name] is not None]
+    return max(values) if values else None
+
+
+def run_one(config):
+    """Crawl the fake API once as `config` says and measure it; runs in a fresh process.
+
+    A sharded run reports the worst shard's latency percentiles, each over
+    that shard's recent requests, and the peak RSS of the largest process.
+    """
+    logging.basicConfig(level=logging.WARN)
+    tmp = tempfile.mkdtemp()
+    path = None if config['storage'] == 'memory' else os.path.join(tmp, 'benchmark.' + config['storage'])
+    store = storage.open_storage(config['storage'], path)
+    options = dict(max_tasks=config['max_tasks'], initial_tasks=config['max_tasks'],
+                   window_days=config['window_days'], batch_size=config['batch_size'], stream=config['stream'],
+                   retry_policy=retrying.RetryPolicy(base=config['retry_base']), progress_interval=0,
+                   base_url=config['url'])
+    failed_shards = 0
+    try:
+        if config['processes'] > 1:
+            result = crawling.crawl_sharded(config['start'], config['end'], store, config['processes'],
+                                            staging_dir=tmp, **options)
+            shards = [stats for stats in result['shards'] if stats]
+            failed_shards = len(result['shards']) - len(shards)
+            elapsed = result['merge']['elapsed']
+        else:
+            shards = [crawl_single(config['start'], config['end'], store, options)]
+            elapsed = shards[0]['elapsed']
+    finally:
+        store.close()
+        shutil.rmtree(tmp)
+    requests = sum(stats['requests']['sent'] for stats in shards)
+    rows = sum(stats['rows']['parsed'] for stats in shards)
+    return {
+        'elapsed': elapsed,
+        'requests': requests,
+        'requests_per_sec': requests / elapsed if elapsed else None,
+        'rows': rows,
+        'rows_per_sec': rows / elapsed if elapsed else None,
+        'latency_p50': worst(shards, 'p50'),
+        'latency_p99': worst(shards, 'p99'),
+        'retries': sum(stats['requests']['retries'] for stats in shards),
+        'failed_days': sum(stats['days']['failed'] for stats in shards),
+        'failed_shards': failed_shards,
+        'peak_rss_kb': max(peak_rss_kb(resource.RUSAGE_SELF), peak_rss_kb(resource.RUSAGE_CHILDREN)),
+        'stages': [stats['stages'] for stats in shards],
+    }
+
+
+def run_child(config, conn):
+    # Silence the crawlers' reports, in shard processes too, which inherit the descriptor.
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stdout.fileno())
+    os.close(devnull)
+    conn.send(run_one(config))
+    conn.close()
+
+
+def run_isolated(config, timeout):
+    """run_one in a new spawned process, which shares no memory with this one.
+
+    Returns a dict with just an 'error' if the process dies or runs longer
+    than `timeout` seconds.
+    """
+    context = multiprocessing.get_context('spawn')
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=run_child, args=(config, sender))
+    process.start()
+    sender.close()
+    try:
+        if not receiver.poll(timeout):
+            process.terminate()
+            return {'error': 'timed out after {} secs'.format(timeout)}
+        try:
+            return receiver.recv()
+        except EOFError:
+            process.join()
+            return {'error': 'exit code {}'.format(process.exitcode)}
+    finally:
+        receiver.close()
+        process.join()
+
+
+def main():
+    args = ARGS.parse_args()
+    logging.basicConfig(level=args.level)
+    # The fake API runs in this process; one log line per request would drown the results.
+    logging.getLogger('aiohttp.access').setLevel(logging.WARNING)
+    start = datetime.strptime(args.start_date, '%Y-%m-%d').date()
+    end = datetime.strptime(args.end_date, '%Y-%m-%d').date()
+
+    market = fakemarket.FakeMarket(rows_per_day=args.rows_per_day, seed=args.seed)
+    server = fakeserver.FakeServer(market, latency=args.latency, latency_sigma=args.latency_sigma,
+                                   error_rate=args.error_rate, seed=args.seed, compress=args.compress)
+    # Encode every day now, so the fake API's own work does not count in the runs.
+    market.body(start, end)
+    common = {'commit': git_commit(), 'python': platform.python_version(), 'days': (end - start).days + 1,
+              'rows_per_day': args.rows_per_day, 'latency': args.latency, 'latency_sigma': args.latency_sigma,
+              'error_rate': args.error_rate, 'compress': args.compress, 'stream': args.stream,
+              'window_days': args.window_days, 'seed': args.seed}
+    out = open(args.output, 'a', encoding='utf-8') if args.output else sys.stdout
+    try:
+        with fakeserver.ServerThread(server) as url:
+            sweep = itertools.product(args.processes, args.max_tasks, args.batch_size, args.storage)
+            for processes, max_tasks, batch_size, kind in sweep:
+                for run in range(args.repeat):
+                    config = dict(start=start, end=end, processes=processes, max_tasks=max_tasks,
+                                  batch_size=batch_size, storage=kind, stream=args.stream,
+                                  window_days=args.window_days, retry_base=args.retry_base, url=url)
+                    result = dict(common, processes=processes, max_tasks=max_tasks, batch_size=batch_size,
+                                  storage=kind, run=run, time=time.time())
+                    result.update(run_isolated(config, args.timeout))
+                    print(json.dumps(result, sort_keys=True), file=out, flush=True)
+                    if 'error' in result:
+                        logging.error('processes %r, max_tasks %r, batch_size %r, %s: %s', processes, max_tasks,
+                                      batch_size, kind, result['error'])
+                    else:
+                        logging.info('processes %r, max_tasks %r, batch_size %r, %s: %.0f requests/sec, '
+                                     '%.0f rows/sec', processes, max_tasks, batch_size, kind,
+                                     result['requests_per_sec'] or 0, result['rows_per_sec'] or 0)
+        logging.info('fake API: %r', server.stats())
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == '__main__':
+    main()
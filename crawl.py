@@ -5,15 +5,103 @@
 import argparse
 from datetime import datetime
 import asyncio
+import json
 import logging
 import sys
+import time
 
+import crawler.caching as caching
 import crawler.crawling as crawling
+import crawler.ingesting as ingesting
+import crawler.planning as planning
+import crawler.profiling as profiling
+import crawler.retrying as retrying
+import crawler.storage as storage
 
 ARGS = argparse.ArgumentParser(description='Taiwan aquatic market crawler')
-ARGS.add_argument('--max_tasks', action='store', type=int, metavar='N', default=10, help='Limit concurrent connections')
+ARGS.add_argument('--max_tasks', action='store', type=int, metavar='N', default=10,
+                  help='Upper bound for concurrent connections')
+ARGS.add_argument('--initial_tasks', action='store', type=int, metavar='N', default=4,
+                  help='Concurrent connections to start with before adapting')
+ARGS.add_argument('--min_tasks', action='store', type=int, metavar='N', default=1,
+                  help='Lower bound for concurrent connections')
 ARGS.add_argument('--max_tries', action='store', type=int, metavar='N', default=4,
                   help='Limit retries on network errors')
+ARGS.add_argument('--connect_timeout', action='store', type=float, metavar='SECS', default=10.0,
+                  help='Give up connecting after SECS')
+ARGS.add_argument('--read_timeout', action='store', type=float, metavar='SECS', default=60.0,
+                  help='Give up on a response that stalls for SECS')
+ARGS.add_argument('--keepalive', action='store', type=float, metavar='SECS', default=30.0,
+                  help='Keep idle connections open for reuse this long')
+ARGS.add_argument('--dns_ttl', action='store', type=int, metavar='SECS', default=300,
+                  help='Cache DNS lookups this long')
+ARGS.add_argument('--hedge', action='store', type=float, metavar='PCT',
+                  help='Duplicate requests slower than this latency percentile (e.g. 95)')
+ARGS.add_argument('--retry_base', action='store', type=float, metavar='SECS', default=0.5,
+                  help='Backoff before the first retry (doubles each retry, with jitter)')
+ARGS.add_argument('--retry_budget', action='store', type=float, metavar='RATIO', default=0.2,
+                  help='Retries allowed per request made, across all workers')
+ARGS.add_argument('--breaker_threshold', action='store', type=int, metavar='N', default=5,
+                  help='Pause all requests after N failures in a row')
+ARGS.add_argument('--breaker_cooldown', action='store', type=float, metavar='SECS', default=30.0,
+                  help='How long to pause before probing the server again')
+ARGS.add_argument('--window_days', action='store', type=int, metavar='N', default=7,
+                  help='Initial number of days requested at once')
+ARGS.add_argument('--max_window_days', action='store', type=int, metavar='N', default=31,
+                  help='Upper bound for the adaptive request window')
+ARGS.add_argument('--order', action='store', choices=planning.ORDERS, default='oldest',
+                  help='Fetch the oldest or newest dates first, or dates missing from the ledger')
+ARGS.add_argument('--queue_size', action='store', type=int, metavar='N',
+                  help='Windows planned ahead of the workers (default: twice --max_tasks)')
+ARGS.add_argument('--stream', action='store_true', default=False,
+                  help='Decode responses while they arrive, keeping memory flat for large windows')
+ARGS.add_argument('--batch_size', action='store', type=int, metavar='N', default=5000,
+                  help='Rows written per database transaction')
+ARGS.add_argument('--batch_delay', action='store', type=float, metavar='SECS', default=5.0,
+                  help='Flush a partial batch once it is this old')
+ARGS.add_argument('--write_queue_size', action='store', type=int, metavar='N', default=16,
+                  help='Parsed responses buffered ahead of the database writer')
+ARGS.add_argument('--incremental', action='store_true', default=False,
+                  help='Keep earlier results and only fetch dates not yet in the ledger')
+ARGS.add_argument('--reset', action='store_true', default=False,
+                  help='Discard everything stored before crawling')
+ARGS.add_argument('--storage', action='store', choices=sorted(storage.STORAGES), default='sqlite',
+                  help='Where to store the crawled rows')
+ARGS.add_argument('--output', action='store', metavar='PATH',
+                  help='Database or file to write (default depends on --storage)')
+ARGS.add_argument('--cache', action='store', metavar='DIR',
+                  help='Keep compressed raw responses in DIR and reuse them for past days')
+ARGS.add_argument('--cache_fresh_days', action='store', type=int, metavar='N', default=7,
+                  help='Always refetch windows ending within the last N days')
+ARGS.add_argument('--compression', action='store', choices=sorted(caching.COMPRESSIONS), default='gzip',
+                  help='Compression for new cache entries')
+ARGS.add_argument('--replay', action='store_true', default=False,
+                  help='Re-ingest cached responses instead of crawling (requires --cache)')
+ARGS.add_argument('--processes', action='store', type=int, metavar='N', default=1,
+                  help='Crawl in N processes, each fetching a shard of the dates (or decode in N during --replay)')
+ARGS.add_argument('--cube', action='store', metavar='DIR',
+                  help='Update the price cube in DIR with the fetched days afterwards (SQLite storage only)')
+ARGS.add_argument('--progress', action='store', type=float, metavar='SECS', default=10.0,
+                  help='Print rows/sec and the ETA every SECS (0 to disable)')
+ARGS.add_argument('--report', action='store', metavar='PATH',
+                  help='Write the run statistics and stage timings to PATH as JSON')
+ARGS.add_argument('--metrics_port', action='store', type=int, metavar='PORT',
+                  help='Serve Prometheus metrics on http://HOST:PORT/metrics (shards use PORT+1, ...)')
+ARGS.add_argument('--metrics_host', action='store', metavar='HOST', default='127.0.0.1',
+                  help='Address to serve metrics on')
+ARGS.add_argument('--metrics_file', action='store', metavar='PATH',
+                  help='Write Prometheus metrics to PATH (e.g. a textfile collector .prom file)')
+ARGS.add_argument('--metrics_interval', action='store', type=float, metavar='SECS', default=15.0,
+                  help='How often to rewrite --metrics_file')
+ARGS.add_argument('--profile', action='store', nargs='?', const='crawl.pstats', metavar='PATH',
+                  help='Run under cProfile with asyncio debug mode; report the hottest functions and '
+                       'dump the profile to PATH (default: %(const)s)')
+ARGS.add_argument('--profile_sort', action='store', choices=profiling.SORT_KEYS, default='cumulative',
+                  help='Order of the hot function report')
+ARGS.add_argument('--profile_limit', action='store', type=int, metavar='N', default=30,
+                  help='Functions listed in the hot function report')
+ARGS.add_argument('--slow_callback', action='store', type=float, metavar='SECS', default=0.1,
+                  help='With --profile, warn about loop callbacks blocking longer than SECS')
 ARGS.add_argument('start_date', action='store')
 ARGS.add_argument('end_date', action='store')
 
@@ -30,6 +118,21 @@ def str_to_datetime(date_str):
     return datetime.strptime(date_str, '%Y-%m-%d')
 
 
+def update_cube(args, store):
+    if args.cube:
+        # Only the cube needs numpy; plain crawls run without it.
+        import analysis.cube as cube
+        t0 = time.time()
+        days = cube.PriceCube(args.cube).update(store.path)
+        print('price cube: {} days updated in {:.3f} secs'.format(days, time.time() - t0))
+
+
+def write_report(args, stats):
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            json.dump(stats, f, indent=2, sort_keys=True)
+
+
 def main():
     """Main program.
 
@@ -37,22 +140,91 @@ def main():
     """
 
     args = ARGS.parse_args()
+    if args.replay and not args.cache:
+        ARGS.error('--replay requires --cache')
+    if args.cube and args.storage != 'sqlite':
+        ARGS.error('--cube requires --storage sqlite')
 
     levels = [logging.ERROR, logging.WARN, logging.INFO, logging.DEBUG]
     logging.basicConfig(level=levels[min(args.level, len(levels) - 1)])
 
-    loop = asyncio.get_event_loop()
+    if not args.profile:
+        run(args)
+        return
+    profiler = profiling.Profiler(args.profile, sort=args.profile_sort, limit=args.profile_limit,
+                                  slow_callback=args.slow_callback)
+    profiler.watch_loop(asyncio.get_event_loop())
+    with profiler:
+        run(args)
+
+
+def run(args):
+    """Replay the cache or crawl, as `args` say."""
+    start = str_to_datetime(args.start_date).date()
+    end = str_to_datetime(args.end_date).date()
+    store = storage.open_storage(args.storage, args.output)
+    cache = caching.ResponseCache(args.cache, args.compression) if args.cache else None
+
+    if args.replay:
+        try:
+            if args.reset:
+                store.reset()
+            ingesting.replay(cache, store, start, end, processes=args.processes, batch_size=args.batch_size)
+            update_cube(args, store)
+        finally:
+            store.close()
+        return
+
+    options = dict(max_tasks=args.max_tasks,
+                   max_tries=args.max_tries,
+                   initial_tasks=args.initial_tasks,
+                   min_tasks=args.min_tasks,
+                   window_days=args.window_days,
+                   max_window_days=args.max_window_days,
+                   order=args.order,
+                   queue_size=args.queue_size,
+                   batch_size=args.batch_size,
+                   batch_delay=args.batch_delay,
+                   write_queue_size=args.write_queue_size,
+                   incremental=args.incremental,
+                   reset=args.reset,
+                   cache=cache,
+                   cache_fresh_days=args.cache_fresh_days,
+                   retry_policy=retrying.RetryPolicy(base=args.retry_base),
+                   retry_budget=retrying.RetryBudget(ratio=args.retry_budget),
+                   breaker=retrying.CircuitBreaker(args.breaker_threshold, args.breaker_cooldown),
+                   connect_timeout=args.connect_timeout,
+                   read_timeout=args.read_timeout,
+                   keepalive_timeout=args.keepalive,
+                   dns_ttl=args.dns_ttl,
+                   hedge_percentile=args.hedge,
+                   stream=args.stream,
+                   progress_interval=args.progress,
+                   metrics_port=args.metrics_port,
+                   metrics_host=args.metrics_host,
+                   metrics_file=args.metrics_file,
+                   metrics_interval=args.metrics_interval)
+
+    if args.processes > 1:
+        try:
+            write_report(args, crawling.crawl_sharded(start, end, store, args.processes, **options))
+            update_cube(args, store)
+        except KeyboardInterrupt:
+            sys.stderr.flush()
+            print('\nInterrupted, rerun with --incremental to resume\n')
+        finally:
+            store.close()
+        return
 
-    start = str_to_datetime(args.start_date)
-    end = str_to_datetime(args.end_date)
-    crawler = crawling.Crawler(start, end,
-                               max_tasks=args.max_tasks,
-                               loop=loop)
+    loop = asyncio.get_event_loop()
+    crawler = crawling.Crawler(start, end, storage=store, loop=loop, **options)
     try:
         loop.run_until_complete(crawler.crawl())
+        write_report(args, crawler.stats())
+        update_cube(args, store)
     except KeyboardInterrupt:
         sys.stderr.flush()
-        print('\nInterrupted\n')
+        print('\nInterrupted, rerun with --incremental to resume\n')
     finally:
         crawler.close()
 
@@ -0,0 +1,149 @@
+"""Response cache -- compressed API responses keyed by request URL.
+
+Each response is stored as two files named after the SHA-256 of its URL:
+the compressed body and a small JSON metadata file describing the request
+window, status, content type, sizes and fetch time.  Files are written to
+a temporary name and renamed, so a crash never leaves a half-written entry.
+"""
+
+from datetime import datetime
+import glob
+import gzip
+import hashlib
+import json
+import logging
+import lzma
+import os
+
+from crawler.planning import Window
+
+LOGGER = logging.getLogger(__name__)
+
+COMPRESSIONS = {
+    'gzip': (gzip, '.gz'),
+    'lzma': (lzma, '.xz'),
+}
+
+
+def url_key(url):
+    return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+
+def entry_window(meta):
+    return Window(datetime.strptime(meta['start'], '%Y-%m-%d').date(),
+                  datetime.strptime(meta['end'], '%Y-%m-%d').date())
+
+
+class ResponseCache:
+    """Content-addressed store of raw API responses."""
+
+    def __init__(self, root, compression='gzip'):
+        self.root = root
+        self.compression = compression
+        self.hits = 0
+        self.misses = 0
+
+    def meta_path(self, key):
+        return os.path.join(self.root, key[:2], key + '.json')
+
+    def body_path(self, meta):
+        _, suffix = COMPRESSIONS[meta['compression']]
+        return os.path.join(self.root, meta['key'][:2], meta['key'] + suffix)
+
+    def get(self, url):
+        """Return (meta, body) for a cached URL, or None."""
+        try:
+            with open(self.meta_path(url_key(url)), encoding='utf-8') as f:
+                meta = json.load(f)
+            body = self.load(meta)
+        except (OSError, ValueError, EOFError, lzma.LZMAError) as error:
+            if not isinstance(error, FileNotFoundError):
+                LOGGER.warning('ignoring broken cache entry for %r: %r', url, error)
+            self.misses += 1
+            return None
+        self.hits += 1
+        return meta, body
+
+    def load(self, meta):
+        module, _ = COMPRESSIONS[meta['compression']]
+        with open(self.body_path(meta), 'rb') as f:
+            return module.decompress(f.read())
+
+    def put(self, url, body, window, status=200, content_type=None):
+        writer = self.writer(url, window, status, content_type)
+        writer.write(body)
+        writer.commit()
+
+    def writer(self, url, window, status=200, content_type=None):
+        """A CacheWriter storing a response body as it arrives."""
+        return CacheWriter(self, url, window, status, content_type)
+
+    @staticmethod
+    def _write(path, data):
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def entries(self, start=None, end=None):
+        """Metadata of cached responses overlapping [start, end], oldest fetch first.
+
+        Replaying in this order lets a later fetch of the same dates win.
+        """
+        metas = []
+        for path in glob.glob(os.path.join(self.root, '*', '*.json')):
+            with open(path, encoding='utf-8') as f:
+                meta = json.load(f)
+            window = entry_window(meta)
+            if (start and window.end < start) or (end and window.start > end):
+                continue
+            metas.append(meta)
+        metas.sort(key=lambda meta: meta['fetched_at'])
+        return metas
+
+
+class CacheWriter:
+    """Compress a response body into the cache chunk by chunk.
+
+    Nothing is visible in the cache until `commit`; `abort` drops the
+    partial body.
+    """
+
+    def __init__(self, cache, url, window, status=200, content_type=None):
+        self.cache = cache
+        key = url_key(url)
+        self.meta = {
+            'key': key,
+            'url': url,
+            'start': window.start.isoformat(),
+            'end': window.end.isoformat(),
+            'status': status,
+            'content_type': content_type,
+            'size': 0,
+            'stored_size': 0,
+            'compression': cache.compression,
+            'fetched_at': None,
+        }
+        os.makedirs(os.path.join(cache.root, key[:2]), exist_ok=True)
+        self.path = cache.body_path(self.meta)
+        module, _ = COMPRESSIONS[cache.compression]
+        self.raw = open(self.path + '.tmp', 'wb')
+        self.file = module.open(self.raw, 'wb')
+
+    def write(self, chunk):
+        self.file.write(chunk)
+        self.meta['size'] += len(chunk)
+
+    def commit(self):
+        self.file.close()
+        self.meta['stored_size'] = self.raw.tell()
+        self.raw.close()
+        os.replace(self.path + '.tmp', self.path)
+        self.meta['fetched_at'] = datetime.now().isoformat(timespec='microseconds')
+        self.cache._write(self.cache.meta_path(self.meta['key']),
+                          json.dumps(self.meta, ensure_ascii=False).encode('utf-8'))
+
+    def abort(self):
+        self.file.close()
+        self.raw.close()
+        os.remove(self.path + '.tmp')
@@ -1,4 +1,5 @@
 import asyncio
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
 try:
     # Python 3.4.
@@ -8,11 +9,24 @@ except ImportError:
     from asyncio import Queue
 
 import aiohttp
+from aiohttp import web
 import time
-from datetime import timedelta
+from collections import Counter
+from datetime import date, timedelta
 import logging
-import cgi
-import sqlite3
+import os
+import shutil
+import tempfile
+
+from crawler.ingesting import WindowRows, decode, stream_decoder, window_marks
+from crawler.metrics import CONTENT_TYPE, SIZE_BUCKETS, Exposition, write_textfile
+from crawler.planning import RangePlanner, order_key, ordered_dates, roc_date, window_dates
+from crawler.records import TradeBatch
+from crawler.reporting import Histogram, LatencyTracker, Progress, StageTimings
+from crawler.retrying import CircuitBreaker, RetryBudget, RetryPolicy, retry_after
+from crawler.sharding import merge_shards, shard_dates, staging_path
+from crawler.storage import LEDGER_FAILED, BatchWriter, SQLiteStorage
+from crawler.throttling import AIMDController
 
 LOGGER = logging.getLogger(__name__)
 
@@ -28,158 +42,882 @@ def dates_gen_fn(start_date, end_date, delta=timedelta(days=1)):
         current_date += delta
 
 
-DATABASE_PATH = 'tw-aquaculture-market-lab.sqlite'
-DATABASE_TABLE = 'aquatic_trans_'
-
-# Database connection
-conn = sqlite3.connect(DATABASE_PATH)
-cur = conn.cursor()
-
-# Table setup
-sql = '''
-DROP TABLE IF EXISTS {};
-CREATE TABLE {} (
-    id           INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT UNIQUE,
-    type_name    TEXT NOT NULL,
-    type_code    INTEGER NOT NULL,
-    market_name  TEXT NOT NULL,
-    high_price   REAL NOT NULL,
-    low_price    REAL NOT NULL,
-    mid_price    REAL NOT NULL,
-    avg_price    REAL NOT NULL,
-    date         TEXT NOT NULL,
-    trans_amount REAL NOT NULL
-)
-'''.format(DATABASE_TABLE, DATABASE_TABLE)
-cur.executescript(sql)
-conn.commit()
-# cur.close()
+class WritePipeline:
+    """Hand parsed rows from the event loop to a single writer thread.
+
+    Fetch workers `put` row lists onto a bounded queue and block once it is
+    full, so a slow disk throttles the network instead of buffering without
+    limit.  One drain task feeds the queue to `writer` on a dedicated thread,
+    which lets socket I/O and database I/O overlap.
+    """
+
+    def __init__(self, writer, maxsize=16, timings=None, loop=None):
+        self.writer = writer
+        self.timings = timings or StageTimings()
+        self.loop = loop or asyncio.get_event_loop()
+        self.q = Queue(maxsize=maxsize, loop=self.loop)
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.Task(self.drain(), loop=self.loop)
+
+    @asyncio.coroutine
+    def put(self, rows, marks=()):
+        with self.timings.span('write_wait'):
+            yield from self.q.put((rows, marks))
+
+    @asyncio.coroutine
+    def drain(self):
+        """Feed queued rows to the writer forever."""
+        try:
+            while True:
+                rows, marks = yield from self.q.get()
+                try:
+                    yield from self.loop.run_in_executor(self.executor, self.writer.add, rows, marks)
+                except Exception:
+                    LOGGER.exception('failed writing %r rows', len(rows))
+                finally:
+                    self.q.task_done()
+        except asyncio.CancelledError:
+            pass
+
+    @asyncio.coroutine
+    def join(self):
+        """Wait until everything queued so far is written and committed."""
+        yield from self.q.join()
+        yield from self.loop.run_in_executor(self.executor, self.writer.flush)
+
+    def close(self):
+        """Stop the drain task and write whatever is still queued."""
+        if self.task:
+            self.task.cancel()
+        self.executor.shutdown(wait=True)
+        while not self.q.empty():
+            self.writer.add(*self.q.get_nowait())
+        self.writer.close()
+
+
+@asyncio.coroutine
+def serve_metrics(render, host='127.0.0.1', port=9108):
+    """Answer GET /metrics with `render()`; returns the started aiohttp.web.AppRunner."""
+    @asyncio.coroutine
+    def handle(request):
+        return web.Response(body=render().encode('utf-8'), headers={'Content-Type': CONTENT_TYPE})
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle)
+    # Scrapes come every few seconds; logging each one would drown the crawl's output.
+    runner = web.AppRunner(app, access_log=None)
+    yield from runner.setup()
+    try:
+        yield from web.TCPSite(runner, host, port).start()
+    except BaseException:
+        yield from runner.cleanup()
+        raise
+    return runner
+
+
+def request_trace(stats, timings):
+    """Count new versus reused connections into `stats`; time DNS, connect and TTFB into `timings`."""
+    def start(name):
+        @asyncio.coroutine
+        def on_start(session, context, params):
+            setattr(context, name, time.perf_counter())
+        return on_start
+
+    def end(name, stage, counter=None):
+        @asyncio.coroutine
+        def on_end(session, context, params):
+            if counter:
+                stats[counter] += 1
+            timings.observe(stage, time.perf_counter() - getattr(context, name))
+        return on_end
+
+    @asyncio.coroutine
+    def on_reuse(session, context, params):
+        stats['connections_reused'] += 1
+
+    trace = aiohttp.TraceConfig()
+    trace.on_dns_resolvehost_start.append(start('dns_start'))
+    trace.on_dns_resolvehost_end.append(end('dns_start', 'dns'))
+    trace.on_connection_create_start.append(start('connect_start'))
+    trace.on_connection_create_end.append(end('connect_start', 'connect', 'connections_created'))
+    trace.on_connection_reuseconn.append(on_reuse)
+    trace.on_request_start.append(start('request_start'))
+    trace.on_request_end.append(end('request_start', 'ttfb'))
+    return trace
+
+
+class ConcurrencyLimiter:
+    """Let at most `controller.limit` requests be in flight at once."""
+
+    def __init__(self, controller, loop=None):
+        self.controller = controller
+        self.in_flight = 0
+        self.cond = asyncio.Condition(loop=loop)
+
+    @asyncio.coroutine
+    def acquire(self):
+        with (yield from self.cond):
+            while self.in_flight >= self.controller.limit:
+                yield from self.cond.wait()
+            self.in_flight += 1
+
+    @asyncio.coroutine
+    def release(self):
+        with (yield from self.cond):
+            self.in_flight -= 1
+            self.cond.notify_all()
 
 
 class Crawler:
     """Crawl the aquatic market data of a specific date interval.
+
+    Results go to `storage` (a SQLite database by default), which upserts
+    them, so crawling a date again only changes what the API changed.
+    Every fetched date is recorded in the storage's ledger.  In incremental
+    mode dates the ledger marks as done are skipped, so an interrupted or
+    daily run only fetches what is missing or failed before.  With `reset`
+    the storage is emptied before crawling.
+
+    `max_tasks` workers run, but an AIMD controller decides how many of
+    them may have a request in flight, starting from `initial_tasks` and
+    adapting to the server's latency and errors.
+
+    Network errors, timeouts and 429/5xx responses are retried with
+    jittered exponential backoff (`retry_policy`) as long as the shared
+    `retry_budget` allows; a `breaker` pauses every worker while the
+    server keeps failing.
+
+    With `hedge_percentile`, a request still running after that percentile
+    of recent latencies gets a duplicate; whichever answers first is used
+    and the other is cancelled.
+
+    Dates are planned lazily by a producer that stays `queue_size` windows
+    ahead of the workers, in `order`: 'oldest', 'newest' or 'gaps' (dates
+    missing from the ledger first).  `dates`, if given, replaces the days
+    from `start_date` to `end_date` (see crawl_sharded).
+
+    With `stream`, response bodies are read `chunk_size` bytes at a time
+    and decoded as they arrive; rows go to the writer `stream_batch` at a
+    time, so memory use does not grow with the window size.  Latency, the
+    throttle and hedging then cover the time to the response headers.
+
+    With a `cache`, every good response is kept on disk and windows older
+    than `cache_fresh_days` are served from it (see ingesting.replay for
+    re-ingesting a cache without any network access).
+
+    Every stage of the pipeline is timed into `timings` (see
+    reporting.STAGES), and every `progress_interval` seconds a line with
+    the days and rows done, rows/sec and the ETA is printed.
+
+    With `metrics_port`, Prometheus metrics (see `metrics`) are served on
+    http://`metrics_host`:`metrics_port`/metrics while the crawl runs; with
+    `metrics_file` they are written there every `metrics_interval` seconds
+    for a textfile collector.  `metrics_labels` are added to every series.
+
+    `base_url` is the API's URL with two {} for the start and end dates;
+    benchmarks point it at a fakeserver.FakeServer.
     """
 
-    def __init__(self, start_date, end_date, max_tasks=10, max_tries=10, loop=None):
+    def __init__(self, start_date, end_date, max_tasks=10, max_tries=10, initial_tasks=4, min_tasks=1,
+                 window_days=7, max_window_days=31,
+                 batch_size=5000, batch_delay=5.0, write_queue_size=16, incremental=False, reset=False,
+                 storage=None, cache=None, cache_fresh_days=7, retry_policy=None, retry_budget=None, breaker=None,
+                 connect_timeout=10.0, read_timeout=60.0, keepalive_timeout=30.0, dns_ttl=300,
+                 hedge_percentile=None, hedge_min_samples=20, order='oldest', queue_size=None, dates=None,
+                 stream=False, chunk_size=65536, stream_batch=1000, progress_interval=10.0,
+                 metrics_port=None, metrics_host='127.0.0.1', metrics_file=None, metrics_interval=15.0,
+                 metrics_labels=None, base_url=BASE_URL, loop=None):
         self.start_date = start_date
         self.end_date = end_date
         self.max_tasks = max_tasks
         self.max_tries = max_tries
+        self.base_url = base_url
+        self.storage = storage or SQLiteStorage()
+        self.cache = cache
+        self.cache_fresh_days = cache_fresh_days
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.stream_batch = stream_batch
+
+        if reset:
+            self.storage.reset()
+        done = self.storage.completed_dates() if incremental or order == 'gaps' else frozenset()
+        if incremental:
+            LOGGER.info('skipping %r dates already in the ledger', len(done))
+        if dates is None:
+            total_days = (end_date - start_date).days + 1
+            if incremental:
+                total_days -= sum(1 for day in done if start_date <= day <= end_date)
+            dates = ordered_dates(start_date, end_date, order, done, skip_done=incremental)
+        else:
+            dates = sorted((day for day in dates if not incremental or day not in done),
+                           key=lambda day: order_key(day, order, done))
+            total_days = len(dates)
+        self.progress = Progress(total_days)
+        self.progress_interval = progress_interval
+        self.planner = RangePlanner(dates, days=window_days, max_days=max_window_days)
 
         self.loop = loop or asyncio.get_event_loop()
-        self.session = aiohttp.ClientSession(loop=self.loop)
-
-        self.q = Queue(loop=self.loop)
+        self.latencies = LatencyTracker()
+        self.timings = StageTimings()
+        self.request_seconds = Histogram()
+        self.response_sizes = Histogram(SIZE_BUCKETS)
+        self.metrics_port = metrics_port
+        self.metrics_host = metrics_host
+        self.metrics_file = metrics_file
+        self.metrics_interval = metrics_interval
+        self.metrics_labels = metrics_labels
+        self.metrics_server = None
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+
+        # Every request goes to the same host: keep enough warm connections
+        # for the largest concurrency the throttle may choose, plus one
+        # hedge each, and reuse them.
+        self.net_stats = Counter()
+        pool_size = max_tasks * 2 if hedge_percentile else max_tasks
+        connector = aiohttp.TCPConnector(limit=pool_size, limit_per_host=pool_size,
+                                         use_dns_cache=True, ttl_dns_cache=dns_ttl,
+                                         keepalive_timeout=keepalive_timeout, loop=self.loop)
+        self.session = aiohttp.ClientSession(connector=connector,
+                                             timeout=aiohttp.ClientTimeout(connect=connect_timeout,
+                                                                           sock_read=read_timeout),
+                                             headers={'Accept-Encoding': 'gzip, deflate'},
+                                             trace_configs=[request_trace(self.net_stats, self.timings)],
+                                             loop=self.loop)
+
+        self.throttle = AIMDController(initial=initial_tasks, minimum=min_tasks, maximum=max_tasks)
+        self.limiter = ConcurrencyLimiter(self.throttle, loop=self.loop)
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.budget = retry_budget or RetryBudget()
+        self.breaker = breaker or CircuitBreaker()
+        self.retries = 0
+        self.failed_dates = []
+        # Invalid records skipped; their days are marked done all the same.
+        self.rejected = 0
+
+        # Windows wait in the queue by plan order; the producer keeps at most
+        # `queue_size` of them planned ahead, and split halves jump the queue.
+        self.q = asyncio.PriorityQueue(loop=self.loop)
+        self.slots = asyncio.Semaphore(queue_size or 2 * max_tasks, loop=self.loop)
+        self.planned = 0
+        self.writer = WritePipeline(BatchWriter(self.storage, batch_size=batch_size, max_delay=batch_delay,
+                                                timings=self.timings),
+                                    maxsize=write_queue_size, timings=self.timings, loop=self.loop)
 
         self.t0 = time.time()
         self.t1 = None
 
-        self.make_url_queue()
+    def add_window(self, window, priority=0):
+        self.q.put_nowait((priority, window))
+
+    @asyncio.coroutine
+    def produce(self):
+        """Plan windows lazily, keeping at most `queue_size` of them waiting."""
+        while True:
+            yield from self.slots.acquire()
+            window = self.planner.next_window()
+            if window is None:
+                self.slots.release()
+                return
+            self.planned += 1
+            self.add_window(window, self.planned)
+
+    def window_url(self, window):
+        return self.base_url.format(roc_date(window.start), roc_date(window.end))
+
+    def split_window(self, window, reason):
+        """Requeue the two halves of a failed window; return False for a single day."""
+        halves = self.planner.failed(window)
+        if not halves:
+            return False
+        LOGGER.info('%s for %r, splitting into %r', reason, window, halves)
+        for half in halves:
+            self.add_window(half)
+        return True
+
+    @asyncio.coroutine
+    def mark_failed(self, window):
+        """Record the dates of `window` as failed so a later --incremental run retries them."""
+        self.failed_dates.extend(window_dates(window))
+        self.progress.add(len(window_dates(window)))
+        yield from self.writer.put([], window_marks(window, LEDGER_FAILED))
 
-    def add_url(self, url):
-        self.q.put_nowait(url)
+    @asyncio.coroutine
+    def wait_for_circuit(self):
+        """Hold this worker while the circuit breaker is open."""
+        delay = self.breaker.delay()
+        while delay:
+            yield from asyncio.sleep(delay, loop=self.loop)
+            delay = self.breaker.delay()
 
-    def make_url_queue(self):
-        dates = dates_gen_fn(self.start_date, self.end_date)
-        for date in dates:
-            roc_year = int(date.strftime('%Y')) - 1911
-            query_date = '{:3d}{}'.format(roc_year, date.strftime('%m%d')).replace(' ', '0')
-            url = BASE_URL.format(query_date, query_date)
-            self.add_url(url)
+    @asyncio.coroutine
+    def request(self, url, read=True):
+        """GET `url` and read the whole body, or leave it unread and return None for it."""
+        self.net_stats['requests'] += 1
+        response = yield from self.session.get(url, allow_redirects=False)
+        if not read:
+            return response, None
+        try:
+            with self.timings.span('body'):
+                body = yield from response.read()
+        except BaseException:
+            response.release()
+            raise
+        self.count_bytes(response, len(body))
+        return response, body
+
+    def hedge_delay(self):
+        """Seconds to wait before hedging, or None while hedging is off or still warming up.
+
+        The percentile comes from every successful request, hedged ones
+        included, timed from when the first copy was sent until either copy
+        answered.  For a hedged request that understates how slow the first
+        copy was, but never below the delay it was hedged after: requests
+        slower than the percentile stay above it, so hedging does not drag
+        the percentile down.  It does make the percentile lag behind when
+        the server slows down.
+        """
+        if self.hedge_percentile is None or len(self.latencies.recent) < self.hedge_min_samples:
+            return None
+        return self.latencies.percentile(self.hedge_percentile)
+
+    @asyncio.coroutine
+    def hedged_request(self, url, read=True):
+        """Like `request`, but send a duplicate if the first one is slow; the first answer wins."""
+        delay = self.hedge_delay()
+        if delay is None:
+            return (yield from self.request(url, read))
+
+        first = asyncio.ensure_future(self.request(url, read), loop=self.loop)
+        tasks = [first]
+        try:
+            done, pending = yield from asyncio.wait(tasks, timeout=delay, loop=self.loop)
+            if not done:
+                self.net_stats['hedges'] += 1
+                tasks.append(asyncio.ensure_future(self.request(url, read), loop=self.loop))
+            pending = set(tasks)
+            winner = error = None
+            while pending and winner is None:
+                done, pending = yield from asyncio.wait(pending, loop=self.loop, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        error = error or task.exception()
+                    elif winner is None:
+                        winner = task
+                    else:
+                        # Both finished at once; the loser's connection goes back to the pool.
+                        task.result()[0].release()
+        finally:
+            for task in tasks:
+                task.cancel()
+        if winner is None:
+            raise error
+        if winner is not first:
+            self.net_stats['hedge_wins'] += 1
+        return winner.result()
+
+    def count_bytes(self, response, size):
+        """Tally bytes on the wire versus `size` after decompression."""
+        wire = size
+        if response.headers.get('content-encoding') in ('gzip', 'deflate') and response.content_length:
+            wire = response.content_length
+        self.net_stats['bytes_wire'] += wire
+        self.net_stats['bytes_decoded'] += size
+        self.response_sizes.observe(size)
+
+    def request_succeeded(self, latency):
+        self.latencies.add(latency)
+        self.request_seconds.observe(latency)
+        self.throttle.success(latency)
+        self.breaker.success()
+
+    def request_failed(self, reason):
+        self.throttle.failure(reason)
+        self.breaker.failure()
 
     def close(self):
-        self.session.close()
+        if self.metrics_server:
+            self.loop.run_until_complete(self.metrics_server.cleanup())
+            self.metrics_server = None
+        self.writer.close()
+        self.storage.close()
+        if not self.session.closed:
+            self.loop.run_until_complete(self.session.close())
+
+    @asyncio.coroutine
+    def ingest(self, content_type, body, window):
+        """Queue the rows of `window` in a body for writing, with its ledger marks.
+
+        Returns the row count, or None if the body holds no records.
+        """
+        with self.timings.span('decode'):
+            records = decode(content_type, body)
+            if records is None:
+                return None
+            clip = WindowRows(window)
+            rows = clip.rows(records)
+            marks = clip.marks()
+        self.rejected += clip.rejected
+        yield from self.writer.put(rows, marks)
+        return len(rows)
 
     @asyncio.coroutine
-    def parse(self, response):
-        # print(response)
+    def parse(self, response, body, window):
+        """Queue the rows of a response for writing; return their count, or None if unusable."""
         if response.status == 200:
-            content_type = response.headers.get('content-type')
-
-            if content_type:
-                content_type, pdict = cgi.parse_header(content_type)
-
-            if content_type in ('text/html', 'application/xml'):
-                json = yield from response.json(content_type=content_type)
-                if json:
-                    # print(len(json))
-                    for item in json:
-                        # print(item)
-                        type_name = item['魚貨名稱']
-                        type_code = item['品種代碼']
-                        market_name = item['市場名稱']
-                        high_price = item['上價']
-                        low_price = item['下價']
-                        mid_price = item['中價']
-                        avg_price = item['平均價']
-                        date = item['交易日期']
-                        trans_amount = item['交易量']
-
-                        sql = '''
-                        INSERT INTO {}
-                        (type_name, type_code, market_name, high_price, low_price, mid_price, avg_price, date, trans_amount)
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)'''.format(DATABASE_TABLE)
-                        cur.execute(sql, (
-                            type_name, type_code, market_name, high_price, low_price, mid_price, avg_price, date,
-                            trans_amount))
-
-                    conn.commit()
-
-        return
-
-    @asyncio.coroutine
-    def fetch(self, url):
-        """Fetch one URL."""
-        tries = 0
-        while tries < self.max_tries:
-            try:
-                response = yield from self.session.get(url, allow_redirects=False)
+            return (yield from self.ingest(response.headers.get('content-type'), body, window))
+
+        return None
+
+    def finished(self, url, window, rows, how=''):
+        self.progress.add(len(window_dates(window)), rows)
+        print('{} done{} ({} rows)'.format(url, how, rows))
+
+    def cacheable(self, window):
+        """Only serve settled history from the cache; recent days may still be revised."""
+        return window.end < date.today() - timedelta(days=self.cache_fresh_days)
+
+    @asyncio.coroutine
+    def fetch_cached(self, url, window):
+        """Ingest a cached response for `url`; return False on a cache miss."""
+        cached = yield from self.loop.run_in_executor(None, self.cache.get, url)
+        if not cached:
+            return False
+        meta, body = cached
+        try:
+            rows = yield from self.ingest(meta['content_type'], body, window)
+        except ValueError as error:
+            LOGGER.warning('ignoring unparsable cache entry for %r: %r', url, error)
+            return False
+        if rows is None:
+            return False
+        self.finished(url, window, rows, ' from cache')
+        return True
 
-                if tries > 1:
-                    LOGGER.info('try %r for %r success', tries, url)
+    @asyncio.coroutine
+    def parse_stream(self, response, url, window):
+        """Decode a response as it arrives and queue its rows in small batches.
+
+        Returns (row count, body size), or None if the response is unusable.
+        The ledger marks go with the last batch, so a window cut short is
+        never recorded as done.
+        """
+        content_type = response.headers.get('content-type')
+        decoder = stream_decoder(content_type) if response.status == 200 else None
+        if decoder is None:
+            return None
+
+        clip = WindowRows(window)
+        cache = self.cache.writer(url, window, response.status, content_type) if self.cache else None
+        size = num_rows = 0
+        body_time = decode_time = 0.0
+        rows = TradeBatch()
+        try:
+            while True:
+                t0 = time.perf_counter()
+                chunk = yield from response.content.read(self.chunk_size)
+                t1 = time.perf_counter()
+                body_time += t1 - t0
+                if not chunk:
+                    break
+                size += len(chunk)
+                if cache:
+                    yield from self.loop.run_in_executor(None, cache.write, chunk)
+                t2 = time.perf_counter()
+                rows.extend(clip.rows(decoder.feed(chunk)))
+                decode_time += time.perf_counter() - t2
+                if len(rows) >= self.stream_batch:
+                    yield from self.writer.put(rows)
+                    num_rows += len(rows)
+                    rows = TradeBatch()
+            rows.extend(clip.rows(decoder.close()))
+            self.rejected += clip.rejected
+            yield from self.writer.put(rows, clip.marks())
+            num_rows += len(rows)
+        except BaseException:
+            if cache:
+                cache.abort()
+            raise
+        if cache:
+            yield from self.loop.run_in_executor(None, cache.commit)
+        self.timings.observe('body', body_time)
+        self.timings.observe('decode', decode_time)
+        self.count_bytes(response, size)
+        return num_rows, size
 
-                break
+    @asyncio.coroutine
+    def fetch_stream(self, response, url, window):
+        """Ingest a streamed response, splitting or failing the window if it breaks off."""
+        try:
+            result = yield from self.parse_stream(response, url, window)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as error:
+            # Rows queued so far are kept; upserts make refetching them harmless.
+            if not self.split_window(window, 'broken response ({!r})'.format(error)):
+                LOGGER.error('could not read %r: %r', url, error)
+                yield from self.mark_failed(window)
+            return
+        finally:
+            response.release()
+
+        if result is None:
+            LOGGER.error('%r returned status %r', url, response.status)
+            yield from self.mark_failed(window)
+            return
+
+        rows, size = result
+        self.planner.feedback(window, size)
+        self.finished(url, window, rows)
+
+    @asyncio.coroutine
+    def fetch(self, window):
+        """Fetch one window of dates."""
+        url = self.window_url(window)
+        if self.cache and self.cacheable(window) and (yield from self.fetch_cached(url, window)):
+            return
+
+        self.budget.deposit()
+        tries = 0
+        while True:
+            yield from self.wait_for_circuit()
+            yield from self.limiter.acquire()
+            t0 = time.time()
+            wait = None
+            try:
+                response, body = yield from self.hedged_request(url, read=not self.stream)
+            except asyncio.TimeoutError:
+                LOGGER.info('try %r for %r timed out', tries, url)
+                self.request_failed('timeout')
+                if self.split_window(window, 'timeout'):
+                    return
             except aiohttp.ClientError as client_error:
                 LOGGER.info('try %r for %r raised %r', tries, url, client_error)
-                # exception = client_error
+                self.request_failed(repr(client_error))
+            else:
+                if not self.retry_policy.retryable(response.status):
+                    self.request_succeeded(time.time() - t0)
+
+                    if tries > 1:
+                        LOGGER.info('try %r for %r success', tries, url)
+
+                    break
+                LOGGER.info('try %r for %r returned status %r', tries, url, response.status)
+                self.request_failed('status {} from {}'.format(response.status, url))
+                wait = retry_after(response.headers)
+                response.release()
+            finally:
+                yield from self.limiter.release()
 
             tries += 1
-        else:
-            # We never broke out of the loop: all tries failed.
+            if tries >= self.max_tries or not self.budget.withdraw():
+                reason = 'failed after {} tries'.format(tries)
+                if tries < self.max_tries:
+                    reason += ', retry budget exhausted'
+                if not self.split_window(window, reason):
+                    LOGGER.error('%r %s', url, reason)
+                    yield from self.mark_failed(window)
+                return
+
+            self.retries += 1
+            yield from asyncio.sleep(self.retry_policy.delay(tries, wait), loop=self.loop)
+
+        if self.stream:
+            yield from self.fetch_stream(response, url, window)
             return
 
         try:
-            yield from self.parse(response)
+            if self.planner.too_large(len(body)) and self.split_window(window, 'response too large'):
+                return
+
+            try:
+                rows = yield from self.parse(response, body, window)
+            except ValueError as error:
+                if not self.split_window(window, 'unparsable response ({})'.format(error)):
+                    LOGGER.error('could not parse %r: %r', url, error)
+                    yield from self.mark_failed(window)
+                return
+
+            if rows is None:
+                LOGGER.error('%r returned status %r', url, response.status)
+                yield from self.mark_failed(window)
+                return
+
+            self.planner.feedback(window, len(body))
+
+            if self.cache:
+                yield from self.loop.run_in_executor(None, self.cache.put, url, body, window,
+                                                     response.status, response.headers.get('content-type'))
 
         finally:
-            yield from response.release()
+            response.release()
 
-        print('{} done'.format(url))
+        self.finished(url, window, rows)
 
     @asyncio.coroutine
     def work(self):
+        """Process queue items forever.
+
+        A window whose fetch raises anything unexpected is logged and
+        recorded as failed; the worker carries on with the next one.
+        """
+        try:
+            while True:
+                priority, window = yield from self.q.get()
+                if priority:
+                    self.slots.release()
+                try:
+                    with self.timings.span('fetch'):
+                        yield from self.fetch(window)
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    LOGGER.exception('unexpected error fetching %r', window)
+                    yield from self.mark_failed(window)
+                finally:
+                    self.q.task_done()
+        except asyncio.CancelledError:
+            pass
 
-        """Process queue items forever."""
+    @asyncio.coroutine
+    def show_progress(self):
+        """Print a progress line every `progress_interval` seconds."""
         try:
             while True:
-                url = yield from self.q.get()
-                yield from self.fetch(url)
-                self.q.task_done()
+                yield from asyncio.sleep(self.progress_interval, loop=self.loop)
+                print(self.progress.line())
+        except asyncio.CancelledError:
+            pass
+
+    def metrics(self):
+        """The crawler's state and statistics in the Prometheus text format."""
+        out = Exposition(labels=self.metrics_labels)
+        out.gauge('in_flight_requests', 'Requests sent and not yet answered', self.limiter.in_flight)
+        out.gauge('concurrency_limit', 'Requests the throttle currently allows in flight', self.throttle.limit)
+        out.gauge('queue_depth', 'Windows waiting for a worker', self.q.qsize())
+        out.gauge('write_queue_depth', 'Parsed responses waiting for the database writer', self.writer.q.qsize())
+        out.gauge('circuit_open', '1 while the circuit breaker holds requests back',
+                  int(self.breaker.state != self.breaker.CLOSED))
+        out.gauge('days', 'Days to crawl in this run', self.progress.total_days)
+        out.counter('days_done_total', 'Days fetched or given up on', self.progress.days)
+        out.counter('days_failed_total', 'Days given up on', len(self.failed_dates))
+        out.counter('requests_total', 'Requests sent, hedges included', self.net_stats['requests'])
+        out.counter('retries_total', 'Requests retried', self.retries)
+        out.counter('retries_denied_total', 'Retries the retry budget denied', self.budget.denied)
+        out.counter('circuit_trips_total', 'Times the circuit breaker opened', self.breaker.trips)
+        out.counter('hedges_total', 'Duplicate requests sent for slow ones', self.net_stats['hedges'])
+        out.counter('connections_total', 'Pooled connections, by whether they were new',
+                    [({'state': 'created'}, self.net_stats['connections_created']),
+                     ({'state': 'reused'}, self.net_stats['connections_reused'])])
+        out.counter('response_bytes_total', 'Response body bytes, on the wire and decompressed',
+                    [({'encoding': 'wire'}, self.net_stats['bytes_wire']),
+                     ({'encoding': 'decoded'}, self.net_stats['bytes_decoded'])])
+        out.counter('rows_parsed_total', 'Rows decoded from responses', self.progress.rows)
+        out.counter('records_rejected_total', 'Invalid records skipped', self.rejected)
+        counts = self.storage.counts
+        out.counter('rows_stored_total', 'Rows written, by what the upsert did to them',
+                    [({'result': result}, counts[result]) for result in ('inserted', 'updated', 'unchanged')])
+        out.histogram('request_duration_seconds', 'Latency of successful requests',
+                      [({}, self.request_seconds)])
+        out.histogram('response_size_bytes', 'Decompressed size of response bodies',
+                      [({}, self.response_sizes)])
+        out.histogram('stage_duration_seconds', 'Time spent per pipeline stage; db_write is one transaction',
+                      [({'stage': stage}, histogram) for stage, histogram in self.timings.ordered()])
+        return out.text()
+
+    @asyncio.coroutine
+    def write_metrics(self):
+        """Write the metrics to `metrics_file` every `metrics_interval` seconds."""
+        try:
+            while True:
+                write_textfile(self.metrics_file, self.metrics())
+                yield from asyncio.sleep(self.metrics_interval, loop=self.loop)
         except asyncio.CancelledError:
             pass
 
     @asyncio.coroutine
     def crawl(self):
         """Run the crawler until all finished."""
+        if self.metrics_port is not None:
+            self.metrics_server = yield from serve_metrics(self.metrics, self.metrics_host, self.metrics_port)
+            LOGGER.info('serving metrics on http://%s:%r/metrics', self.metrics_host, self.metrics_port)
+        self.writer.start()
+        producer = asyncio.Task(self.produce(), loop=self.loop)
         workers = [asyncio.Task(self.work(), loop=self.loop)
                    for _ in range(self.max_tasks)]
+        if self.progress_interval:
+            workers.append(asyncio.Task(self.show_progress(), loop=self.loop))
+        if self.metrics_file:
+            workers.append(asyncio.Task(self.write_metrics(), loop=self.loop))
         self.t0 = time.time()
+        self.progress = Progress(self.progress.total_days)
+        # Halves of split windows are queued before their window is done,
+        # so once the producer is finished the queue drains for good.
+        yield from producer
         yield from self.q.join()
+        yield from self.writer.join()
         self.t1 = time.time()
         for w in workers:
             w.cancel()
 
-        conn.close()
+        self.writer.close()
+        if self.metrics_file:
+            write_textfile(self.metrics_file, self.metrics())
+        self.report()
 
+    def report(self):
         dt = self.t1 - self.t0
         print('elapsed time: {}'.format(dt))
+        print('retries: {}, denied by budget: {}, circuit breaker trips: {}'.format(
+            self.retries, self.budget.denied, self.breaker.trips))
+        if self.failed_dates:
+            print('failed dates: {} (rerun with --incremental to retry them)'.format(len(self.failed_dates)))
+        stats = self.net_stats
+        connections = stats['connections_created'] + stats['connections_reused']
+        print('connections: {} created, {} reused ({:.0%} reuse)'.format(
+            stats['connections_created'], stats['connections_reused'],
+            stats['connections_reused'] / connections if connections else 0))
+        print('bytes: {} on the wire, {} decoded, {} saved by compression'.format(
+            stats['bytes_wire'], stats['bytes_decoded'], stats['bytes_decoded'] - stats['bytes_wire']))
+        print(self.latencies.summary())
+        if self.hedge_percentile is not None:
+            primary = stats['requests'] - stats['hedges']
+            print('hedged {} of {} requests ({:.1%}), {} hedges won'.format(
+                stats['hedges'], primary, stats['hedges'] / primary if primary else 0, stats['hedge_wins']))
+        print(self.throttle.summary())
+        print('limit over time: {}'.format(self.throttle.timeline()))
+        if self.cache:
+            print('cache hits: {}, misses: {}'.format(self.cache.hits, self.cache.misses))
+        counts = self.storage.counts
+        print('rows inserted: {}, updated: {}, unchanged: {}'.format(
+            counts['inserted'], counts['updated'], counts['unchanged']))
+        if self.rejected:
+            print('invalid records skipped: {} (their days are marked done)'.format(self.rejected))
+        print(self.progress.line())
+        print(self.timings.summary())
+
+    def stats(self):
+        """The run statistics of `report` as a JSON-serializable dict."""
+        counts = self.storage.counts
+        return {
+            'elapsed': (self.t1 or time.time()) - self.t0,
+            'days': {'total': self.progress.total_days, 'done': self.progress.days, 'failed': len(self.failed_dates)},
+            'rows': {'parsed': self.progress.rows, 'inserted': counts['inserted'], 'updated': counts['updated'],
+                     'unchanged': counts['unchanged'], 'rejected': self.rejected},
+            'requests': {'sent': self.net_stats['requests'], 'retries': self.retries,
+                         'denied_by_budget': self.budget.denied, 'breaker_trips': self.breaker.trips,
+                         'hedges': self.net_stats['hedges'], 'hedge_wins': self.net_stats['hedge_wins']},
+            'latency': {'p50': self.latencies.percentile(50), 'p95': self.latencies.percentile(95),
+                        'p99': self.latencies.percentile(99), 'samples': len(self.latencies.recent)},
+            'connections': {'created': self.net_stats['connections_created'],
+                            'reused': self.net_stats['connections_reused']},
+            'bytes': {'wire': self.net_stats['bytes_wire'], 'decoded': self.net_stats['bytes_decoded']},
+            'cache': {'hits': self.cache.hits, 'misses': self.cache.misses} if self.cache else None,
+            'stages': self.timings.as_dict(),
+        }
+
+
+def crawl_shard(dates, path, options):
+    """Crawl `dates` into a fresh SQLite database at `path`; runs in a worker process.
+
+    The staging database skips rollups; the merge updates the target's.
+    Returns the crawler's stats.
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    storage = SQLiteStorage(path, rollups=False)
+    crawler = Crawler(dates[0], dates[-1], dates=dates, storage=storage, loop=loop, **options)
+    try:
+        loop.run_until_complete(crawler.crawl())
+    finally:
+        crawler.close()
+        loop.close()
+    return crawler.stats()
+
+
+def shard_metrics(options, index):
+    """Options for shard `index`: its own metrics port and file, and a shard label."""
+    options = dict(options, metrics_labels=dict(options.get('metrics_labels') or {}, shard=index))
+    if options.get('metrics_port'):
+        options['metrics_port'] += index
+    if options.get('metrics_file'):
+        root, ext = os.path.splitext(options['metrics_file'])
+        options['metrics_file'] = '{}-{:02d}{}'.format(root, index, ext)
+    return options
+
+
+def crawl_sharded(start_date, end_date, storage, processes, max_tasks=10, incremental=False, reset=False,
+                  batch_size=5000, staging_dir=None, **options):
+    """Crawl [start_date, end_date] in `processes` processes and merge into `storage`.
+
+    The dates left to fetch are split into contiguous shards, each crawled
+    by its own Crawler and event loop into a staging database; `max_tasks`
+    is divided between the shards so the server sees the same load as a
+    single-process crawl.  Each staging database is merged as soon as its
+    shard is done, also when the shard failed.  If the crawl is interrupted
+    the days the unfinished shards committed are merged too, so a rerun
+    with `incremental` picks up where this one stopped.  Returns the stats
+    of every shard (None for a failed one) and of the merges.
+    """
+    if reset:
+        storage.reset()
+    dates = list(dates_gen_fn(start_date, end_date))
+    if incremental:
+        done = storage.completed_dates()
+        dates = [day for day in dates if day not in done]
+        LOGGER.info('%r dates left to fetch, %r already in the ledger', len(dates), len(done))
+    shards = shard_dates(dates, processes)
+    if not shards:
+        print('nothing to fetch')
+        return {'shards': [], 'merge': None}
+
+    options = dict(options, max_tasks=max(1, max_tasks // len(shards)), batch_size=batch_size)
+    options['initial_tasks'] = min(options.get('initial_tasks', 4), options['max_tasks'])
+    directory = tempfile.mkdtemp(prefix='crawl-shards-', dir=staging_dir)
+    paths = [staging_path(directory, i) for i in range(len(shards))]
+    shard_stats = [None] * len(shards)
+    unmerged = set(range(len(shards)))
+    rows = 0
+    merge_time = 0.0
+    t0 = time.time()
+    try:
+        with ProcessPoolExecutor(len(shards)) as executor:
+            futures = {executor.submit(crawl_shard, shard, paths[i], shard_metrics(options, i)): i
+                       for i, shard in enumerate(shards)}
+            for future in as_completed(futures):
+                i = futures[future]
+                try:
+                    shard_stats[i] = future.result()
+                except Exception:
+                    LOGGER.exception('shard %r failed, merging the days it finished', i)
+                unmerged.discard(i)
+                shard_rows, secs = merge_shards(storage, [paths[i]], batch_size=batch_size)
+                rows += shard_rows
+                merge_time += secs
+    finally:
+        if unmerged:
+            LOGGER.warning('merging the days %r unfinished shards committed', len(unmerged))
+            merge_shards(storage, [paths[i] for i in sorted(unmerged)], batch_size=batch_size)
+        shutil.rmtree(directory, ignore_errors=True)
+    elapsed = time.time() - t0
+
+    print('sharded crawl: {} shards, {} dates in {:.3f} secs'.format(len(shards), len(dates), elapsed))
+    print('merge: {} rows in {:.3f} secs ({:.0f} rows/sec), {:.1%} of the elapsed time'.format(
+        rows, merge_time, rows / merge_time if merge_time else 0, merge_time / elapsed if elapsed else 0))
+    failed = sum(stats['days']['failed'] for stats in shard_stats if stats)
+    failed_shards = shard_stats.count(None)
+    if failed or failed_shards:
+        print('failed dates: {}, failed shards: {} (rerun with --incremental to retry them)'.format(
+            failed, failed_shards))
+    counts = storage.counts
+    print('rows inserted: {}, updated: {}, unchanged: {}'.format(
+        counts['inserted'], counts['updated'], counts['unchanged']))
+    rejected = sum(stats['rows']['rejected'] for stats in shard_stats if stats)
+    if rejected:
+        print('invalid records skipped: {} (their days are marked done)'.format(rejected))
+    return {'shards': shard_stats,
+            'merge': {'rows': rows, 'elapsed': elapsed, 'merge_time': merge_time,
+                      'inserted': counts['inserted'], 'updated': counts['updated'],
+                      'unchanged': counts['unchanged']}}
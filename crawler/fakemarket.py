@@ -0,0 +1,60 @@
+"""Fake market -- deterministic trades shaped like the COA API's JSON.
+
+A FakeMarket reports `rows_per_day` trades a day, one per species and
+market, with prices scattered around a fixed base price per species.  The
+same seed and day always give the same items, so benchmark runs are
+comparable; see fakeserver for serving them over HTTP.  Each day is
+encoded once and kept, so serving a window costs little more than a join.
+"""
+
+from datetime import date
+import json
+import math
+import random
+
+from crawler.planning import roc_date
+
+MARKETS = ('台北', '三重', '桃園', '新竹', '台中', '埔心', '嘉義', '台南', '高雄', '興達港', '東港', '宜蘭', '花蓮',
+           '台東', '澎湖', '南投', '彰化')
+
+SPECIES = ('吳郭魚', '虱目魚', '白蝦', '草蝦', '鱸魚', '鯖魚', '秋刀魚', '鮪魚', '鯛魚', '石斑', '鰻魚', '白帶魚',
+           '午仔魚', '烏魚', '黃魚', '魷魚', '花枝', '文蛤', '牡蠣', '紅蟳')
+
+
+class FakeMarket:
+    """The trades of `rows_per_day` species and market pairs, the same for every `seed` and day."""
+
+    def __init__(self, rows_per_day=300, seed=0, markets=MARKETS):
+        self.rows_per_day = rows_per_day
+        self.seed = seed
+        self.markets = markets
+        species = math.ceil(rows_per_day / len(markets))
+        rng = random.Random(seed)
+        self.species = [('{}{}'.format(SPECIES[i % len(SPECIES)], i // len(SPECIES) or ''), 1001 + i,
+                         rng.uniform(30.0, 600.0)) for i in range(species)]
+        self.encoded = {}
+
+    def items(self, day):
+        rng = random.Random('{}-{}'.format(self.seed, day.toordinal()))
+        items = []
+        for i in range(self.rows_per_day):
+            name, code, base = self.species[i // len(self.markets)]
+            avg = base * rng.uniform(0.8, 1.2)
+            high = avg * rng.uniform(1.0, 1.3)
+            low = avg * rng.uniform(0.7, 1.0)
+            items.append({'魚貨名稱': name, '品種代碼': code, '市場名稱': self.markets[i % len(self.markets)],
+                          '上價': round(high, 1), '下價': round(low, 1), '中價': round((high + low) / 2, 1),
+                          '平均價': round(avg, 1), '交易日期': roc_date(day),
+                          '交易量': round(rng.lognormvariate(5.0, 1.5), 1)})
+        return items
+
+    def day_json(self, day):
+        """The items of `day` as JSON array elements, without the brackets."""
+        if day not in self.encoded:
+            self.encoded[day] = json.dumps(self.items(day), ensure_ascii=False)[1:-1].encode('utf-8')
+        return self.encoded[day]
+
+    def body(self, start, end):
+        """The JSON the API answers for StartDate=`start` and EndDate=`end`, as UTF-8 bytes."""
+        parts = (self.day_json(date.fromordinal(ordinal)) for ordinal in range(start.toordinal(), end.toordinal() + 1))
+        return b'[' + b', '.join(part for part in parts if part) + b']'
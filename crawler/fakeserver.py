@@ -0,0 +1,134 @@
+"""Fake server -- a local stand-in for the COA AquaticTransData.aspx API.
+
+A FakeServer answers GET /OpenData/AquaticTransData.aspx?StartDate=..&EndDate=..
+with the trades of a FakeMarket, labelled text/html like the real API.
+Each response waits a log-normally distributed time first (`latency` is
+the median, `latency_sigma` the spread of its logarithm), and a share
+`error_rate` of requests get a 503 instead.  With `compress`, bodies are
+gzipped for clients that accept it, at a CPU cost to the server that can
+dominate a benchmark.  A ServerThread runs one on an event loop of its
+own, so a crawler in the same process or another can be pointed at `url`.
+"""
+
+import asyncio
+import math
+import random
+import socket
+import threading
+
+from aiohttp import web
+
+from crawler.fakemarket import FakeMarket
+from crawler.planning import parse_roc_date
+
+PATH = '/OpenData/AquaticTransData.aspx'
+
+
+def find_unused_port(host='127.0.0.1'):
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind((host, 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+class FakeServer:
+    """Serve `market` with the given latency and error rate; `seed` makes both repeatable."""
+
+    def __init__(self, market=None, latency=0.0, latency_sigma=0.5, error_rate=0.0, seed=0, compress=False):
+        self.market = market or FakeMarket(seed=seed)
+        self.latency = latency
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.compress = compress
+        self.rng = random.Random(seed)
+        self.runner = None
+        self.url = None
+        self.requests = 0
+        self.errors = 0
+
+    def delay(self):
+        if not self.latency:
+            return 0.0
+        return self.latency * math.exp(self.rng.gauss(0.0, self.latency_sigma))
+
+    @asyncio.coroutine
+    def handle(self, request):
+        self.requests += 1
+        yield from asyncio.sleep(self.delay())
+        if self.rng.random() < self.error_rate:
+            self.errors += 1
+            return web.Response(status=503, text='Service Unavailable')
+        try:
+            start = parse_roc_date(request.query['StartDate'])
+            end = parse_roc_date(request.query['EndDate'])
+        except (KeyError, ValueError):
+            return web.Response(status=400, text='bad StartDate or EndDate')
+        response = web.Response(body=self.market.body(start, end), content_type='text/html', charset='utf-8')
+        if self.compress:
+            response.enable_compression()
+        return response
+
+    @asyncio.coroutine
+    def start(self, host='127.0.0.1', port=None):
+        """Start listening; `url` is then a URL template for Crawler's `base_url`."""
+        port = port or find_unused_port(host)
+        app = web.Application()
+        app.router.add_get(PATH, self.handle)
+        self.runner = web.AppRunner(app)
+        yield from self.runner.setup()
+        yield from web.TCPSite(self.runner, host, port).start()
+        self.url = 'http://{}:{}{}?StartDate={{}}&EndDate={{}}'.format(host, port, PATH)
+
+    @asyncio.coroutine
+    def stop(self):
+        if self.runner is not None:
+            yield from self.runner.cleanup()
+            self.runner = None
+
+    def stats(self):
+        return {'requests': self.requests, 'errors': self.errors}
+
+
+class ServerThread:
+    """Run a FakeServer on its own event loop in a daemon thread, as a context manager."""
+
+    def __init__(self, server, host='127.0.0.1', port=None):
+        self.server = server
+        self.host = host
+        self.port = port
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.ready = threading.Event()
+        self.error = None
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.server.start(self.host, self.port))
+        except Exception as error:
+            self.error = error
+            self.ready.set()
+            self.loop.close()
+            return
+        self.ready.set()
+        self.loop.run_forever()
+        self.loop.run_until_complete(self.server.stop())
+        self.loop.close()
+
+    def start(self):
+        self.thread.start()
+        self.ready.wait()
+        if self.error is not None:
+            raise self.error
+        return self.server.url
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
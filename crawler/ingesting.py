@@ -0,0 +1,251 @@
+"""Ingesting -- turn raw API responses into storage rows and ledger marks.
+
+Everything here is plain, picklable functions so the same code runs on the
+crawler's event loop and in worker processes during a bulk re-ingest.
+"""
+
+import cgi
+import codecs
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+import json
+import logging
+from operator import itemgetter
+import time
+
+from crawler.caching import entry_window
+from crawler.planning import Window, parse_roc_date, window_dates
+from crawler.records import TradeBatch, finite_number
+from crawler.storage import DATE_COLUMN, LEDGER_DONE, BatchWriter, date_key
+
+LOGGER = logging.getLogger(__name__)
+
+
+def json_charset(content_type):
+    """Charset of a response holding JSON data, or None if it holds none.
+
+    The API labels its JSON as HTML or XML.
+    """
+    charset = 'utf-8'
+    if content_type:
+        content_type, pdict = cgi.parse_header(content_type)
+        charset = pdict.get('charset', charset)
+
+    if content_type in ('text/html', 'application/xml'):
+        return charset
+
+    return None
+
+
+def decode(content_type, body):
+    """Return the records in a response body, or None if it holds no JSON data.
+
+    Raises ValueError on a truncated or malformed body.
+    """
+    charset = json_charset(content_type)
+    if charset is None:
+        return None
+    return json.loads(body.decode(charset)) or []
+
+
+class RecordStream:
+    """Decode a JSON array of records incrementally, chunk by chunk.
+
+    `feed` returns the records a chunk completes, so only the text of one
+    unfinished record is ever buffered.  `close` raises ValueError if the
+    body ended before the array did.  A `null` body counts as no records,
+    as in `decode`.
+    """
+
+    START, FIRST, ITEM, SEPARATOR, END = range(5)
+    WHITESPACE = ' \t\n\r'
+
+    def __init__(self, charset='utf-8'):
+        self.decoder = codecs.getincrementaldecoder(charset)()
+        self.json = json.JSONDecoder()
+        self.buffer = ''
+        self.state = self.START
+
+    def feed(self, chunk, final=False):
+        text = self.buffer + self.decoder.decode(chunk, final)
+        records = []
+        pos = 0
+        while True:
+            while pos < len(text) and text[pos] in self.WHITESPACE:
+                pos += 1
+            if pos == len(text):
+                break
+            char = text[pos]
+            if self.state == self.START and char == '[':
+                self.state = self.FIRST
+                pos += 1
+            elif self.state in (self.FIRST, self.SEPARATOR) and char == ']':
+                self.state = self.END
+                pos += 1
+            elif self.state == self.SEPARATOR and char == ',':
+                self.state = self.ITEM
+                pos += 1
+            elif self.state in (self.START, self.FIRST, self.ITEM):
+                try:
+                    value, end = self.json.raw_decode(text, pos)
+                except ValueError:
+                    if final:
+                        raise
+                    break  # Wait for the rest of the value.
+                if end == len(text) and not final and not isinstance(value, (dict, list)):
+                    break  # A number may go on in the next chunk.
+                if self.state == self.START:
+                    if value is not None:
+                        raise ValueError('expected a JSON array, got {!r}'.format(type(value).__name__))
+                    self.state = self.END
+                else:
+                    records.append(value)
+                    self.state = self.SEPARATOR
+                pos = end
+            else:
+                raise ValueError('unexpected {!r} at offset {} of a JSON array'.format(char, pos))
+        self.buffer = text[pos:]
+        return records
+
+    def close(self):
+        """Finish decoding; return any last records."""
+        records = self.feed(b'', final=True)
+        if self.state != self.END:
+            raise ValueError('truncated JSON array')
+        return records
+
+
+def stream_decoder(content_type):
+    """A RecordStream for a response body, or None if it holds no JSON data."""
+    charset = json_charset(content_type)
+    return RecordStream(charset) if charset else None
+
+
+@lru_cache(maxsize=4096)
+def roc_date_key(text):
+    """Convert the API's ROC date string to the integer date stored in rows."""
+    return date_key(parse_roc_date(text))
+
+
+# API field names, in storage.COLUMNS order.
+ITEM_FIELDS = ('魚貨名稱', '品種代碼', '市場名稱', '上價', '下價', '中價', '平均價', '交易日期', '交易量')
+extract_fields = itemgetter(*ITEM_FIELDS)
+
+
+def item_to_row(item):
+    """Turn one decoded API record into a row in storage.COLUMNS order.
+
+    Raises ValueError if a field is missing or a price or volume is not
+    a finite, non-negative number.
+    """
+    try:
+        name, code, market, high, low, mid, avg, day, amount = extract_fields(item)
+    except (KeyError, TypeError):
+        raise ValueError('incomplete record {!r}'.format(item))
+    return (name, code, market, finite_number(high), finite_number(low), finite_number(mid),
+            finite_number(avg), roc_date_key(day), finite_number(amount))
+
+
+def window_marks(window, status, counts=None):
+    """Ledger entries for every date in `window`, with row counts keyed by date_key."""
+    counts = counts or {}
+    return [(day.isoformat(), status, counts.get(date_key(day), 0)) for day in window_dates(window)]
+
+
+class WindowRows:
+    """Turn records into the rows of one window, counting rows per date.
+
+    Invalid records are skipped and counted in `rejected`; `marks` logs a
+    warning for a window that had any, as its dates are still marked done.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self.low, self.high = date_key(window.start), date_key(window.end)
+        self.counts = Counter()
+        self.rejected = 0
+        self.first_error = None
+
+    def rows(self, records):
+        """Return the records' rows within the window as a TradeBatch."""
+        batch = TradeBatch()
+        for item in records:
+            try:
+                row = item_to_row(item)
+            except ValueError as error:
+                LOGGER.debug('skipping record in %r: %s', self.window, error)
+                self.rejected += 1
+                self.first_error = self.first_error or error
+                continue
+            if self.low <= row[DATE_COLUMN] <= self.high:
+                batch.append(row)
+        self.counts.update(batch.date)
+        return batch
+
+    def marks(self):
+        """Ledger marks recording every date of the window as done."""
+        if self.rejected:
+            LOGGER.warning('skipped %r invalid records in %r, the first: %s', self.rejected, self.window,
+                           self.first_error)
+        return window_marks(self.window, LEDGER_DONE, self.counts)
+
+
+def window_rows(records, window):
+    """Return the rows of `window` in `records` and the ledger marks recording them."""
+    clip = WindowRows(window)
+    rows = clip.rows(records)
+    return rows, clip.marks()
+
+
+def load_entry(cache, meta, start_date, end_date):
+    """Decode one cached response, clipped to [start_date, end_date].
+
+    Returns (rows, marks), or None if the entry cannot be used.
+    """
+    cached = entry_window(meta)
+    window = Window(max(cached.start, start_date), min(cached.end, end_date))
+    try:
+        records = decode(meta['content_type'], cache.load(meta))
+    except (OSError, ValueError, EOFError) as error:
+        LOGGER.error('could not load cached %r: %r', meta['url'], error)
+        return None
+    return window_rows(records or [], window)
+
+
+def _load_entry(args):
+    return load_entry(*args)
+
+
+def replay(cache, storage, start_date, end_date, processes=1, batch_size=5000):
+    """Re-ingest cached responses for [start_date, end_date] into `storage`.
+
+    Decoding and row normalization are fanned out over `processes` worker
+    processes; their results come back in fetch order and are written by
+    this process alone, so later fetches of the same dates still win.
+    """
+    t0 = time.time()
+    metas = [meta for meta in cache.entries(start_date, end_date) if meta['status'] == 200]
+    jobs = ((cache, meta, start_date, end_date) for meta in metas)
+    writer = BatchWriter(storage, batch_size=batch_size, max_delay=float('inf'))
+
+    executor = ProcessPoolExecutor(processes) if processes > 1 else None
+    try:
+        results = executor.map(_load_entry, jobs, chunksize=16) if executor else map(_load_entry, jobs)
+        for meta, result in zip(metas, results):
+            if result is None:
+                continue
+            rows, marks = result
+            writer.add(rows, marks)
+            LOGGER.debug('%r replayed (%r rows)', meta['url'], len(rows))
+        writer.close()
+    finally:
+        if executor:
+            executor.shutdown()
+
+    dt = time.time() - t0
+    print('replayed {} responses, {} rows in {:.3f} secs ({:.0f} rows/sec, {} processes)'.format(
+        len(metas), writer.num_rows, dt, writer.num_rows / dt if dt else 0, processes))
+    counts = storage.counts
+    print('rows inserted: {}, updated: {}, unchanged: {}'.format(
+        counts['inserted'], counts['updated'], counts['unchanged']))
@@ -0,0 +1,85 @@
+"""Metrics -- the crawler's statistics in the Prometheus text format.
+
+An Exposition collects counters, gauges and histograms and renders them
+as text; crawling.serve_metrics serves it over HTTP at scrape time, and
+`write_textfile` writes it atomically for node_exporter's textfile
+collector.
+"""
+
+import os
+
+PREFIX = 'aquatic_crawler_'
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Upper bounds in bytes for response sizes, 1 KiB to 64 MiB by powers of four.
+SIZE_BUCKETS = tuple(1024 * 4 ** i for i in range(9))
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, escape(value)) for name, value in sorted(labels.items())) + '}'
+
+
+class Exposition:
+    """Metric families rendered in the Prometheus text format.
+
+    Every name gets `prefix`, and every sample the constant `labels`.
+    Metric values are a number, or a list of (labels, number) pairs for a
+    family with several series.
+    """
+
+    def __init__(self, prefix=PREFIX, labels=None):
+        self.prefix = prefix
+        self.labels = labels or {}
+        self.lines = []
+
+    def family(self, name, kind, help_text):
+        self.lines.append('# HELP {}{} {}'.format(self.prefix, name, help_text.replace('\n', ' ')))
+        self.lines.append('# TYPE {}{} {}'.format(self.prefix, name, kind))
+
+    def sample(self, name, value, labels=None):
+        labels = dict(self.labels, **labels) if labels else self.labels
+        self.lines.append('{}{}{} {}'.format(self.prefix, name, format_labels(labels), format_value(value)))
+
+    def series(self, name, kind, help_text, value):
+        self.family(name, kind, help_text)
+        for labels, number in value if isinstance(value, list) else [({}, value)]:
+            self.sample(name, number, labels)
+
+    def counter(self, name, help_text, value):
+        self.series(name, 'counter', help_text, value)
+
+    def gauge(self, name, help_text, value):
+        self.series(name, 'gauge', help_text, value)
+
+    def histogram(self, name, help_text, histograms):
+        """A family of reporting.Histogram objects, given as (labels, histogram) pairs."""
+        self.family(name, 'histogram', help_text)
+        for labels, histogram in histograms:
+            for bound, count in histogram.cumulative():
+                self.sample(name + '_bucket', count, dict(labels, le=format_value(float(bound))))
+            self.sample(name + '_sum', histogram.sum, labels)
+            self.sample(name + '_count', histogram.count, labels)
+
+    def text(self):
+        return '\n'.join(self.lines) + '\n'
+
+
+def write_textfile(path, text):
+    """Replace `path` with `text` at once, so a collector never reads half a file."""
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(path + '.tmp', path)
@@ -0,0 +1,139 @@
+"""Request planning -- group crawl dates into adaptive multi-day windows."""
+
+from collections import namedtuple
+from datetime import date, timedelta
+from itertools import chain
+import logging
+
+LOGGER = logging.getLogger(__name__)
+
+# An inclusive span of consecutive dates fetched with a single request.
+Window = namedtuple('Window', ['start', 'end'])
+
+# Crawl orders: oldest or newest date first, or dates missing from the
+# ledger first (newest first), then the ones already fetched.
+ORDERS = ('oldest', 'newest', 'gaps')
+
+
+def roc_date(date):
+    """Format a date the way the COA API expects it, e.g. 2009-01-05 -> '0980105'."""
+    roc_year = date.year - 1911
+    return '{:03d}{}'.format(roc_year, date.strftime('%m%d'))
+
+
+def parse_roc_date(text):
+    """Parse an API date such as '1070102' or '107.01.02' back into a date."""
+    digits = ''.join(c for c in str(text) if c.isdigit())
+    return date(int(digits[:-4]) + 1911, int(digits[-4:-2]), int(digits[-2:]))
+
+
+def window_days(window):
+    return (window.end - window.start).days + 1
+
+
+def window_dates(window):
+    return [window.start + timedelta(days=i) for i in range(window_days(window))]
+
+
+def date_range(start, end, newest_first=False):
+    """Lazily yield the days from `start` to `end` inclusive."""
+    step = timedelta(days=-1 if newest_first else 1)
+    day = end if newest_first else start
+    while start <= day <= end:
+        yield day
+        day += step
+
+
+def order_key(day, order, done=frozenset()):
+    """Sort key putting `day` in crawl `order`; `done` holds the dates already fetched."""
+    if order == 'newest':
+        return -day.toordinal()
+    if order == 'gaps':
+        return day in done, -day.toordinal()
+    return day.toordinal()
+
+
+def ordered_dates(start, end, order='oldest', done=frozenset(), skip_done=False):
+    """Lazily yield the days from `start` to `end` in crawl `order`.
+
+    Days in `done` are left out with `skip_done`; either way only the
+    current position in the range is kept in memory.
+    """
+    newest_first = order != 'oldest'
+    if order == 'gaps':
+        missing = (day for day in date_range(start, end, newest_first) if day not in done)
+        fetched = () if skip_done else (day for day in date_range(start, end, newest_first) if day in done)
+        return chain(missing, fetched)
+    days = date_range(start, end, newest_first)
+    if skip_done:
+        days = (day for day in days if day not in done)
+    return days
+
+
+def bisect(window):
+    """Split a window into two halves, or return None for a single day."""
+    days = window_days(window)
+    if days < 2:
+        return None
+    middle = window.start + timedelta(days=days // 2 - 1)
+    return Window(window.start, middle), Window(middle + timedelta(days=1), window.end)
+
+
+class RangePlanner:
+    """Hand out request windows over a set of dates, sized by feedback.
+
+    Windows never span a gap in the dates, so skipping dates simply cuts
+    the run in two.  Dates are taken lazily in the order given, which may
+    be newest first.  The window size grows while responses stay small and
+    shrinks when they get large; a window that fails outright is bisected
+    by the caller via `bisect`.
+    """
+
+    def __init__(self, dates, days=7, min_days=1, max_days=31,
+                 target_bytes=2 * 1024 * 1024, max_bytes=8 * 1024 * 1024):
+        self.days = max(min_days, min(days, max_days))
+        self.min_days = min_days
+        self.max_days = max_days
+        self.target_bytes = target_bytes
+        self.max_bytes = max_bytes
+
+        self._dates = iter(dates)
+        self._next = None
+
+    def next_window(self):
+        """Return the next window to request, or None when all dates are planned.
+
+        Takes at most `days` dates, plus one to see where a run of
+        consecutive days ends; that one starts the next window.
+        """
+        first = last = self._next or next(self._dates, None)
+        self._next = None
+        if first is None:
+            return None
+        for _ in range(self.days - 1):
+            day = next(self._dates, None)
+            if day is None:
+                break
+            if abs(day - last) != timedelta(days=1):
+                self._next = day
+                break
+            last = day
+        return Window(min(first, last), max(first, last))
+
+    def too_large(self, size):
+        return size > self.max_bytes
+
+    def feedback(self, window, size):
+        """Adjust the window size after a successful response of `size` bytes."""
+        days = window_days(window)
+        if size > self.target_bytes and self.days > self.min_days:
+            self.days = max(self.min_days, min(self.days, days) // 2)
+            LOGGER.debug('window shrunk to %r days', self.days)
+        elif size < self.target_bytes // 2 and days >= self.days and self.days < self.max_days:
+            self.days = min(self.max_days, self.days * 2)
+            LOGGER.debug('window grown to %r days', self.days)
+
+    def failed(self, window):
+        """Shrink future windows after `window` failed and return its halves."""
+        self.days = max(self.min_days, min(self.days, window_days(window)) // 2)
+        return bisect(window)
@@ -0,0 +1,94 @@
+"""Profiling -- cProfile and slow callback detection for crawler runs.
+
+A Profiler runs a block of code under cProfile; at exit it prints the
+hottest functions and dumps the raw statistics for pstats or snakeviz.
+`watch_loop` puts an event loop in debug mode, where asyncio warns about
+every callback or coroutine step that blocks the loop longer than the
+threshold; those warnings are also tallied for the report.
+
+cProfile only sees the thread it was started in: the database writer
+thread and worker processes show up as time spent waiting on them.
+"""
+
+from collections import defaultdict
+import cProfile
+import logging
+import pstats
+import re
+import sys
+
+SORT_KEYS = ('cumulative', 'tottime', 'ncalls')
+
+# Object addresses make every instance of the same callback look different.
+ADDRESS_RE = re.compile(r' at 0x[0-9a-fA-F]+')
+
+
+class SlowCallbacks(logging.Handler):
+    """Tally asyncio's 'Executing <callback> took N seconds' warnings by callback."""
+
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.calls = defaultdict(list)
+
+    def emit(self, record):
+        try:
+            if (isinstance(record.msg, str) and record.msg.startswith('Executing ') and
+                    isinstance(record.args, tuple) and len(record.args) == 2):
+                callback, secs = record.args
+                self.calls[ADDRESS_RE.sub('', str(callback))].append(float(secs))
+        except Exception:
+            self.handleError(record)
+
+    def summary(self, limit=10):
+        if not self.calls:
+            return 'slow callbacks: none'
+        ranked = sorted(self.calls.items(), key=lambda item: sum(item[1]), reverse=True)
+        lines = ['slow callbacks: {} calls blocked the loop for {:.3f} secs in total (count, total, max):'.format(
+            sum(len(secs) for secs in self.calls.values()), sum(sum(secs) for secs in self.calls.values()))]
+        for callback, secs in ranked[:limit]:
+            lines.append('  {:>5} {:>8.3f}s {:>7.3f}s  {}'.format(len(secs), sum(secs), max(secs), callback))
+        return '\n'.join(lines)
+
+
+class Profiler:
+    """Profile a `with` block; report the `limit` hottest functions by `sort` and dump them to `path`."""
+
+    def __init__(self, path, sort='cumulative', limit=30, slow_callback=0.1, out=None):
+        self.path = path
+        self.sort = sort
+        self.limit = limit
+        self.slow_callback = slow_callback
+        self.out = out or sys.stdout
+        self.profile = cProfile.Profile()
+        self.slow = None
+
+    def watch_loop(self, loop):
+        """Log and tally every step of `loop` that runs longer than `slow_callback` seconds."""
+        loop.set_debug(True)
+        loop.slow_callback_duration = self.slow_callback
+        if self.slow is None:
+            self.slow = SlowCallbacks()
+            logger = logging.getLogger('asyncio')
+            logger.addHandler(self.slow)
+            if logger.getEffectiveLevel() > logging.WARNING:
+                logger.setLevel(logging.WARNING)
+
+    def __enter__(self):
+        self.profile.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profile.disable()
+        if self.slow is not None:
+            logging.getLogger('asyncio').removeHandler(self.slow)
+        self.report()
+
+    def report(self):
+        print('\nhottest functions by {}:'.format(self.sort), file=self.out)
+        stats = pstats.Stats(self.profile, stream=self.out)
+        stats.sort_stats(self.sort).print_stats(self.limit)
+        if self.slow is not None:
+            print(self.slow.summary(), file=self.out)
+        if self.path:
+            stats.dump_stats(self.path)
+            print('profile written to {} (python -m pstats {})'.format(self.path, self.path), file=self.out)
@@ -0,0 +1,81 @@
+"""Records -- compact, column-oriented buffers of trade rows.
+
+A TradeBatch holds rows as columns instead of tuples: prices and volumes
+in `array('d')`, dates in `array('l')`, and species and market names as
+interned strings shared by every row that mentions them.  A buffered row
+then costs a few machine words instead of a tuple of nine objects.
+Iterating a batch yields ordinary row tuples in storage.COLUMNS order, so
+every storage accepts one wherever it accepts a list of rows.
+"""
+
+from array import array
+import math
+import sys
+
+
+def finite_number(value):
+    """Return `value` as a float, or raise ValueError unless it is a finite, non-negative number."""
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        raise ValueError('invalid number {!r}'.format(value))
+    if not math.isfinite(number) or number < 0:
+        raise ValueError('invalid number {!r}'.format(value))
+    return number
+
+
+def intern_text(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class TradeBatch:
+    """Trade rows stored column by column."""
+
+    # In storage.COLUMNS order.
+    __slots__ = ('type_name', 'type_code', 'market_name', 'high_price', 'low_price',
+                 'mid_price', 'avg_price', 'date', 'trans_amount')
+
+    def __init__(self, rows=()):
+        self.type_name = []
+        self.type_code = []
+        self.market_name = []
+        self.high_price = array('d')
+        self.low_price = array('d')
+        self.mid_price = array('d')
+        self.avg_price = array('d')
+        self.date = array('l')
+        self.trans_amount = array('d')
+        self.extend(rows)
+
+    def columns(self):
+        return [getattr(self, name) for name in self.__slots__]
+
+    def append(self, row):
+        type_name, type_code, market_name, high, low, mid, avg, date, amount = row
+        self.type_name.append(intern_text(type_name))
+        self.type_code.append(intern_text(type_code))
+        self.market_name.append(intern_text(market_name))
+        self.high_price.append(high)
+        self.low_price.append(low)
+        self.mid_price.append(mid)
+        self.avg_price.append(avg)
+        self.date.append(date)
+        self.trans_amount.append(amount)
+
+    def extend(self, rows):
+        if isinstance(rows, TradeBatch):
+            for column, other in zip(self.columns(), rows.columns()):
+                column.extend(other)
+        else:
+            for row in rows:
+                self.append(row)
+
+    def __len__(self):
+        return len(self.date)
+
+    def __iter__(self):
+        return zip(*self.columns())
+
+    def nbytes(self):
+        """Approximate memory held by the columns, not counting the shared strings."""
+        return sum(sys.getsizeof(column) for column in self.columns())
@@ -0,0 +1,176 @@
+"""Reporting -- latency percentiles and run statistics for the crawler."""
+
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+from datetime import timedelta
+import math
+import time
+
+# Upper bounds in seconds of the histogram buckets, from a cached DNS
+# lookup to a stalled transfer.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Pipeline stages in the order a window goes through them.  'dns' and
+# 'connect' only happen for new connections, 'connect' includes 'dns', and
+# 'ttfb' runs from sending a request to its response headers, including
+# any connect.  'write_wait' is time blocked on a full write queue and
+# 'db_write' one storage transaction, commit included.
+STAGES = ('fetch', 'dns', 'connect', 'ttfb', 'body', 'decode', 'write_wait', 'db_write')
+
+
+def percentile(values, p):
+    """The p-th percentile (0-100) of a sorted sequence, by nearest rank."""
+    if not values:
+        return None
+    rank = int(math.ceil(p / 100.0 * len(values)))
+    return values[max(0, min(rank, len(values)) - 1)]
+
+
+class LatencyTracker:
+    """Keep the most recent `size` latencies and answer percentile queries."""
+
+    def __init__(self, size=1000):
+        self.recent = deque(maxlen=size)
+        self.count = 0
+
+    def add(self, latency):
+        self.recent.append(latency)
+        self.count += 1
+
+    def percentile(self, p):
+        return percentile(sorted(self.recent), p)
+
+    def summary(self):
+        values = sorted(self.recent)
+        if not values:
+            return 'latency: no samples'
+        return 'latency: p50 {:.3f}s, p95 {:.3f}s, p99 {:.3f}s over the last {} requests'.format(
+            percentile(values, 50), percentile(values, 95), percentile(values, 99), len(values))
+
+
+class Histogram:
+    """Count observations into buckets with fixed upper `bounds`, plus one for the rest.
+
+    Memory stays constant however many values are observed; percentiles
+    are the upper bound of the bucket holding them, or the largest value
+    seen if that is smaller.
+    """
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else None
+
+    def percentile(self, p):
+        if not self.count:
+            return None
+        rank = max(1, int(math.ceil(p / 100.0 * self.count)))
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def cumulative(self):
+        """(upper bound, observations up to it) pairs, ending with infinity."""
+        total = 0
+        pairs = []
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            total += count
+            pairs.append((bound, total))
+        return pairs
+
+    def as_dict(self):
+        return {'count': self.count, 'sum': self.sum, 'mean': self.mean, 'max': self.max,
+                'p50': self.percentile(50), 'p95': self.percentile(95), 'p99': self.percentile(99)}
+
+
+class StageTimings:
+    """A latency histogram per pipeline stage (see STAGES)."""
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.stages = {}
+
+    def histogram(self, stage):
+        try:
+            return self.stages[stage]
+        except KeyError:
+            histogram = self.stages[stage] = Histogram(self.bounds)
+            return histogram
+
+    def observe(self, stage, secs):
+        self.histogram(stage).observe(secs)
+
+    @contextmanager
+    def span(self, stage):
+        """Time the body of a `with` block, even one that yields to the event loop."""
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - t0)
+
+    def ordered(self):
+        """(stage, histogram) pairs of the stages seen, in pipeline order."""
+        order = {stage: i for i, stage in enumerate(STAGES)}
+        return sorted(self.stages.items(), key=lambda item: (order.get(item[0], len(order)), item[0]))
+
+    def summary(self):
+        lines = ['stage timings (count, total, mean, p50, p95, p99, max):']
+        for stage, h in self.ordered():
+            lines.append('  {:<10} {:>7} {:>9.3f}s {:>8.4f}s {:>8.4f}s {:>8.4f}s {:>8.4f}s {:>8.4f}s'.format(
+                stage, h.count, h.sum, h.mean, h.percentile(50), h.percentile(95), h.percentile(99), h.max))
+        return '\n'.join(lines)
+
+    def as_dict(self):
+        return {stage: h.as_dict() for stage, h in self.ordered()}
+
+
+def format_secs(secs):
+    return str(timedelta(seconds=int(round(secs))))
+
+
+class Progress:
+    """Days and rows done out of `total_days`, with the rates and ETA they imply."""
+
+    def __init__(self, total_days, clock=time.time):
+        self.total_days = total_days
+        self.clock = clock
+        self.t0 = clock()
+        self.days = 0
+        self.rows = 0
+
+    def add(self, days, rows=0):
+        self.days += days
+        self.rows += rows
+
+    def elapsed(self):
+        return self.clock() - self.t0
+
+    def eta(self):
+        """Seconds left at the rate so far, or None before any day is done."""
+        if not self.days:
+            return None
+        return max(0, self.total_days - self.days) * self.elapsed() / self.days
+
+    def line(self):
+        elapsed = self.elapsed()
+        eta = self.eta()
+        return 'progress: {}/{} days ({:.1%}), {} rows, {:.0f} rows/sec, elapsed {}, ETA {}'.format(
+            self.days, self.total_days, self.days / self.total_days if self.total_days else 1, self.rows,
+            self.rows / elapsed if elapsed else 0, format_secs(elapsed), format_secs(eta) if eta is not None else '?')
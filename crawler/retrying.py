@@ -0,0 +1,118 @@
+"""Retrying -- backoff, retry budget and circuit breaker for API requests."""
+
+import logging
+import random
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+# Statuses worth retrying: the server is overloaded or briefly broken.
+RETRY_STATUSES = frozenset((429, 500, 502, 503, 504))
+
+
+def retry_after(headers):
+    """Seconds asked for by a Retry-After header, or None."""
+    try:
+        return max(0.0, float(headers.get('retry-after')))
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy:
+    """Exponential backoff with full jitter.
+
+    The n-th retry waits a random time up to `base * 2**n`, capped at `cap`
+    seconds, but never less than a server's Retry-After.
+    """
+
+    def __init__(self, base=0.5, cap=30.0, statuses=RETRY_STATUSES):
+        self.base = base
+        self.cap = cap
+        self.statuses = statuses
+
+    def retryable(self, status):
+        return status in self.statuses
+
+    def delay(self, retry, minimum=None):
+        delay = random.uniform(0, min(self.cap, self.base * 2 ** retry))
+        return max(delay, minimum or 0)
+
+
+class RetryBudget:
+    """Allow retries only up to a fraction of the requests made.
+
+    Every request deposits `ratio` tokens and every retry spends one, so
+    during an outage retries add at most `ratio` extra load instead of
+    multiplying it by `max_tries`.  `reserve` tokens are there from the start.
+    """
+
+    def __init__(self, ratio=0.2, reserve=10):
+        self.ratio = ratio
+        self.reserve = reserve
+        self.tokens = float(reserve)
+        self.spent = 0
+        self.denied = 0
+
+    def deposit(self):
+        self.tokens = min(self.tokens + self.ratio, self.reserve + 1000 * self.ratio)
+
+    def withdraw(self):
+        if self.tokens < 1:
+            self.denied += 1
+            return False
+        self.tokens -= 1
+        self.spent += 1
+        return True
+
+
+class CircuitBreaker:
+    """Stop all requests for a while after `threshold` failures in a row.
+
+    Once `cooldown` seconds have passed the breaker is half open: a single
+    probe request goes through while everybody else keeps waiting; its
+    success closes the breaker, its failure opens it again.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half open'
+
+    def __init__(self, threshold=5, cooldown=30.0, probe_interval=1.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.probe_interval = probe_interval
+
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_until = 0.0
+        self.probing = False
+        self.trips = 0
+
+    def delay(self):
+        """Seconds to wait before sending a request; 0 means go ahead."""
+        if self.state == self.CLOSED:
+            return 0
+        if self.state == self.OPEN:
+            remaining = self.opened_until - time.time()
+            if remaining > 0:
+                return remaining
+            self.state = self.HALF_OPEN
+            self.probing = False
+        if not self.probing:
+            self.probing = True
+            return 0
+        return self.probe_interval
+
+    def success(self):
+        self.failures = 0
+        if self.state != self.CLOSED:
+            LOGGER.warning('circuit closed, resuming requests')
+        self.state = self.CLOSED
+        self.probing = False
+
+    def failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.threshold):
+            self.state = self.OPEN
+            self.opened_until = time.time() + self.cooldown
+            self.probing = False
+            self.trips += 1
+            LOGGER.warning('%r failures in a row, pausing requests for %r secs', self.failures, self.cooldown)
@@ -0,0 +1,161 @@
+"""Rollups -- trade aggregates by day, week, month and year, kept in SQLite.
+
+Each grain has a table keyed by (period, species_id, market_id) holding
+sums that combine across periods: the number of trades, the volume, the
+value (avg_price * trans_amount), the sum of average prices and the
+lowest and highest price.  Averages and VWAPs are quotients of those sums;
+the rollup_<grain>_prices views compute them next to the species and
+market names.
+
+Periods are integers: YYYYMMDD for days, the YYYYMMDD of the Monday for
+weeks, YYYYMM for months and YYYY for years.  Trades are unique per day,
+species and market already, so rollup_day is a view over the trades
+table; weeks and months are aggregated from it and years from months.
+Both ways of keeping them current run in the caller's transaction, so a
+storage write and its rollups commit together: `add` adds the sums of
+newly inserted trades to their periods, and `update` deletes and
+re-inserts every period containing the given days, which also accounts
+for revised trades.
+"""
+
+from collections import namedtuple
+from datetime import date, timedelta
+import logging
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+DAY_SELECT = '''
+SELECT date AS period, species_id, market_id, 1 AS trades, trans_amount AS volume,
+       avg_price * trans_amount AS value, avg_price AS price_sum, low_price, high_price
+FROM trades'''
+
+DAY_SQL = 'CREATE VIEW IF NOT EXISTS rollup_day AS' + DAY_SELECT
+
+TABLE_SQL = '''
+CREATE TABLE IF NOT EXISTS rollup_{grain} (
+    period       INTEGER NOT NULL,
+    species_id   INTEGER NOT NULL,
+    market_id    INTEGER NOT NULL,
+    trades       INTEGER NOT NULL,
+    volume       REAL NOT NULL,
+    value        REAL NOT NULL,
+    price_sum    REAL NOT NULL,
+    low_price    REAL NOT NULL,
+    high_price   REAL NOT NULL,
+    PRIMARY KEY (period, species_id, market_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS rollup_{grain}_species ON rollup_{grain} (species_id, market_id, period);
+'''
+
+PRICES_SQL = '''
+CREATE VIEW IF NOT EXISTS rollup_{grain}_prices AS
+SELECT r.period, s.code AS type_code, s.name AS type_name, m.name AS market_name, r.trades,
+       r.volume AS trans_amount, r.price_sum / r.trades AS avg_price,
+       CASE WHEN r.volume > 0 THEN r.value / r.volume END AS vwap, r.low_price, r.high_price
+FROM rollup_{grain} r JOIN species s ON s.id = r.species_id JOIN markets m ON m.id = r.market_id;
+'''
+
+DROP_SQL = '''
+DROP VIEW IF EXISTS rollup_{grain}_prices;
+DROP {type} IF EXISTS rollup_{grain};
+'''
+
+SUMS = 'SUM(trades), SUM(volume), SUM(value), SUM(price_sum), MIN(low_price), MAX(high_price)'
+
+INSERT_SQL = '''
+INSERT INTO rollup_{grain}
+(period, species_id, market_id, trades, volume, value, price_sum, low_price, high_price)
+SELECT {period} AS p, species_id, market_id, {sums}
+FROM {source} {where}
+GROUP BY p, species_id, market_id'''
+
+ADD_SQL = INSERT_SQL + '''
+ON CONFLICT (period, species_id, market_id) DO UPDATE SET
+    trades = trades + excluded.trades, volume = volume + excluded.volume, value = value + excluded.value,
+    price_sum = price_sum + excluded.price_sum, low_price = min(low_price, excluded.low_price),
+    high_price = max(high_price, excluded.high_price)'''
+
+# Monday of the week of a YYYYMMDD `period`, as YYYYMMDD.
+WEEK_SQL = '''CAST(strftime('%Y%m%d', printf('%04d-%02d-%02d', period / 10000, period / 100 % 100, period % 100),
+                    'weekday 0', '-6 days') AS INTEGER)'''
+
+
+def key_to_date(key):
+    return date(key // 10000, key // 100 % 100, key % 100)
+
+
+def week_key(day):
+    """The YYYYMMDD key of the Monday starting the week of a YYYYMMDD day."""
+    monday = key_to_date(day) - timedelta(days=key_to_date(day).weekday())
+    return monday.year * 10000 + monday.month * 100 + monday.day
+
+
+def week_span(key):
+    sunday = key_to_date(key) + timedelta(days=6)
+    return key, sunday.year * 10000 + sunday.month * 100 + sunday.day
+
+
+# The stored grains, in the order they are computed.  `key` maps a day to
+# the grain's period, `span` a period to the range of source periods it
+# aggregates, and `period` does what `key` does, in SQL; `day_period` is
+# the same for a day, where the source is not rollup_day.
+Grain = namedtuple('Grain', 'name source period day_period key span')
+
+GRAINS = (
+    Grain('week', 'rollup_day', WEEK_SQL, WEEK_SQL, week_key, week_span),
+    Grain('month', 'rollup_day', 'period / 100', 'period / 100',
+          lambda day: day // 100, lambda key: (key * 100 + 1, key * 100 + 31)),
+    Grain('year', 'rollup_month', 'period / 100', 'period / 10000',
+          lambda day: day // 10000, lambda key: (key * 100 + 1, key * 100 + 12)),
+)
+GRAIN_NAMES = ('day',) + tuple(grain.name for grain in GRAINS)
+
+
+def insert_sql(grain, where=''):
+    return INSERT_SQL.format(grain=grain.name, period=grain.period, sums=SUMS, source=grain.source, where=where)
+
+
+def create(conn):
+    """Create the rollup tables and views; return True if they hold nothing yet."""
+    conn.executescript(DAY_SQL)
+    for grain in GRAINS:
+        conn.executescript(TABLE_SQL.format(grain=grain.name))
+    for name in GRAIN_NAMES:
+        conn.executescript(PRICES_SQL.format(grain=name))
+    return conn.execute('SELECT 1 FROM rollup_month LIMIT 1').fetchone() is None
+
+
+def drop(conn):
+    for name in GRAIN_NAMES:
+        conn.executescript(DROP_SQL.format(grain=name, type='VIEW' if name == 'day' else 'TABLE'))
+
+
+def add(conn, last_id):
+    """Add the trades with ids past `last_id`, all new, to the rollups."""
+    source = '({} WHERE id > ?)'.format(DAY_SELECT)
+    for grain in GRAINS:
+        sql = ADD_SQL.format(grain=grain.name, period=grain.day_period, sums=SUMS, source=source, where='')
+        conn.execute(sql, (last_id,))
+
+
+def update(conn, days):
+    """Recompute every period containing one of `days` (YYYYMMDD keys)."""
+    days = set(days)
+    for grain in GRAINS:
+        sql = insert_sql(grain, 'WHERE period BETWEEN ? AND ?')
+        for key in sorted({grain.key(day) for day in days}):
+            conn.execute('DELETE FROM rollup_{} WHERE period = ?'.format(grain.name), (key,))
+            conn.execute(sql, grain.span(key))
+
+
+def rebuild(conn):
+    """Recompute every rollup from the trades in one transaction; return the rows per grain."""
+    t0 = time.time()
+    counts = {}
+    with conn:
+        for grain in GRAINS:
+            conn.execute('DELETE FROM rollup_{}'.format(grain.name))
+            counts[grain.name] = conn.execute(insert_sql(grain)).rowcount
+    LOGGER.info('rebuilt rollups in %.3f secs: %r', time.time() - t0, counts)
+    return counts
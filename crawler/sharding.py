@@ -0,0 +1,79 @@
+"""Sharding -- split a crawl over processes and merge their staging databases.
+
+Each shard crawls its own contiguous run of dates into a private SQLite
+database, so worker processes never contend for the main store; the parent
+merges each staging database as soon as its shard has finished.
+"""
+
+import logging
+import os
+import sqlite3
+import time
+
+from crawler.storage import COLUMNS, BatchWriter, SQLiteStorage
+
+LOGGER = logging.getLogger(__name__)
+
+
+def shard_dates(dates, shards):
+    """Split a list of dates into at most `shards` contiguous, nearly equal lists."""
+    shards = max(1, min(shards, len(dates)))
+    size, extra = divmod(len(dates), shards)
+    result = []
+    start = 0
+    for i in range(shards):
+        end = start + size + (1 if i < extra else 0)
+        result.append(dates[start:end])
+        start = end
+    return [shard for shard in result if shard]
+
+
+def staging_path(directory, index):
+    return os.path.join(directory, 'shard-{:02d}.sqlite'.format(index))
+
+
+def copy_staging(storage, path, batch_size=5000):
+    """Write the rows and ledger of a staging database to any storage.
+
+    The ledger marks go with the last batch, so they are committed only
+    once all the shard's rows are.  Returns the number of rows copied.
+    """
+    staging = SQLiteStorage(path, rollups=False)
+    writer = BatchWriter(storage, batch_size=batch_size, max_delay=float('inf'))
+    try:
+        cursor = staging.conn.execute('SELECT {} FROM {table}'.format(', '.join(COLUMNS), **staging.names))
+        rows = cursor.fetchmany(batch_size)
+        while rows:
+            writer.add(rows)
+            rows = cursor.fetchmany(batch_size)
+        writer.add([], list(staging.conn.execute('SELECT date, status, row_count FROM {ledger}'.format(
+            **staging.names))))
+        writer.close()
+    finally:
+        staging.close()
+    return writer.num_rows
+
+
+def merge_shards(storage, paths, batch_size=5000):
+    """Merge staging databases into `storage`, in order; return (rows, secs).
+
+    A SQLite target attaches each staging database and merges it with a few
+    set-based statements; other storages get the rows in batches.
+    """
+    t0 = time.time()
+    rows = 0
+    for path in paths:
+        if not os.path.exists(path):
+            LOGGER.warning('no staging database at %r, skipping it', path)
+            continue
+        try:
+            if isinstance(storage, SQLiteStorage):
+                rows += storage.merge(path)
+            else:
+                rows += copy_staging(storage, path, batch_size)
+        except sqlite3.Error as error:
+            # A shard that died while creating its database leaves nothing to merge.
+            LOGGER.error('could not merge %r: %r', path, error)
+            continue
+        LOGGER.info('merged %r', path)
+    return rows, time.time() - t0
@@ -0,0 +1,564 @@
+"""Storage subsystem for the aquatic market crawler.
+
+A Storage receives rows and ledger marks in batches.  Each `write` call is
+one transaction: its rows and marks become visible together or not at all.
+Connections and files are opened lazily on first use, so constructing a
+storage (or importing this module) never touches the disk.
+"""
+
+from collections import Counter
+import csv
+from datetime import datetime
+import json
+import logging
+import os
+import sqlite3
+import time
+
+from crawler import rollups
+from crawler.records import TradeBatch
+
+LOGGER = logging.getLogger(__name__)
+
+DATABASE_PATH = 'tw-aquaculture-market-lab.sqlite'
+DATABASE_TABLE = 'aquatic_trans_'
+LEDGER_TABLE = 'crawl_ledger'
+INFO_TABLE = 'crawl_info'
+
+LEDGER_DONE = 'done'
+LEDGER_FAILED = 'failed'
+
+# Row layout shared by every storage, in the order of the tuples they receive;
+# `date` is a YYYYMMDD integer (see date_key).
+COLUMNS = ('type_name', 'type_code', 'market_name', 'high_price', 'low_price',
+           'mid_price', 'avg_price', 'date', 'trans_amount')
+DATE_COLUMN = COLUMNS.index('date')
+# Ledger mark layout: ISO date, status, number of rows for that date.
+LEDGER_COLUMNS = ('date', 'status', 'row_count', 'fetched_at')
+
+
+def parse_iso_date(text):
+    return datetime.strptime(text, '%Y-%m-%d').date()
+
+
+def date_key(date):
+    """Integer form of a date as stored in rows, e.g. 2018-01-02 -> 20180102."""
+    return date.year * 10000 + date.month * 100 + date.day
+
+
+def database_generation(conn):
+    """The token SQLiteStorage gives a database when it creates or resets its tables, or None.
+
+    Exports compare it to tell a reset and recrawled database from the one
+    they exported before, even if it holds as many trades again.
+    """
+    try:
+        row = conn.execute("SELECT value FROM {} WHERE key = 'generation'".format(INFO_TABLE)).fetchone()
+    except sqlite3.OperationalError:  # Written by a crawler without the info table.
+        return None
+    return row[0] if row else None
+
+
+def row_key(row):
+    """Natural key of a row: one price record per date, market and species."""
+    return row[DATE_COLUMN], row[2], row[1]
+
+
+class Storage:
+    """Interface of a crawl result sink.
+
+    `counts` tallies what writes did to each row: 'inserted', 'updated', or
+    'unchanged' when the same record was already stored.
+    """
+
+    def __init__(self):
+        self.counts = Counter()
+
+    def write(self, rows, marks=()):
+        """Store rows and ledger marks in one transaction."""
+        raise NotImplementedError
+
+    def completed_dates(self):
+        """Return the set of dates the ledger records as fetched successfully."""
+        return set()
+
+    def reset(self):
+        """Discard everything stored so far."""
+
+    def close(self):
+        """Release connections or files; the storage reopens them on next use."""
+
+
+class SQLiteStorage(Storage):
+    """Store rows in a normalized SQLite database tuned for bulk appends.
+
+    Species and markets live in dimension tables and trades refer to them
+    by integer id; dates are stored as YYYYMMDD integers.  A view named
+    after the old flat table keeps ad-hoc queries working, and a database
+    still holding that flat table is migrated when first opened.  A random
+    generation token (see database_generation) is replaced on every reset.
+
+    Trades are unique per (date, market, species) and written with an
+    upsert, so storing a re-fetched day only touches rows whose prices or
+    volume changed.  Unless `rollups` is false, every write also refreshes
+    the day, week, month and year aggregates (see crawler.rollups) of the
+    dates it stored; a database written without them needs rebuild_rollups.
+    """
+
+    default_path = DATABASE_PATH
+
+    TABLES_SQL = '''
+    CREATE TABLE IF NOT EXISTS species (
+        id           INTEGER NOT NULL PRIMARY KEY,
+        code         INTEGER NOT NULL UNIQUE,
+        name         TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS markets (
+        id           INTEGER NOT NULL PRIMARY KEY,
+        name         TEXT NOT NULL UNIQUE
+    );
+    CREATE TABLE IF NOT EXISTS trades (
+        id           INTEGER NOT NULL PRIMARY KEY,
+        species_id   INTEGER NOT NULL REFERENCES species (id),
+        market_id    INTEGER NOT NULL REFERENCES markets (id),
+        date         INTEGER NOT NULL,
+        high_price   REAL NOT NULL,
+        low_price    REAL NOT NULL,
+        mid_price    REAL NOT NULL,
+        avg_price    REAL NOT NULL,
+        trans_amount REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS trades_species_market_date
+        ON trades (species_id, market_id, date, avg_price, trans_amount);
+    CREATE INDEX IF NOT EXISTS trades_market_date
+        ON trades (market_id, date, species_id, avg_price, trans_amount);
+    CREATE TABLE IF NOT EXISTS {ledger} (
+        date         TEXT NOT NULL PRIMARY KEY,
+        status       TEXT NOT NULL,
+        row_count    INTEGER NOT NULL,
+        fetched_at   TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS {info} (
+        key          TEXT NOT NULL PRIMARY KEY,
+        value        TEXT NOT NULL
+    );
+    INSERT OR IGNORE INTO {info} (key, value) VALUES ('generation', lower(hex(randomblob(8))));
+    '''
+
+    VIEW_SQL = '''
+    CREATE VIEW IF NOT EXISTS {table} AS
+    SELECT t.id, s.name AS type_name, s.code AS type_code, m.name AS market_name,
+           t.high_price, t.low_price, t.mid_price, t.avg_price, t.date, t.trans_amount
+    FROM trades t JOIN species s ON s.id = t.species_id JOIN markets m ON m.id = t.market_id
+    '''
+
+    # Also serves lookups by date alone, being the leading column.
+    KEY_SQL = '''
+    CREATE UNIQUE INDEX trades_key ON trades (date, market_id, species_id)'''
+
+    # Drop all but the latest copy of each key, left by plain INSERTs.
+    DEDUPE_SQL = '''
+    DELETE FROM trades WHERE id NOT IN (SELECT MAX(id) FROM trades GROUP BY date, market_id, species_id)'''
+
+    UPSERT_SQL = '''
+    ON CONFLICT (date, market_id, species_id) DO UPDATE SET
+        high_price = excluded.high_price, low_price = excluded.low_price, mid_price = excluded.mid_price,
+        avg_price = excluded.avg_price, trans_amount = excluded.trans_amount
+    WHERE (high_price, low_price, mid_price, avg_price, trans_amount) <>
+          (excluded.high_price, excluded.low_price, excluded.mid_price, excluded.avg_price, excluded.trans_amount)'''
+
+    INSERT_SQL = '''
+    INSERT INTO trades
+    (species_id, market_id, date, high_price, low_price, mid_price, avg_price, trans_amount)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)''' + UPSERT_SQL
+
+    MARK_SQL = '''
+    INSERT OR REPLACE INTO {ledger}
+    (date, status, row_count, fetched_at)
+    VALUES (?, ?, ?, strftime('%Y-%m-%d %H:%M:%f', 'now'))'''
+
+    # Copy a pre-normalization flat table; its ROC date text ('1070102',
+    # sometimes with separators) becomes a YYYYMMDD integer.
+    MIGRATE_SQL = (
+        '''INSERT OR IGNORE INTO species (code, name)
+        SELECT type_code, MIN(type_name) FROM {table} GROUP BY type_code''',
+        '''INSERT OR IGNORE INTO markets (name)
+        SELECT DISTINCT market_name FROM {table}''',
+        '''INSERT OR REPLACE INTO trades
+        (species_id, market_id, date, high_price, low_price, mid_price, avg_price, trans_amount)
+        SELECT s.id, m.id,
+               (CAST(substr(o.d, 1, length(o.d) - 4) AS INTEGER) + 1911) * 10000 + CAST(substr(o.d, -4) AS INTEGER),
+               o.high_price, o.low_price, o.mid_price, o.avg_price, o.trans_amount
+        FROM (SELECT *, replace(replace(date, '.', ''), '/', '') AS d FROM {table}) o
+        JOIN species s ON s.code = o.type_code
+        JOIN markets m ON m.name = o.market_name
+        ORDER BY o.id''',
+        '''DROP TABLE {table}''',
+    )
+
+    # Copy another database of this layout attached as 'shard', mapping its
+    # dimension ids onto ours.  'WHERE 1' keeps the upsert clause from being
+    # parsed as a join constraint.
+    MERGE_SQL = (
+        '''INSERT OR IGNORE INTO main.species (code, name) SELECT code, name FROM shard.species''',
+        '''INSERT OR IGNORE INTO main.markets (name) SELECT name FROM shard.markets''',
+        '''INSERT INTO main.trades
+        (species_id, market_id, date, high_price, low_price, mid_price, avg_price, trans_amount)
+        SELECT s.id, m.id, t.date, t.high_price, t.low_price, t.mid_price, t.avg_price, t.trans_amount
+        FROM shard.trades t
+        JOIN shard.species ss ON ss.id = t.species_id JOIN main.species s ON s.code = ss.code
+        JOIN shard.markets sm ON sm.id = t.market_id JOIN main.markets m ON m.name = sm.name
+        WHERE 1''' + UPSERT_SQL,
+        '''INSERT OR REPLACE INTO main.{ledger} (date, status, row_count, fetched_at)
+        SELECT date, status, row_count, fetched_at FROM shard.{ledger}''',
+    )
+
+    # WAL lets readers run during a crawl; NORMAL sync only fsyncs at
+    # checkpoints, which is safe in WAL mode and much cheaper per commit.
+    PRAGMAS = (
+        'PRAGMA journal_mode = WAL',
+        'PRAGMA synchronous = NORMAL',
+        'PRAGMA temp_store = MEMORY',
+        'PRAGMA cache_size = -65536',
+        'PRAGMA mmap_size = 268435456',
+    )
+
+    def __init__(self, path=DATABASE_PATH, table=DATABASE_TABLE, ledger=LEDGER_TABLE, rollups=True):
+        super().__init__()
+        self.path = path
+        self.with_rollups = rollups
+        self.names = {'table': table, 'ledger': ledger, 'info': INFO_TABLE}
+        self.mark_sql = self.MARK_SQL.format(**self.names)
+        self.species_ids = {}
+        self.market_ids = {}
+        self._conn = None
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            # Opened on whichever thread writes first, then used by one thread at a time.
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            for pragma in self.PRAGMAS:
+                self._conn.execute(pragma)
+            self.setup()
+        return self._conn
+
+    def setup(self):
+        self._conn.executescript(self.TABLES_SQL.format(**self.names))
+        if self.has_object('table', self.names['table']):
+            self.migrate()
+        if not self.has_object('index', 'trades_key'):
+            with self._conn:
+                self._conn.execute(self.DEDUPE_SQL)
+                self._conn.execute(self.KEY_SQL)
+                self._conn.execute('DROP INDEX IF EXISTS trades_date')
+        self._conn.execute(self.VIEW_SQL.format(**self.names))
+        self._conn.commit()
+        self.load_dimensions()
+        if self.with_rollups and rollups.create(self._conn) and self.has_trades():
+            LOGGER.info('building rollups of %r', self.path)
+            rollups.rebuild(self._conn)
+
+    def has_trades(self):
+        return self._conn.execute('SELECT 1 FROM trades LIMIT 1').fetchone() is not None
+
+    def has_object(self, type_, name):
+        sql = 'SELECT 1 FROM sqlite_master WHERE type = ? AND name = ?'
+        return self._conn.execute(sql, (type_, name)).fetchone() is not None
+
+    def migrate(self):
+        """Move rows from the old flat table into the normalized tables."""
+        t0 = time.time()
+        with self._conn:
+            for sql in self.MIGRATE_SQL:
+                self._conn.execute(sql.format(**self.names))
+        LOGGER.info('migrated %r to normalized tables in %.3f secs', self.names['table'], time.time() - t0)
+
+    def load_dimensions(self):
+        self.species_ids = dict(self._conn.execute('SELECT code, id FROM species'))
+        self.market_ids = dict(self._conn.execute('SELECT name, id FROM markets'))
+
+    def species_id(self, code, name):
+        try:
+            return self.species_ids[code]
+        except KeyError:
+            self.conn.execute('INSERT OR IGNORE INTO species (code, name) VALUES (?, ?)', (code, name))
+            id_, = self.conn.execute('SELECT id FROM species WHERE code = ?', (code,)).fetchone()
+            self.species_ids[code] = id_
+            return id_
+
+    def market_id(self, name):
+        try:
+            return self.market_ids[name]
+        except KeyError:
+            self.conn.execute('INSERT OR IGNORE INTO markets (name) VALUES (?)', (name,))
+            id_, = self.conn.execute('SELECT id FROM markets WHERE name = ?', (name,)).fetchone()
+            self.market_ids[name] = id_
+            return id_
+
+    def encode(self, rows):
+        """Replace names with dimension ids, in INSERT_SQL parameter order."""
+        for type_name, type_code, market_name, high, low, mid, avg, date, amount in rows:
+            yield (self.species_id(type_code, type_name), self.market_id(market_name), date,
+                   high, low, mid, avg, amount)
+
+    def write(self, rows, marks=()):
+        try:
+            with self.conn:
+                last_id = self.conn.execute('SELECT MAX(id) FROM trades').fetchone()[0] or 0
+                changed = self.conn.executemany(self.INSERT_SQL, list(self.encode(rows))).rowcount
+                if marks:
+                    self.conn.executemany(self.mark_sql, marks)
+                # Upserted rows keep their id, so only new rows lie past the old maximum.
+                inserted = self.conn.execute('SELECT COUNT(*) FROM trades WHERE id > ?', (last_id,)).fetchone()[0]
+                if self.with_rollups and changed > inserted:
+                    rollups.update(self.conn, {row[DATE_COLUMN] for row in rows})
+                elif self.with_rollups and inserted:
+                    rollups.add(self.conn, last_id)
+        except Exception:
+            # Ids cached during the failed transaction were rolled back with it.
+            self.load_dimensions()
+            raise
+        self.counts.update(inserted=inserted, updated=max(changed, 0) - inserted,
+                           unchanged=len(rows) - max(changed, 0))
+
+    def merge(self, path):
+        """Upsert the trades and ledger of the database at `path` into this one.
+
+        The whole merge is one transaction.  Returns the number of trades read.
+        """
+        conn = self.conn
+        conn.execute('ATTACH DATABASE ? AS shard', (path,))
+        try:
+            with conn:
+                total = conn.execute('SELECT COUNT(*) FROM shard.trades').fetchone()[0]
+                last_id = conn.execute('SELECT MAX(id) FROM main.trades').fetchone()[0] or 0
+                conn.execute(self.MERGE_SQL[0])
+                conn.execute(self.MERGE_SQL[1])
+                changed = conn.execute(self.MERGE_SQL[2]).rowcount
+                conn.execute(self.MERGE_SQL[3].format(**self.names))
+                inserted = conn.execute('SELECT COUNT(*) FROM main.trades WHERE id > ?', (last_id,)).fetchone()[0]
+                if self.with_rollups and changed > inserted:
+                    rollups.update(conn, [row[0] for row in conn.execute('SELECT DISTINCT date FROM shard.trades')])
+                elif self.with_rollups and inserted:
+                    rollups.add(conn, last_id)
+        finally:
+            conn.execute('DETACH DATABASE shard')
+            self.load_dimensions()
+        self.counts.update(inserted=inserted, updated=max(changed, 0) - inserted,
+                           unchanged=total - max(changed, 0))
+        return total
+
+    def completed_dates(self):
+        sql = 'SELECT date FROM {ledger} WHERE status = ?'.format(**self.names)
+        return {parse_iso_date(row[0]) for row in self.conn.execute(sql, (LEDGER_DONE,))}
+
+    def rebuild_rollups(self):
+        """Recompute all rollups from the stored trades; return the rows per grain."""
+        return rollups.rebuild(self.conn)
+
+    def reset(self):
+        rollups.drop(self.conn)
+        self.conn.executescript('''
+        DROP VIEW IF EXISTS {table};
+        DROP TABLE IF EXISTS trades;
+        DROP TABLE IF EXISTS species;
+        DROP TABLE IF EXISTS markets;
+        DROP TABLE IF EXISTS {ledger};
+        DROP TABLE IF EXISTS {info};
+        '''.format(**self.names))
+        self.setup()
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+class FileStorage(Storage):
+    """Append rows to a text file, with the ledger in a '.ledger' file beside it.
+
+    Each `write` appends and flushes both files; no data is ever rewritten,
+    so unlike SQLiteStorage a re-fetched day is stored again.
+    """
+
+    default_path = None
+
+    def __init__(self, path=None):
+        super().__init__()
+        self.path = path or self.default_path
+        self.ledger_path = self.path + '.ledger'
+        self._files = None
+
+    @property
+    def files(self):
+        if self._files is None:
+            self._files = (open(self.path, 'a', encoding='utf-8', newline=''),
+                           open(self.ledger_path, 'a', encoding='utf-8', newline=''))
+        return self._files
+
+    def write(self, rows, marks=()):
+        data, ledger = self.files
+        now = datetime.now().isoformat(timespec='seconds')
+        self.append(data, COLUMNS, rows)
+        self.append(ledger, LEDGER_COLUMNS, [tuple(mark) + (now,) for mark in marks])
+        data.flush()
+        ledger.flush()
+        self.counts['inserted'] += len(rows)
+
+    def append(self, f, columns, records):
+        raise NotImplementedError
+
+    def read_ledger(self, f):
+        """Yield (date, status) pairs from an open ledger file."""
+        raise NotImplementedError
+
+    def completed_dates(self):
+        if not os.path.exists(self.ledger_path):
+            return set()
+        status = {}
+        with open(self.ledger_path, encoding='utf-8', newline='') as f:
+            # Later marks win, just like INSERT OR REPLACE in the SQLite ledger.
+            for date, value in self.read_ledger(f):
+                status[date] = value
+        return {parse_iso_date(date) for date, value in status.items() if value == LEDGER_DONE}
+
+    def reset(self):
+        self.close()
+        for path in (self.path, self.ledger_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def close(self):
+        if self._files is not None:
+            for f in self._files:
+                f.close()
+            self._files = None
+
+
+class CSVStorage(FileStorage):
+    """Append rows to a CSV file with a header line."""
+
+    default_path = 'aquatic_trans.csv'
+
+    def append(self, f, columns, records):
+        writer = csv.writer(f)
+        if f.tell() == 0:
+            writer.writerow(columns)
+        writer.writerows(records)
+
+    def read_ledger(self, f):
+        reader = csv.reader(f)
+        next(reader, None)
+        return ((mark[0], mark[1]) for mark in reader)
+
+
+class NDJSONStorage(FileStorage):
+    """Append rows as newline-delimited JSON objects."""
+
+    default_path = 'aquatic_trans.ndjson'
+
+    def append(self, f, columns, records):
+        f.writelines(json.dumps(dict(zip(columns, record)), ensure_ascii=False) + '\n' for record in records)
+
+    def read_ledger(self, f):
+        return ((mark['date'], mark['status']) for mark in map(json.loads, f))
+
+
+class MemoryStorage(Storage):
+    """Keep rows in a dict by row_key; useful for tests and throwaway runs."""
+
+    default_path = None
+
+    def __init__(self, path=None):
+        super().__init__()
+        self.trades = {}
+        self.ledger = {}
+
+    @property
+    def rows(self):
+        return list(self.trades.values())
+
+    def write(self, rows, marks=()):
+        for row in rows:
+            key = row_key(row)
+            old = self.trades.get(key)
+            self.counts['inserted' if old is None else 'unchanged' if old == row else 'updated'] += 1
+            self.trades[key] = row
+        for date, status, row_count in marks:
+            self.ledger[date] = (status, row_count)
+
+    def completed_dates(self):
+        return {parse_iso_date(date) for date, (status, _) in self.ledger.items() if status == LEDGER_DONE}
+
+    def reset(self):
+        self.trades = {}
+        self.ledger = {}
+
+
+STORAGES = {
+    'sqlite': SQLiteStorage,
+    'csv': CSVStorage,
+    'ndjson': NDJSONStorage,
+    'memory': MemoryStorage,
+}
+
+
+def open_storage(kind='sqlite', path=None):
+    """Create a storage by name, using its default path when none is given."""
+    cls = STORAGES[kind]
+    return cls(path or cls.default_path)
+
+
+class BatchWriter:
+    """Buffer rows and hand them to a storage in batches.
+
+    A batch is flushed once it holds `batch_size` rows or its oldest row is
+    `max_delay` seconds old, whichever comes first.  Each flush is a single
+    `Storage.write`, i.e. one transaction and one commit.
+
+    Marks added together with rows land in the same transaction as those
+    rows, so a ledger mark is never committed without its data and vice versa.
+    Rows wait in a column-oriented TradeBatch rather than as tuples.  With
+    `timings` (a reporting.StageTimings), each write is timed as 'db_write'.
+    """
+
+    def __init__(self, storage, batch_size=5000, max_delay=5.0, timings=None):
+        self.storage = storage
+        self.timings = timings
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+
+        self.rows = TradeBatch()
+        self.marks = []
+        self.t0 = None
+        self.num_rows = 0
+        self.num_batches = 0
+
+    def add(self, rows, marks=()):
+        if not rows and not marks:
+            return
+        if not self.rows and not self.marks:
+            self.t0 = time.time()
+        self.rows.extend(rows)
+        self.marks.extend(marks)
+        if len(self.rows) >= self.batch_size or time.time() - self.t0 >= self.max_delay:
+            self.flush()
+
+    def flush(self):
+        if not self.rows and not self.marks:
+            return
+        if self.timings:
+            with self.timings.span('db_write'):
+                self.storage.write(self.rows, self.marks)
+        else:
+            self.storage.write(self.rows, self.marks)
+        LOGGER.debug('wrote batch of %r rows', len(self.rows))
+        self.num_rows += len(self.rows)
+        self.num_batches += 1
+        self.rows = TradeBatch()
+        self.marks = []
+        self.t0 = None
+
+    def close(self):
+        self.flush()
@@ -0,0 +1,1095 @@
+import asyncio
+from contextlib import redirect_stdout
+from datetime import date, timedelta
+import json
+import io
+import logging
+import os
+import pstats
+import shutil
+import socket
+import sqlite3
+import tempfile
+import time
+import unittest
+import urllib.error
+import urllib.request
+
+from crawler.caching import ResponseCache
+from crawler.fakemarket import FakeMarket
+from crawler.ingesting import RecordStream, WindowRows, decode, item_to_row, replay, stream_decoder, window_rows
+from crawler.metrics import CONTENT_TYPE, Exposition, write_textfile
+from crawler.planning import (RangePlanner, Window, bisect, order_key, ordered_dates, parse_roc_date, roc_date,
+                              window_dates)
+from crawler.records import TradeBatch, finite_number
+from crawler.profiling import Profiler, SlowCallbacks
+from crawler.reporting import Histogram, LatencyTracker, Progress, StageTimings, percentile
+from crawler.retrying import CircuitBreaker, RetryBudget, RetryPolicy, retry_after
+from crawler.rollups import GRAIN_NAMES, week_key
+from crawler.sharding import merge_shards, shard_dates, staging_path
+from crawler.storage import (COLUMNS, LEDGER_DONE, LEDGER_FAILED, BatchWriter, CSVStorage, MemoryStorage,
+                             NDJSONStorage, SQLiteStorage, date_key, open_storage)
+from crawler.throttling import AIMDController
+
+try:
+    from crawler import crawling, fakeserver
+except (ImportError, AttributeError):
+    # No aiohttp, or an asyncio without the coroutine decorator (Python 3.11+).
+    crawling = fakeserver = None
+
+
+def days(start, n):
+    return [start + timedelta(days=i) for i in range(n)]
+
+
+class TestPlanning(unittest.TestCase):
+
+    def test_roc_date(self):
+        self.assertEqual('0980105', roc_date(date(2009, 1, 5)))
+        self.assertEqual('1071231', roc_date(date(2018, 12, 31)))
+        self.assertEqual(date(2009, 1, 5), parse_roc_date('0980105'))
+        self.assertEqual(date(2018, 12, 31), parse_roc_date('107.12.31'))
+
+    def test_ordered_dates(self):
+        start, end = date(2018, 1, 1), date(2018, 1, 5)
+        done = {date(2018, 1, 2), date(2018, 1, 4)}
+        self.assertEqual(days(start, 5), list(ordered_dates(start, end)))
+        self.assertEqual(days(start, 5)[::-1], list(ordered_dates(start, end, 'newest')))
+        self.assertEqual([5, 3, 1, 4, 2], [day.day for day in ordered_dates(start, end, 'gaps', done)])
+        self.assertEqual([5, 3, 1], [day.day for day in ordered_dates(start, end, 'gaps', done, skip_done=True)])
+        self.assertEqual([1, 3, 5], [day.day for day in ordered_dates(start, end, 'oldest', done, skip_done=True)])
+        for order in ('oldest', 'newest', 'gaps'):
+            self.assertEqual(list(ordered_dates(start, end, order, done)),
+                             sorted(days(start, 5), key=lambda day: order_key(day, order, done)))
+
+    def test_newest_first_windows(self):
+        planner = RangePlanner(ordered_dates(date(2018, 1, 1), date(2018, 1, 10), 'newest'), days=4)
+        self.assertEqual(Window(date(2018, 1, 7), date(2018, 1, 10)), planner.next_window())
+        self.assertEqual(Window(date(2018, 1, 3), date(2018, 1, 6)), planner.next_window())
+        self.assertEqual(Window(date(2018, 1, 1), date(2018, 1, 2)), planner.next_window())
+        self.assertIsNone(planner.next_window())
+
+    def test_bisect(self):
+        window = Window(date(2018, 1, 1), date(2018, 1, 5))
+        self.assertEqual((Window(date(2018, 1, 1), date(2018, 1, 2)),
+                          Window(date(2018, 1, 3), date(2018, 1, 5))), bisect(window))
+        self.assertIsNone(bisect(Window(date(2018, 1, 1), date(2018, 1, 1))))
+        self.assertEqual(days(date(2018, 1, 1), 5), window_dates(window))
+
+    def test_windows_cover_dates(self):
+        dates = days(date(2018, 1, 1), 10) + days(date(2018, 2, 1), 3)
+        planner = RangePlanner(dates, days=4)
+        windows = []
+        while True:
+            window = planner.next_window()
+            if window is None:
+                break
+            windows.append(window)
+        self.assertEqual([Window(date(2018, 1, 1), date(2018, 1, 4)),
+                          Window(date(2018, 1, 5), date(2018, 1, 8)),
+                          Window(date(2018, 1, 9), date(2018, 1, 10)),
+                          Window(date(2018, 2, 1), date(2018, 2, 3))], windows)
+
+    def test_lazy_windows(self):
+        dates = ordered_dates(date(2009, 1, 1), date(2018, 12, 31))
+        taken = []
+        planner = RangePlanner((taken.append(day) or day for day in dates), days=7)
+        self.assertEqual(Window(date(2009, 1, 1), date(2009, 1, 7)), planner.next_window())
+        self.assertEqual(7, len(taken))
+        del taken[:]
+        dates = days(date(2018, 1, 1), 3) + days(date(2018, 2, 1), 9)
+        planner = RangePlanner((taken.append(day) or day for day in dates), days=7)
+        self.assertEqual(Window(date(2018, 1, 1), date(2018, 1, 3)), planner.next_window())
+        self.assertEqual(4, len(taken))
+        self.assertEqual(Window(date(2018, 2, 1), date(2018, 2, 7)), planner.next_window())
+        self.assertEqual(10, len(taken))
+
+    def test_feedback(self):
+        planner = RangePlanner(days(date(2018, 1, 1), 100), days=4, max_days=16,
+                               target_bytes=1000, max_bytes=4000)
+        window = planner.next_window()
+        planner.feedback(window, 100)
+        self.assertEqual(8, planner.days)
+        planner.feedback(planner.next_window(), 2000)
+        self.assertEqual(4, planner.days)
+        self.assertTrue(planner.too_large(5000))
+
+    def test_failed(self):
+        planner = RangePlanner(days(date(2018, 1, 1), 8), days=8)
+        halves = planner.failed(planner.next_window())
+        self.assertEqual(2, len(halves))
+        self.assertEqual(4, planner.days)
+
+
+ROW = ('吳郭魚', 1011, '台北', 60.0, 40.0, 50.0, 50.0, 20180102, 1200.0)
+
+
+def make_row(day, market='台北', avg_price=50.0, code=1011, amount=1200.0):
+    """A row like ROW; `day` is a date, or a day of January 2018."""
+    key = date_key(day) if isinstance(day, date) else 20180100 + day
+    return ROW[:1] + (code, market) + ROW[3:6] + (avg_price, key, amount)
+
+
+class TestTradeBatch(unittest.TestCase):
+
+    def test_round_trip(self):
+        rows = [make_row(1), make_row(2, '高雄', 55.0)]
+        batch = TradeBatch(rows)
+        self.assertEqual(COLUMNS, TradeBatch.__slots__)
+        self.assertEqual(2, len(batch))
+        self.assertEqual(rows, list(batch))
+        batch.extend(TradeBatch([make_row(3)]))
+        self.assertEqual([20180101, 20180102, 20180103], list(batch.date))
+        self.assertFalse(TradeBatch())
+
+    def test_interned_names(self):
+        batch = TradeBatch([make_row(1, ''.join(['台', '北'])), make_row(2, ''.join(['台', '北']))])
+        self.assertIs(batch.market_name[0], batch.market_name[1])
+
+    def test_finite_number(self):
+        self.assertEqual(12.5, finite_number('12.5'))
+        for value in ('abc', None, float('nan'), float('inf'), -1):
+            self.assertRaises(ValueError, finite_number, value)
+
+
+class TestBatchWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.storage = MemoryStorage()
+
+    def test_flush_by_size(self):
+        writer = BatchWriter(self.storage, batch_size=3, max_delay=60)
+        writer.add([make_row(1), make_row(2)])
+        self.assertEqual(0, len(self.storage.rows))
+        writer.add([make_row(3)])
+        self.assertEqual(3, len(self.storage.rows))
+        self.assertEqual(1, writer.num_batches)
+
+    def test_flush_by_age(self):
+        writer = BatchWriter(self.storage, batch_size=100, max_delay=0)
+        writer.add([make_row(1)])
+        self.assertEqual(1, len(self.storage.rows))
+
+    def test_close_flushes(self):
+        writer = BatchWriter(self.storage, batch_size=100, max_delay=60)
+        writer.add([make_row(1)])
+        writer.close()
+        self.assertEqual(1, len(self.storage.rows))
+        self.assertEqual(1, writer.num_rows)
+
+    def test_marks_commit_with_rows(self):
+        writer = BatchWriter(self.storage, batch_size=2, max_delay=60)
+        writer.add([make_row(1)], [('2018-01-01', LEDGER_DONE, 1)])
+        self.assertEqual({}, self.storage.ledger)
+        writer.add([], [('2018-01-02', LEDGER_DONE, 0)])
+        writer.add([make_row(3)], [('2018-01-03', LEDGER_FAILED, 0)])
+        self.assertEqual(2, len(self.storage.rows))
+        self.assertEqual({date(2018, 1, 1), date(2018, 1, 2)}, self.storage.completed_dates())
+
+
+class TestStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+
+    def check_storage(self, storage):
+        self.addCleanup(storage.close)
+        storage.write([ROW], [('2018-01-02', LEDGER_DONE, 1), ('2018-01-03', LEDGER_FAILED, 0)])
+        storage.write([], [('2018-01-03', LEDGER_DONE, 0)])
+        storage.close()
+        self.assertEqual({date(2018, 1, 2), date(2018, 1, 3)}, storage.completed_dates())
+        storage.reset()
+        self.assertEqual(set(), storage.completed_dates())
+
+    def test_sqlite(self):
+        path = os.path.join(self.tmp, 'test.sqlite')
+        storage = SQLiteStorage(path)
+        self.assertFalse(os.path.exists(path))
+        self.check_storage(storage)
+        self.assertEqual('wal', storage.conn.execute('PRAGMA journal_mode').fetchone()[0])
+
+    def test_sqlite_view(self):
+        storage = SQLiteStorage(os.path.join(self.tmp, 'test.sqlite'))
+        self.addCleanup(storage.close)
+        storage.write([ROW, ROW[:2] + ('高雄',) + ROW[3:]])
+        self.assertEqual([ROW[:7] + (20180102, 1200.0)],
+                         list(storage.conn.execute('SELECT type_name, type_code, market_name, high_price, low_price, '
+                                                   'mid_price, avg_price, date, trans_amount FROM aquatic_trans_ '
+                                                   "WHERE market_name = '台北'")))
+        self.assertEqual(1, storage.conn.execute('SELECT COUNT(*) FROM species').fetchone()[0])
+        self.assertEqual(2, storage.conn.execute('SELECT COUNT(*) FROM markets').fetchone()[0])
+
+    def check_upsert(self, storage):
+        storage.write([make_row(1), make_row(2)])
+        storage.write([make_row(1), make_row(2, avg_price=55.0), make_row(3)])
+        self.assertEqual({'inserted': 3, 'updated': 1, 'unchanged': 1}, dict(storage.counts))
+
+    def test_sqlite_upsert(self):
+        storage = SQLiteStorage(os.path.join(self.tmp, 'test.sqlite'))
+        self.addCleanup(storage.close)
+        self.check_upsert(storage)
+        self.assertEqual([(20180101, 50.0), (20180102, 55.0), (20180103, 50.0)],
+                         list(storage.conn.execute('SELECT date, avg_price FROM trades ORDER BY date')))
+
+    def test_memory_upsert(self):
+        storage = MemoryStorage()
+        self.check_upsert(storage)
+        self.assertEqual(3, len(storage.rows))
+
+    def test_sqlite_migration(self):
+        path = os.path.join(self.tmp, 'legacy.sqlite')
+        conn = sqlite3.connect(path)
+        conn.executescript('''
+        CREATE TABLE aquatic_trans_ (
+            id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT UNIQUE, type_name TEXT NOT NULL,
+            type_code INTEGER NOT NULL, market_name TEXT NOT NULL, high_price REAL NOT NULL,
+            low_price REAL NOT NULL, mid_price REAL NOT NULL, avg_price REAL NOT NULL,
+            date TEXT NOT NULL, trans_amount REAL NOT NULL);
+        INSERT INTO aquatic_trans_ VALUES (NULL, '吳郭魚', 1011, '台北', 60, 40, 50, 50, '1070102', 1200);
+        INSERT INTO aquatic_trans_ VALUES (NULL, '吳郭魚', 1011, '高雄', 60, 40, 50, 50, '0981231', 200);
+        INSERT INTO aquatic_trans_ VALUES (NULL, '吳郭魚', 1011, '高雄', 60, 40, 50, 50, '0981231', 300);
+        ''')
+        conn.commit()
+        conn.close()
+
+        storage = SQLiteStorage(path)
+        self.addCleanup(storage.close)
+        self.assertEqual([(20091231, 300.0), (20180102, 1200.0)],
+                         list(storage.conn.execute('SELECT date, trans_amount FROM aquatic_trans_ ORDER BY date')))
+        self.assertEqual('view', storage.conn.execute(
+            "SELECT type FROM sqlite_master WHERE name = 'aquatic_trans_'").fetchone()[0])
+
+    def test_csv(self):
+        self.check_storage(CSVStorage(os.path.join(self.tmp, 'test.csv')))
+
+    def test_ndjson(self):
+        storage = NDJSONStorage(os.path.join(self.tmp, 'test.ndjson'))
+        storage.write([ROW])
+        storage.close()
+        with open(storage.path, encoding='utf-8') as f:
+            self.assertEqual('台北', json.loads(f.readline())['market_name'])
+        self.check_storage(storage)
+
+    def test_memory(self):
+        self.check_storage(open_storage('memory'))
+
+
+class TestSharding(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+
+    def test_shard_dates(self):
+        dates = days(date(2018, 1, 1), 10)
+        shards = shard_dates(dates, 3)
+        self.assertEqual([4, 3, 3], [len(shard) for shard in shards])
+        self.assertEqual(dates, sum(shards, []))
+        self.assertEqual([dates[:1], dates[1:2]], shard_dates(dates[:2], 5))
+        self.assertEqual([], shard_dates([], 4))
+
+    def make_shards(self):
+        # Different markets first, so the shards give the same market different ids.
+        paths = [staging_path(self.tmp, i) for i in range(2)]
+        for path, market, days_ in ((paths[0], '高雄', (1, 2)), (paths[1], '台北', (2, 3))):
+            shard = SQLiteStorage(path)
+            shard.write([make_row(day, market) for day in days_] + [make_row(day, '台中') for day in days_],
+                        [('2018-01-0{}'.format(day), LEDGER_DONE, 2) for day in days_])
+            shard.close()
+        return paths
+
+    def test_merge_sqlite(self):
+        storage = SQLiteStorage(os.path.join(self.tmp, 'main.sqlite'))
+        self.addCleanup(storage.close)
+        storage.write([make_row(1, '台中', avg_price=40.0)])
+        rows, _ = merge_shards(storage, self.make_shards())
+        self.assertEqual(8, rows)
+        self.assertEqual({'inserted': 7, 'updated': 1, 'unchanged': 1}, dict(storage.counts))
+        self.assertEqual([(20180101, '台中', 50.0), (20180101, '高雄', 50.0), (20180102, '台中', 50.0),
+                          (20180102, '台北', 50.0), (20180102, '高雄', 50.0), (20180103, '台中', 50.0),
+                          (20180103, '台北', 50.0)],
+                         list(storage.conn.execute('SELECT date, market_name, avg_price FROM aquatic_trans_ '
+                                                   'ORDER BY date, market_name')))
+        self.assertEqual(set(days(date(2018, 1, 1), 3)), storage.completed_dates())
+        self.assertNotIn('shard', [row[1] for row in storage.conn.execute('PRAGMA database_list')])
+
+    def test_merge_memory(self):
+        storage = MemoryStorage()
+        rows, _ = merge_shards(storage, self.make_shards() + [staging_path(self.tmp, 9)], batch_size=3)
+        self.assertEqual(8, rows)
+        self.assertEqual(7, len(storage.rows))
+        self.assertEqual(set(days(date(2018, 1, 1), 3)), storage.completed_dates())
+
+
+
+class TestRollups(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.path = os.path.join(self.tmp, 'test.sqlite')
+
+    def snapshot(self, storage):
+        return {grain: list(storage.conn.execute('SELECT * FROM rollup_{} ORDER BY 1, 2, 3'.format(grain)))
+                for grain in GRAIN_NAMES}
+
+    def test_week_key(self):
+        self.assertEqual([20171225, 20171225, 20180101, 20180101, 20200224],
+                         [week_key(day) for day in (20171225, 20171231, 20180101, 20180107, 20200301)])
+
+    def test_incremental(self):
+        storage = SQLiteStorage(self.path)
+        self.addCleanup(storage.close)
+        # 2017-12-31 is a Sunday, 2018-01-01 the Monday after.
+        storage.write([make_row(date(2017, 12, 31), avg_price=40.0), make_row(date(2018, 1, 1), avg_price=60.0, amount=300.0),
+                       make_row(date(2018, 1, 2)), make_row(date(2018, 1, 2), '高雄', 80.0)])
+        sql = "SELECT period, trades, trans_amount, avg_price, vwap FROM rollup_{}_prices WHERE market_name = '台北'"
+        self.assertEqual([(20171225, 1, 1200.0, 40.0, 40.0), (20180101, 2, 1500.0, 55.0, 52.0)],
+                         list(storage.conn.execute(sql.format('week') + ' ORDER BY period')))
+        self.assertEqual([(201712, 1, 1200.0, 40.0, 40.0), (201801, 2, 1500.0, 55.0, 52.0)],
+                         list(storage.conn.execute(sql.format('month') + ' ORDER BY period')))
+
+        # A revised price and a new month roll up to the year.
+        storage.write([make_row(date(2018, 1, 2), avg_price=20.0), make_row(date(2018, 2, 5), amount=0.0)])
+        self.assertEqual([(2017, 1, 1200.0, 40.0, 40.0), (2018, 3, 1500.0, 130.0 / 3, 28.0)],
+                         list(storage.conn.execute(sql.format('year') + ' ORDER BY period')))
+        self.assertEqual((1, None), storage.conn.execute(
+            'SELECT trades, vwap FROM rollup_month_prices WHERE period = 201802').fetchone())
+        incremental = self.snapshot(storage)
+        self.assertEqual({'week': 4, 'month': 4, 'year': 3}, storage.rebuild_rollups())
+        self.assertEqual(incremental, self.snapshot(storage))
+
+    def test_built_on_open(self):
+        storage = SQLiteStorage(self.path, rollups=False)
+        storage.write([make_row(date(2018, 1, 1)), make_row(date(2018, 1, 2))])
+        self.assertIsNone(storage.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'rollup_day'").fetchone())
+        storage.close()
+        storage = SQLiteStorage(self.path)
+        self.addCleanup(storage.close)
+        self.assertEqual([(201801, 2)], list(storage.conn.execute('SELECT period, trades FROM rollup_month')))
+
+    def test_merge(self):
+        shard = SQLiteStorage(os.path.join(self.tmp, 'shard.sqlite'), rollups=False)
+        shard.write([make_row(date(2018, 1, 2), avg_price=70.0), make_row(date(2018, 1, 3))])
+        shard.close()
+        storage = SQLiteStorage(self.path)
+        self.addCleanup(storage.close)
+        storage.write([make_row(date(2018, 1, 1)), make_row(date(2018, 1, 2))])
+        storage.merge(shard.path)
+        self.assertEqual([(201801, 3, 170.0)],
+                         list(storage.conn.execute('SELECT period, trades, price_sum FROM rollup_month')))
+        incremental = self.snapshot(storage)
+        storage.rebuild_rollups()
+        self.assertEqual(incremental, self.snapshot(storage))
+        storage.reset()
+        self.assertEqual([], list(storage.conn.execute('SELECT * FROM rollup_year')))
+
+
+class TestResponseCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+
+    def test_round_trip(self):
+        for compression in ('gzip', 'lzma'):
+            cache = ResponseCache(os.path.join(self.tmp, compression), compression)
+            body = json.dumps([{'市場名稱': '台北'}] * 100, ensure_ascii=False).encode('utf-8')
+            window = Window(date(2018, 1, 1), date(2018, 1, 7))
+            self.assertIsNone(cache.get('http://a/1'))
+            cache.put('http://a/1', body, window, content_type='text/html')
+            meta, cached = cache.get('http://a/1')
+            self.assertEqual(body, cached)
+            self.assertEqual('2018-01-07', meta['end'])
+            self.assertLess(meta['stored_size'], meta['size'])
+            self.assertEqual((1, 1), (cache.hits, cache.misses))
+
+    def test_entries(self):
+        cache = ResponseCache(self.tmp)
+        cache.put('http://a/1', b'[]', Window(date(2018, 1, 1), date(2018, 1, 7)))
+        cache.put('http://a/2', b'[]', Window(date(2018, 1, 8), date(2018, 1, 14)))
+        self.assertEqual(2, len(cache.entries()))
+        self.assertEqual(['http://a/2'], [meta['url'] for meta in cache.entries(date(2018, 1, 10))])
+        self.assertEqual([], cache.entries(date(2018, 2, 1), date(2018, 2, 2)))
+
+    def test_writer(self):
+        cache = ResponseCache(self.tmp, 'lzma')
+        window = Window(date(2018, 1, 1), date(2018, 1, 7))
+        writer = cache.writer('http://a/1', window, content_type='text/html')
+        writer.write(b'[1, ')
+        self.assertIsNone(cache.get('http://a/1'))
+        writer.write(b'2]')
+        writer.commit()
+        meta, body = cache.get('http://a/1')
+        self.assertEqual((b'[1, 2]', 6), (body, meta['size']))
+        writer = cache.writer('http://a/2', window)
+        writer.write(b'[')
+        writer.abort()
+        self.assertEqual(['http://a/1'], [meta['url'] for meta in cache.entries()])
+
+
+def make_item(day, market='台北', avg_price=50.0):
+    return {'魚貨名稱': '吳郭魚', '品種代碼': 1011, '市場名稱': market, '上價': 60.0, '下價': 40.0,
+            '中價': 50.0, '平均價': avg_price, '交易日期': roc_date(day), '交易量': 1200.0}
+
+
+def make_body(days, **kwargs):
+    return json.dumps([make_item(day, **kwargs) for day in days], ensure_ascii=False).encode('utf-8')
+
+
+class TestIngesting(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+
+    def test_decode(self):
+        body = make_body([date(2018, 1, 2)])
+        self.assertEqual(1, len(decode('text/html; charset=utf-8', body)))
+        self.assertIsNone(decode('image/png', body))
+        self.assertRaises(ValueError, decode, 'text/html', body[:-5])
+
+    def test_record_stream(self):
+        body = make_body(days(date(2018, 1, 1), 5))
+        for size in (1, 7, len(body)):
+            stream = stream_decoder('text/html; charset=utf-8')
+            records = []
+            for i in range(0, len(body), size):
+                records.extend(stream.feed(body[i:i + size]))
+                self.assertLess(len(stream.buffer), 200)
+            records.extend(stream.close())
+            self.assertEqual(json.loads(body.decode('utf-8')), records)
+        self.assertIsNone(stream_decoder('image/png'))
+
+    def test_record_stream_edge_cases(self):
+        stream = RecordStream()
+        # A number split across chunks is not cut short.
+        self.assertEqual([], stream.feed(b' [1'))
+        self.assertEqual([12], stream.feed(b'2,'))
+        self.assertEqual([3], stream.feed(b'3]') + stream.close())
+        for body in (b'[]', b'null', b' [ ] '):
+            stream = RecordStream()
+            self.assertEqual([], stream.feed(body) + stream.close())
+        for body in (b'[{"a": 1}', b'[{"a": 1}, ', b'{"a": 1}', b'[1 2]', b'[1], 2', b''):
+            stream = RecordStream()
+            with self.assertRaises(ValueError, msg=body):
+                stream.feed(body)
+                stream.close()
+
+    def test_window_rows(self):
+        window = Window(date(2018, 1, 1), date(2018, 1, 3))
+        records = [make_item(day) for day in days(date(2017, 12, 31), 3)]
+        rows, marks = window_rows(records, window)
+        self.assertEqual([20180101, 20180102], [row[7] for row in rows])
+        self.assertEqual([('2018-01-01', LEDGER_DONE, 1), ('2018-01-02', LEDGER_DONE, 1),
+                          ('2018-01-03', LEDGER_DONE, 0)], marks)
+
+    def test_item_to_row(self):
+        self.assertEqual(make_row(2)[:7] + (20180102, 1200.0), item_to_row(make_item(date(2018, 1, 2))))
+        item = make_item(date(2018, 1, 2))
+        del item['交易量']
+        self.assertRaises(ValueError, item_to_row, item)
+        self.assertRaises(ValueError, item_to_row, dict(make_item(date(2018, 1, 2)), 上價='n/a'))
+        self.assertRaises(ValueError, item_to_row, dict(make_item(date(2018, 1, 2)), 交易量=None))
+
+    def test_invalid_records_skipped(self):
+        clip = WindowRows(Window(date(2018, 1, 1), date(2018, 1, 3)))
+        records = [make_item(date(2018, 1, 1)), make_item(date(2018, 1, 2), avg_price=float('nan')),
+                   make_item(date(2018, 1, 3), avg_price=None)]
+        rows = clip.rows(records)
+        self.assertEqual((1, 2), (len(rows), clip.rejected))
+        with self.assertLogs('crawler.ingesting', 'WARNING') as logs:
+            self.assertEqual(('2018-01-01', LEDGER_DONE, 1), clip.marks()[0])
+        self.assertEqual(1, len(logs.output))
+        self.assertIn('skipped 2 invalid records', logs.output[0])
+
+    def test_replay(self):
+        cache = ResponseCache(self.tmp)
+        first = Window(date(2018, 1, 1), date(2018, 1, 10))
+        cache.put('http://a/1', make_body(window_dates(first)), first, content_type='text/html')
+        # A later fetch of part of the window carries revised prices.
+        second = Window(date(2018, 1, 5), date(2018, 1, 6))
+        cache.put('http://a/2', make_body(window_dates(second), avg_price=55.0), second, content_type='text/html')
+        for processes in (1, 2):
+            storage = MemoryStorage()
+            replay(cache, storage, date(2018, 1, 2), date(2018, 1, 31), processes=processes)
+            self.assertEqual(9, len(storage.rows))
+            self.assertEqual([55.0, 55.0], [row[6] for row in storage.rows if row[6] != 50.0])
+            self.assertEqual(set(days(date(2018, 1, 2), 9)), storage.completed_dates())
+
+
+class TestAIMDController(unittest.TestCase):
+
+    def test_additive_increase(self):
+        controller = AIMDController(initial=2, maximum=5)
+        for _ in range(20):
+            controller.success(0.1)
+        self.assertEqual(5, controller.limit)
+        self.assertEqual([2, 3, 4, 5], [limit for _, limit in controller.history])
+
+    def test_multiplicative_decrease(self):
+        controller = AIMDController(initial=8, minimum=2, cooldown=0)
+        controller.failure()
+        self.assertEqual(4, controller.limit)
+        controller.failure()
+        controller.failure()
+        self.assertEqual(2, controller.limit)
+
+    def test_cooldown(self):
+        controller = AIMDController(initial=8, cooldown=60)
+        controller.failure()
+        controller.failure()
+        self.assertEqual(4, controller.limit)
+
+    def test_latency_spike(self):
+        controller = AIMDController(initial=8, cooldown=0)
+        controller.success(0.1)
+        controller.success(1.0)
+        self.assertEqual(4, controller.limit)
+        self.assertIn('final 4', controller.summary())
+        self.assertTrue(controller.timeline().endswith(':4'))
+
+
+class TestRetrying(unittest.TestCase):
+
+    def test_policy(self):
+        policy = RetryPolicy(base=1, cap=5)
+        self.assertTrue(policy.retryable(503))
+        self.assertFalse(policy.retryable(404))
+        for retry in range(10):
+            self.assertLessEqual(policy.delay(retry), 5)
+        self.assertEqual(7, policy.delay(1, minimum=7))
+        self.assertEqual(3.0, retry_after({'retry-after': '3'}))
+        self.assertIsNone(retry_after({}))
+
+    def test_budget(self):
+        budget = RetryBudget(ratio=0.5, reserve=1)
+        self.assertTrue(budget.withdraw())
+        self.assertFalse(budget.withdraw())
+        budget.deposit()
+        budget.deposit()
+        self.assertTrue(budget.withdraw())
+        self.assertEqual((2, 1), (budget.spent, budget.denied))
+
+    def test_breaker(self):
+        breaker = CircuitBreaker(threshold=2, cooldown=0)
+        breaker.failure()
+        self.assertEqual(0, breaker.delay())
+        breaker.failure()
+        self.assertEqual(CircuitBreaker.OPEN, breaker.state)
+        # Cooled down: one probe goes ahead, the others wait for its result.
+        self.assertEqual(0, breaker.delay())
+        self.assertEqual(breaker.probe_interval, breaker.delay())
+        breaker.failure()
+        self.assertEqual((CircuitBreaker.OPEN, 2), (breaker.state, breaker.trips))
+        self.assertEqual(0, breaker.delay())
+        breaker.success()
+        self.assertEqual(CircuitBreaker.CLOSED, breaker.state)
+
+    def test_breaker_waits(self):
+        breaker = CircuitBreaker(threshold=1, cooldown=60)
+        breaker.failure()
+        self.assertGreater(breaker.delay(), 59)
+
+
+class TestReporting(unittest.TestCase):
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(50, percentile(values, 50))
+        self.assertEqual(95, percentile(values, 95))
+        self.assertEqual(100, percentile(values, 100))
+        self.assertEqual(1, percentile(values, 0))
+        self.assertEqual(7, percentile([7], 99))
+        self.assertIsNone(percentile([], 50))
+
+    def test_latency_tracker(self):
+        tracker = LatencyTracker(size=10)
+        for latency in range(20):
+            tracker.add(latency / 10.0)
+        # Only the 10 most recent latencies (1.0 to 1.9) count.
+        self.assertEqual(20, tracker.count)
+        self.assertEqual(1.0, tracker.percentile(0))
+        self.assertEqual(1.9, tracker.percentile(99))
+        self.assertIn('p95 1.900s', tracker.summary())
+
+    def test_histogram(self):
+        histogram = Histogram(bounds=(0.1, 1.0, 10.0))
+        for value in (0.05, 0.1, 0.5, 0.7, 2.0, 20.0):
+            histogram.observe(value)
+        self.assertEqual([2, 2, 1, 1], histogram.counts)
+        self.assertEqual([(0.1, 2), (1.0, 4), (10.0, 5), (float('inf'), 6)], histogram.cumulative())
+        self.assertEqual(0.1, histogram.percentile(30))
+        self.assertEqual(1.0, histogram.percentile(50))
+        self.assertEqual(20.0, histogram.percentile(99))
+        self.assertAlmostEqual(23.35 / 6, histogram.mean)
+        self.assertIsNone(Histogram().percentile(50))
+        # Percentiles never exceed the largest value seen.
+        small = Histogram(bounds=(1.0,))
+        small.observe(0.2)
+        self.assertEqual(0.2, small.percentile(50))
+
+    def test_stage_timings(self):
+        timings = StageTimings()
+        with timings.span('decode'):
+            pass
+        with self.assertRaises(ValueError):
+            with timings.span('fetch'):
+                raise ValueError
+        timings.observe('db_write', 0.5)
+        self.assertEqual(['fetch', 'decode', 'db_write'], [stage for stage, _ in timings.ordered()])
+        self.assertEqual(0.5, timings.as_dict()['db_write']['p99'])
+        self.assertIn('db_write', timings.summary())
+
+        writer = BatchWriter(MemoryStorage(), batch_size=2, timings=timings)
+        writer.add([make_row(1), make_row(2)])
+        self.assertEqual(2, timings.histogram('db_write').count)
+
+    def test_progress(self):
+        now = [100.0]
+        progress = Progress(40, clock=lambda: now[0])
+        self.assertIsNone(progress.eta())
+        self.assertIn('ETA ?', progress.line())
+        progress.add(10, 5000)
+        now[0] += 50
+        self.assertEqual(150, progress.eta())
+        self.assertEqual('progress: 10/40 days (25.0%), 5000 rows, 100 rows/sec, elapsed 0:00:50, ETA 0:02:30',
+                         progress.line())
+
+
+
+class TestMetrics(unittest.TestCase):
+
+    def exposition(self):
+        out = Exposition(labels={'shard': 1})
+        out.gauge('queue_depth', 'Windows waiting', 3)
+        out.counter('rows_stored_total', 'Rows written', [({'result': 'inserted'}, 10), ({'result': 'a"b'}, 0)])
+        histogram = Histogram(bounds=(0.1, 1.0))
+        histogram.observe(0.05)
+        histogram.observe(2.0)
+        out.histogram('stage_duration_seconds', 'Stage time', [({'stage': 'fetch'}, histogram)])
+        return out.text()
+
+    def test_exposition(self):
+        self.assertEqual([
+            '# HELP aquatic_crawler_queue_depth Windows waiting',
+            '# TYPE aquatic_crawler_queue_depth gauge',
+            'aquatic_crawler_queue_depth{shard="1"} 3',
+            '# HELP aquatic_crawler_rows_stored_total Rows written',
+            '# TYPE aquatic_crawler_rows_stored_total counter',
+            'aquatic_crawler_rows_stored_total{result="inserted",shard="1"} 10',
+            'aquatic_crawler_rows_stored_total{result="a\\"b",shard="1"} 0',
+            '# HELP aquatic_crawler_stage_duration_seconds Stage time',
+            '# TYPE aquatic_crawler_stage_duration_seconds histogram',
+            'aquatic_crawler_stage_duration_seconds_bucket{le="0.1",shard="1",stage="fetch"} 1',
+            'aquatic_crawler_stage_duration_seconds_bucket{le="1",shard="1",stage="fetch"} 1',
+            'aquatic_crawler_stage_duration_seconds_bucket{le="+Inf",shard="1",stage="fetch"} 2',
+            'aquatic_crawler_stage_duration_seconds_sum{shard="1",stage="fetch"} 2.05',
+            'aquatic_crawler_stage_duration_seconds_count{shard="1",stage="fetch"} 2',
+        ], self.exposition().splitlines())
+
+    @unittest.skipIf(crawling is None, 'needs aiohttp and asyncio.coroutine')
+    def test_scrape(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        runner = loop.run_until_complete(crawling.serve_metrics(self.exposition, '127.0.0.1', 0))
+        port = runner.addresses[0][1]
+
+        def scrape(path):
+            try:
+                with urllib.request.urlopen('http://127.0.0.1:{}{}'.format(port, path), timeout=5) as response:
+                    return response.status, response.headers['Content-Type'], response.read().decode('utf-8')
+            except urllib.error.HTTPError as error:
+                return error.code, None, None
+
+        try:
+            status, content_type, text = loop.run_until_complete(loop.run_in_executor(None, scrape, '/metrics'))
+            self.assertEqual((200, CONTENT_TYPE, self.exposition()), (status, content_type, text))
+            self.assertEqual(404, loop.run_until_complete(loop.run_in_executor(None, scrape, '/'))[0])
+        finally:
+            loop.run_until_complete(runner.cleanup())
+
+    def test_textfile(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        path = os.path.join(tmp, 'crawler.prom')
+        write_textfile(path, self.exposition())
+        write_textfile(path, 'replaced\n')
+        self.assertEqual(['crawler.prom'], os.listdir(tmp))
+        with open(path, encoding='utf-8') as f:
+            self.assertEqual('replaced\n', f.read())
+
+
+def busy_function():
+    return sum(range(10000))
+
+
+class TestProfiling(unittest.TestCase):
+
+    def test_profiler(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        path = os.path.join(tmp, 'crawl.pstats')
+        out = io.StringIO()
+        profiler = Profiler(path, sort='tottime', limit=5, slow_callback=0.01, out=out)
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        profiler.watch_loop(loop)
+        with profiler:
+            busy_function()
+            loop.call_soon(time.sleep, 0.03)
+            loop.call_soon(loop.stop)
+            loop.run_forever()
+
+        report = out.getvalue()
+        self.assertIn('hottest functions by tottime', report)
+        self.assertIn('Ordered by: internal time', report)
+        self.assertIn('slow callbacks: 1 calls blocked the loop', report)
+        self.assertIn('sleep', report)
+        self.assertIn('busy_function', str(pstats.Stats(path).stats))
+
+    def test_slow_callbacks(self):
+        handler = SlowCallbacks()
+        errors = []
+        handler.handleError = errors.append
+
+        def record(msg, *args):
+            return logging.LogRecord('asyncio', logging.WARNING, __file__, 1, msg, args, None)
+        handler.handle(record('Executing %s took %.3f seconds', '<Handle sleep() at 0x7f00>', 0.5))
+        handler.handle(record(ValueError('not a string')))
+        handler.handle(record('Executing %s took %.3f seconds', '<Handle sleep()>', 'slow'))
+        self.assertEqual({'<Handle sleep()>': [0.5]}, dict(handler.calls))
+        self.assertEqual(1, len(errors))
+
+
+class TestFakeMarket(unittest.TestCase):
+
+    def test_body(self):
+        market = FakeMarket(rows_per_day=40, seed=3)
+        start = date(2018, 1, 1)
+        body = market.body(start, start + timedelta(days=2))
+        rows, marks = window_rows(decode('text/html; charset=utf-8', body), Window(start, start + timedelta(days=2)))
+        self.assertEqual(120, len(rows))
+        self.assertEqual(40, len({(row[1], row[2]) for row in rows}))
+        self.assertEqual([(day.isoformat(), LEDGER_DONE, 40) for day in days(start, 3)], marks)
+        for row in rows:
+            self.assertLessEqual(row[4], row[6])
+            self.assertLessEqual(row[6], row[3])
+        self.assertEqual(body, FakeMarket(rows_per_day=40, seed=3).body(start, start + timedelta(days=2)))
+        self.assertNotEqual(body, FakeMarket(rows_per_day=40, seed=4).body(start, start + timedelta(days=2)))
+        self.assertEqual(b'[]', market.body(start + timedelta(days=1), start))
+
+
+
+@unittest.skipIf(crawling is None, 'needs aiohttp and asyncio.coroutine')
+class TestCrawler(unittest.TestCase):
+    """Whole crawls against a fakeserver.FakeServer on a thread of its own."""
+
+    start = date(2018, 1, 1)
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+    def serve(self, rows_per_day=20, **kwargs):
+        server = fakeserver.FakeServer(FakeMarket(rows_per_day=rows_per_day), **kwargs)
+        thread = fakeserver.ServerThread(server)
+        url = thread.start()
+        self.addCleanup(thread.stop)
+        return server, url
+
+    def make_crawler(self, url, n, **options):
+        options.setdefault('storage', MemoryStorage())
+        options.setdefault('progress_interval', 0)
+        options.setdefault('retry_policy', RetryPolicy(base=0.01, cap=0.05))
+        crawler = crawling.Crawler(self.start, self.start + timedelta(days=n - 1), base_url=url, loop=self.loop,
+                                   **options)
+        self.addCleanup(crawler.close)
+        return crawler
+
+    def run_crawl(self, crawler, timeout=30):
+        with redirect_stdout(io.StringIO()):
+            self.loop.run_until_complete(asyncio.wait_for(crawler.crawl(), timeout, loop=self.loop))
+        return crawler
+
+    def crawl(self, url, n, **options):
+        return self.run_crawl(self.make_crawler(url, n, **options))
+
+    def assertComplete(self, crawler, n, rows_per_day=20):
+        storage = crawler.storage
+        self.assertEqual(n * rows_per_day, len(storage.rows))
+        self.assertEqual({day.isoformat(): (LEDGER_DONE, rows_per_day) for day in days(self.start, n)},
+                         storage.ledger)
+        self.assertEqual([], crawler.failed_dates)
+
+    def test_connection_reuse(self):
+        server, url = self.serve()
+        crawler = self.crawl(url, 6, window_days=1, max_window_days=1, max_tasks=1, initial_tasks=1)
+        self.assertComplete(crawler, 6)
+        stats = crawler.stats()
+        self.assertEqual({'created': 1, 'reused': 5}, stats['connections'])
+        self.assertEqual(6, server.requests)
+        self.assertEqual(stats['bytes']['wire'], stats['bytes']['decoded'])
+
+    def test_compression(self):
+        server, url = self.serve(compress=True)
+        crawler = self.crawl(url, 6, window_days=3)
+        self.assertComplete(crawler, 6)
+        stats = crawler.stats()
+        self.assertLess(stats['bytes']['wire'] * 2, stats['bytes']['decoded'])
+
+    def test_read_timeout(self):
+        server, url = self.serve(latency=3.0, latency_sigma=0.0)
+        t0 = time.time()
+        with self.assertLogs('crawler.crawling', 'ERROR'):
+            crawler = self.crawl(url, 1, read_timeout=0.2, max_tries=2)
+        self.assertLess(time.time() - t0, 2.0)
+        self.assertEqual([self.start], crawler.failed_dates)
+        self.assertEqual((LEDGER_FAILED, 0), crawler.storage.ledger['2018-01-01'])
+        self.assertEqual(2, crawler.net_stats['requests'])
+        self.assertEqual(0, len(crawler.latencies.recent))
+
+    def slow_first(self, server, secs=1.0):
+        """Make the first request to `server` take `secs`, and every later one no time."""
+        delays = [secs]
+        server.delay = lambda: delays.pop() if delays else 0.0
+
+    def test_hedged_request(self):
+        server, url = self.serve()
+        self.slow_first(server)
+        crawler = self.make_crawler(url, 1, max_tasks=1, hedge_percentile=50, hedge_min_samples=1)
+        crawler.latencies.add(0.05)
+        outcomes = []
+        request = crawler.request
+
+        @asyncio.coroutine
+        def recording_request(url, read=True):
+            try:
+                result = yield from request(url, read)
+            except asyncio.CancelledError:
+                outcomes.append('cancelled')
+                raise
+            outcomes.append('answered')
+            return result
+        crawler.request = recording_request
+
+        window_url = crawler.window_url(Window(self.start, self.start))
+        t0 = time.time()
+        response, body = self.loop.run_until_complete(crawler.hedged_request(window_url))
+        response.release()
+        self.assertLess(time.time() - t0, 0.5)
+        self.assertEqual(20, len(decode('text/html; charset=utf-8', body)))
+        self.assertEqual((2, 1, 1), (crawler.net_stats['requests'], crawler.net_stats['hedges'],
+                                     crawler.net_stats['hedge_wins']))
+        self.loop.run_until_complete(asyncio.sleep(0.05, loop=self.loop))
+        self.assertEqual(['answered', 'cancelled'], outcomes)
+
+        # The loser gave its connection back: both pooled connections can be used at once.
+        crawler.request = request
+        both = asyncio.gather(request(window_url), request(window_url), loop=self.loop)
+        for response, body in self.loop.run_until_complete(asyncio.wait_for(both, 5, loop=self.loop)):
+            response.release()
+
+    def test_hedged_crawl(self):
+        server, url = self.serve()
+        self.slow_first(server)
+        crawler = self.make_crawler(url, 3, max_tasks=1, hedge_percentile=50, hedge_min_samples=1)
+        crawler.latencies.add(0.1)
+        self.run_crawl(crawler)
+        self.assertComplete(crawler, 3)
+        self.assertEqual(1, crawler.net_stats['hedges'])
+        self.assertEqual(1, crawler.net_stats['hedge_wins'])
+        # The hedged request counts from the first copy, so not below the delay it was hedged after.
+        self.assertGreaterEqual(crawler.latencies.recent[1], 0.1)
+
+    def crawl_sharded(self, url, n, processes, **options):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        storage = SQLiteStorage(os.path.join(tmp, 'main.sqlite'))
+        self.addCleanup(storage.close)
+        out = io.StringIO()
+        with redirect_stdout(out):
+            result = crawling.crawl_sharded(self.start, self.start + timedelta(days=n - 1), storage, processes,
+                                            base_url=url, progress_interval=0, staging_dir=tmp, **options)
+        self.assertFalse([name for name in os.listdir(tmp) if name.startswith('crawl-shards-')])
+        return storage, result, out.getvalue()
+
+    def test_sharded(self):
+        server, url = self.serve()
+        storage, result, _ = self.crawl_sharded(url, 10, 2)
+        self.assertEqual(set(days(self.start, 10)), storage.completed_dates())
+        self.assertEqual([5, 5], [stats['days']['done'] for stats in result['shards']])
+        self.assertEqual(200, result['merge']['rows'])
+        self.assertEqual(200, result['merge']['inserted'])
+
+    def test_failed_shard(self):
+        # The second shard cannot serve its metrics on the port after the first one's, so it fails.
+        for _ in range(20):
+            blocker = socket.socket()
+            blocker.bind(('127.0.0.1', 0))
+            port = blocker.getsockname()[1] - 1
+            probe = socket.socket()
+            try:
+                probe.bind(('127.0.0.1', port))
+                break
+            except OSError:
+                blocker.close()
+            finally:
+                probe.close()
+        self.addCleanup(blocker.close)
+        blocker.listen(1)
+        server, url = self.serve()
+        with self.assertLogs('crawler.crawling', 'ERROR') as logs:
+            storage, result, out = self.crawl_sharded(url, 10, 2, metrics_port=port)
+        self.assertIn('shard 1 failed', logs.output[0])
+        self.assertEqual(set(days(self.start, 5)), storage.completed_dates())
+        self.assertIsNone(result['shards'][1])
+        self.assertEqual(100, result['merge']['rows'])
+        self.assertIn('failed shards: 1 (rerun with --incremental', out)
+
+    def test_unexpected_error(self):
+        server, url = self.serve()
+        crawler = self.make_crawler(url, 6, window_days=3, max_window_days=3)
+        fetch = crawler.fetch
+
+        @asyncio.coroutine
+        def broken_fetch(window):
+            if window.start == self.start:
+                raise RuntimeError('boom')
+            yield from fetch(window)
+        crawler.fetch = broken_fetch
+        with self.assertLogs('crawler.crawling', 'ERROR') as logs:
+            self.run_crawl(crawler)
+        self.assertIn('RuntimeError: boom', logs.output[0])
+        self.assertEqual(days(self.start, 3), crawler.failed_dates)
+        self.assertEqual(LEDGER_FAILED, crawler.storage.ledger['2018-01-01'][0])
+        self.assertEqual((LEDGER_DONE, 20), crawler.storage.ledger['2018-01-06'])
+        self.assertEqual(60, len(crawler.storage.rows))
+
+    def test_rejected_records(self):
+        server, url = self.serve()
+        crawler = self.make_crawler(url, 2)
+        window = Window(self.start, self.start + timedelta(days=1))
+        body = json.dumps([make_item(self.start), make_item(self.start, avg_price=None),
+                           make_item(self.start + timedelta(days=1), avg_price=None)]).encode('utf-8')
+        with self.assertLogs('crawler.ingesting', 'WARNING'):
+            rows = self.loop.run_until_complete(crawler.ingest('text/html; charset=utf-8', body, window))
+        self.assertEqual(1, rows)
+        self.assertEqual(2, crawler.stats()['rows']['rejected'])
+        self.assertIn('aquatic_crawler_records_rejected_total 2', crawler.metrics())
+        out = io.StringIO()
+        crawler.t1 = time.time()
+        with redirect_stdout(out):
+            crawler.report()
+        self.assertIn('invalid records skipped: 2', out.getvalue())
+
+    def test_split_large_window(self):
+        server, url = self.serve()
+        crawler = self.make_crawler(url, 6, window_days=6, max_window_days=6)
+        day_size = len(server.market.body(self.start, self.start))
+        crawler.planner.max_bytes = day_size * 5 // 2
+        with self.assertLogs('crawler.crawling', 'INFO') as logs:
+            self.run_crawl(crawler)
+        self.assertComplete(crawler, 6)
+        # 6 days, then 3 + 3, then 1 + 2 twice.
+        self.assertEqual(7, server.requests)
+        self.assertEqual(3, sum('response too large' in line for line in logs.output))
+
+    def test_write_pipeline(self):
+        server, url = self.serve()
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        storage = SQLiteStorage(os.path.join(tmp, 'crawl.sqlite'))
+        crawler = self.crawl(url, 10, window_days=2, max_window_days=2, storage=storage, batch_size=50,
+                             write_queue_size=1)
+        self.assertEqual(set(days(self.start, 10)), storage.completed_dates())
+        self.assertEqual(200, storage.conn.execute('SELECT COUNT(*) FROM trades').fetchone()[0])
+        self.assertEqual(200, storage.counts['inserted'])
+        stages = crawler.stats()['stages']
+        # Five windows of 40 rows make two batches of 80 and one of the last 40.
+        self.assertEqual(3, stages['db_write']['count'])
+        self.assertEqual(5, stages['write_wait']['count'])
+
+    def test_retries_and_throttle(self):
+        server, url = self.serve(error_rate=0.3, seed=1)
+        crawler = self.crawl(url, 20, window_days=1, max_window_days=1, max_tasks=4, initial_tasks=4,
+                             retry_budget=RetryBudget(reserve=100), breaker=CircuitBreaker(threshold=100))
+        self.assertComplete(crawler, 20)
+        self.assertGreater(server.errors, 0)
+        self.assertEqual(server.errors, crawler.retries)
+        self.assertEqual(20 + server.errors, crawler.net_stats['requests'])
+        # Every 503 is a failure to the throttle, which halves the limit.
+        self.assertEqual(2, min(limit for _, limit in crawler.throttle.history))
+
+    def test_retry_budget_exhausted(self):
+        server, url = self.serve(error_rate=1.0)
+        with self.assertLogs('crawler.crawling', 'ERROR') as logs:
+            crawler = self.crawl(url, 3, window_days=1, max_window_days=1,
+                                 retry_budget=RetryBudget(ratio=0, reserve=2), breaker=CircuitBreaker(threshold=100))
+        self.assertEqual(3, sum('retry budget exhausted' in line for line in logs.output))
+        self.assertEqual(days(self.start, 3), sorted(crawler.failed_dates))
+        self.assertEqual({'sent': 5, 'retries': 2, 'denied_by_budget': 3},
+                         {key: crawler.stats()['requests'][key] for key in ('sent', 'retries', 'denied_by_budget')})
+
+    def test_circuit_breaker(self):
+        server, url = self.serve(error_rate=1.0)
+        t0 = time.time()
+        breaker = CircuitBreaker(threshold=2, cooldown=0.2)
+        with self.assertLogs(level='WARNING') as logs:
+            crawler = self.crawl(url, 2, window_days=1, max_window_days=1, max_tasks=1, max_tries=3,
+                                 retry_budget=RetryBudget(reserve=100), breaker=breaker)
+        self.assertEqual(days(self.start, 2), crawler.failed_dates)
+        self.assertEqual(6, server.requests)
+        # Open after the second failure, then every half-open probe fails and opens it again.
+        self.assertEqual(5, breaker.trips)
+        self.assertIn('pausing requests for 0.2 secs', logs.output[0])
+        self.assertGreaterEqual(time.time() - t0, 0.8)
+
+    def record_windows(self, crawler):
+        """Record the start of every window `crawler` fetches and the number of windows then waiting."""
+        fetched = []
+        fetch = crawler.fetch
+
+        @asyncio.coroutine
+        def recording_fetch(window):
+            fetched.append((window.start, crawler.q.qsize()))
+            yield from fetch(window)
+        crawler.fetch = recording_fetch
+        return fetched
+
+    def test_producer_queue(self):
+        server, url = self.serve()
+        crawler = self.make_crawler(url, 8, window_days=1, max_window_days=1, max_tasks=1, queue_size=2,
+                                    order='newest')
+        fetched = self.record_windows(crawler)
+        self.run_crawl(crawler)
+        self.assertComplete(crawler, 8)
+        self.assertEqual(days(self.start, 8)[::-1], [start for start, _ in fetched])
+        self.assertLessEqual(max(waiting for _, waiting in fetched), 2)
+
+    def test_gaps_first(self):
+        server, url = self.serve()
+        storage = MemoryStorage()
+        storage.write([], [(day.isoformat(), LEDGER_DONE, 20) for day in days(self.start, 3)])
+        crawler = self.make_crawler(url, 6, window_days=1, max_window_days=1, max_tasks=1, order='gaps',
+                                    storage=storage)
+        fetched = self.record_windows(crawler)
+        self.run_crawl(crawler)
+        self.assertEqual(days(self.start, 6)[:2:-1] + days(self.start, 3)[::-1], [start for start, _ in fetched])
+        self.assertEqual(120, len(storage.rows))
+
+    def test_stream(self):
+        server, url = self.serve(compress=True)
+        crawler = self.crawl(url, 6, window_days=3, stream=True, chunk_size=256, stream_batch=7)
+        self.assertComplete(crawler, 6)
+        stats = crawler.stats()
+        self.assertEqual(6 * 20, stats['rows']['parsed'])
+        self.assertLess(stats['bytes']['wire'] * 2, stats['bytes']['decoded'])
+        # Rows reach the writer a few at a time, before each response has been read to the end.
+        self.assertGreater(stats['stages']['write_wait']['count'], 6)
+
+
+if __name__ == '__main__':
+    unittest.main()
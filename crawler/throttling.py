@@ -0,0 +1,76 @@
+"""Throttling -- choose how many requests to keep in flight (AIMD).
+
+The controller works like TCP congestion control: every healthy response
+adds `increase / limit` to the limit, i.e. about `increase` per round of
+requests, and a timeout, a 5xx/429 response or a latency spike multiplies
+it by `decrease`.  At most one cut happens per `cooldown` seconds so a
+burst of failures from the same overload only counts once.
+"""
+
+import logging
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+
+class AIMDController:
+    """Additive-increase / multiplicative-decrease concurrency limit."""
+
+    def __init__(self, initial=4, minimum=1, maximum=100, increase=1.0, decrease=0.5,
+                 spike_factor=3.0, smoothing=0.1, cooldown=1.0):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.spike_factor = spike_factor
+        self.smoothing = smoothing
+        self.cooldown = cooldown
+
+        self._limit = float(max(minimum, min(initial, maximum)))
+        self.latency = None  # Exponentially weighted moving average.
+        self.last_cut = None
+        self.t0 = time.time()
+        self.history = [(0.0, self.limit)]
+
+    @property
+    def limit(self):
+        return int(self._limit)
+
+    def _set(self, value):
+        old = self.limit
+        self._limit = max(self.minimum, min(value, self.maximum))
+        if self.limit != old:
+            self.history.append((time.time() - self.t0, self.limit))
+
+    def success(self, latency):
+        """Record a healthy response that took `latency` seconds."""
+        if self.latency is not None and latency > self.spike_factor * self.latency:
+            self.failure('latency spike ({:.3f}s vs {:.3f}s average)'.format(latency, self.latency))
+        else:
+            self._set(self._limit + self.increase / self._limit)
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += self.smoothing * (latency - self.latency)
+
+    def failure(self, reason='failure'):
+        """Record a timeout, overload response or latency spike."""
+        now = time.time()
+        if self.last_cut is not None and now - self.last_cut < self.cooldown:
+            return
+        self.last_cut = now
+        self._set(self._limit * self.decrease)
+        LOGGER.info('%s, concurrency limit cut to %r', reason, self.limit)
+
+    def summary(self):
+        limits = [limit for _, limit in self.history]
+        return 'concurrency limit: final {}, min {}, max {}, {} changes'.format(
+            self.limit, min(limits), max(limits), len(self.history) - 1)
+
+    def timeline(self, max_points=20):
+        """The limit over time as 'secs:limit' pairs, thinned to `max_points`."""
+        step = max(1, len(self.history) // max_points)
+        points = self.history[::step]
+        if points[-1] != self.history[-1]:
+            points.append(self.history[-1])
+        return ' '.join('{:.1f}s:{}'.format(t, limit) for t, limit in points)
@@ -0,0 +1,29 @@
+#!/usr/bin/env python3.6
+
+"""Export crawled trades to memory-mapped column files for analysis."""
+
+import argparse
+import logging
+
+import analysis.columnar as columnar
+import crawler.storage as storage
+
+ARGS = argparse.ArgumentParser(description='Export crawled trades to a columnar store')
+ARGS.add_argument('--database', action='store', metavar='PATH', default=storage.DATABASE_PATH,
+                  help='SQLite database written by crawl.py')
+ARGS.add_argument('--batch_size', action='store', type=int, metavar='N', default=100000,
+                  help='Rows read from the database at a time')
+ARGS.add_argument('output', action='store', metavar='DIR',
+                  help='Directory holding the column files')
+ARGS.add_argument('-q', '--quiet', action='store_const', const=logging.ERROR, dest='level', default=logging.INFO,
+                  help='Only log errors')
+
+
+def main():
+    args = ARGS.parse_args()
+    logging.basicConfig(level=args.level)
+    columnar.export(args.database, args.output, batch_size=args.batch_size)
+
+
+if __name__ == '__main__':
+    main()
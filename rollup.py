@@ -0,0 +1,32 @@
+#!/usr/bin/env python3.6
+
+"""Rebuild the day, week, month and year rollups of a crawler database."""
+
+import argparse
+import logging
+import time
+
+import crawler.storage as storage
+
+ARGS = argparse.ArgumentParser(description='Rebuild the rollup tables from the stored trades')
+ARGS.add_argument('--database', action='store', metavar='PATH', default=storage.DATABASE_PATH,
+                  help='SQLite database written by crawl.py')
+ARGS.add_argument('-q', '--quiet', action='store_const', const=logging.ERROR, dest='level', default=logging.INFO,
+                  help='Only log errors')
+
+
+def main():
+    args = ARGS.parse_args()
+    logging.basicConfig(level=args.level)
+    store = storage.SQLiteStorage(args.database)
+    try:
+        t0 = time.time()
+        counts = store.rebuild_rollups()
+        print('rebuilt rollups in {:.3f} secs: {}'.format(
+            time.time() - t0, ', '.join('{} {} rows'.format(grain, rows) for grain, rows in counts.items())))
+    finally:
+        store.close()
+
+
+if __name__ == '__main__':
+    main()